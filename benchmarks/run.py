@@ -0,0 +1,344 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import paramiko
+import yaml
+
+# The commands read the sudo password at import time; the fake hosts
+# ignore it but the commands refuse to run without one
+os.environ.setdefault("AV_AGENT_SUDO_PASSWORD", "benchmark")
+
+from benchmarks.ssh_server import fleet_addresses, serve_fleet  # noqa: E402
+from modules.agent import Agent  # noqa: E402
+from modules.command_get_logs import CommandGetLogs  # noqa: E402
+from modules.command_update import CommandUpdate  # noqa: E402
+from modules.commander import EchoCommand  # noqa: E402
+from modules.metrics import percentile  # noqa: E402
+
+logger = logging.getLogger("Benchmark")
+
+BASELINE = Path(__file__).with_name("baseline.json")
+
+# name -> (agent method, command factory)
+CASES = {
+    "run_ssh_command": ("run_ssh_command", lambda: EchoCommand("bench")),
+    "run_ssh_command_async": (
+        "run_ssh_command_async",
+        lambda: EchoCommand("bench"),
+    ),
+    "get_logs": (
+        "run_ssh_command_async",
+        lambda: CommandGetLogs("/var/log/syslog"),
+    ),
+    "update": ("run_ssh_command_async", CommandUpdate),
+}
+
+# Metric -> True when a higher value is better
+METRICS = {
+    "throughput": True,
+    "p50": False,
+    "p99": False,
+    "peak_rss_mb": False,
+    "peak_threads": False,
+}
+
+
+class ResourceSampler:
+    """Samples RSS and thread count in the background to find their peaks."""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_threads = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        self.peak_rss = max(self.peak_rss, _rss_bytes())
+        # Not counting this sampler thread itself
+        self.peak_threads = max(
+            self.peak_threads, threading.active_count() - 1
+        )
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+
+        # Peak since process start, in KiB on Linux and bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def write_agent_files(
+    workdir, hosts, port, key_path, known_hosts_path, options
+):
+    config_dir = workdir / "config"
+    config_dir.mkdir(parents=True, exist_ok=True)
+    (config_dir / "hosts.txt").write_text("\n".join(hosts) + "\n")
+    config = {
+        "repository": "Twanus/av-agent-fw",
+        "hosts_file": "config/hosts.txt",
+        "private_key_path": str(key_path),
+        "known_hosts_file": str(known_hosts_path),
+        "ssh_port": port,
+        "backend": "thread",
+        "max_parallel": 32,
+        "host_timeout": 300,
+        "run_timeout": 1800,
+        "pool_size": 256,
+        "result_store": "data/results.db",
+    }
+    config.update(options)
+    with open(config_dir / "config.yaml", "w") as f:
+        yaml.safe_dump(config, f)
+
+
+def run_case(name, host_count):
+    """Run one case against a fresh Agent and return its measurements."""
+    method, make_command = CASES[name]
+    agent = Agent(skip_logging=True)
+    command = make_command()
+    durations = []
+    failures = 0
+
+    with ResourceSampler() as sampler:
+        started = time.perf_counter()
+        if method == "run_ssh_command":
+            # The sequential path has no per-host results, so time each
+            # host from connect to close on this agent's connector
+            connector = agent.ssh_connector
+            connect = connector.connect_to_host
+            close = connector.close_connection
+            host_started = {}
+
+            def timed_connect(host):
+                host_started[host] = time.perf_counter()
+                return connect(host)
+
+            def timed_close(client, session_id, host):
+                close(client, session_id, host)
+                durations.append(time.perf_counter() - host_started[host])
+
+            connector.connect_to_host = timed_connect
+            connector.close_connection = timed_close
+            agent.run_ssh_command(command)
+            failures = host_count - len(durations)
+        else:
+            handle = agent.run_ssh_command_async(command)
+            for result in handle:
+                durations.append(result.duration)
+                if result.exit_status != 0:
+                    failures += 1
+        wall = time.perf_counter() - started
+        agent.shutdown()
+
+    return {
+        "hosts": host_count,
+        "wall": wall,
+        "throughput": host_count / wall,
+        "p50": percentile(durations, 0.50),
+        "p99": percentile(durations, 0.99),
+        "peak_rss_mb": sampler.peak_rss / 2**20,
+        "peak_threads": sampler.peak_threads,
+        "failures": failures,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Return ``[(key, metric, baseline, current)]`` for every regression."""
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if not base.get(metric):
+                continue
+            change = (result[metric] - base[metric]) / base[metric]
+            if higher_is_better:
+                change = -change
+            if change > tolerance:
+                regressions.append((key, metric, base[metric], result[metric]))
+    return regressions
+
+
+def print_table(results, baseline):
+    print(
+        f"{'case':<32} {'hosts/s':>9} {'p50':>8} {'p99':>8} "
+        f"{'rss MiB':>8} {'threads':>7} {'failed':>6}"
+    )
+    for key, r in results.items():
+        print(
+            f"{key:<32} {r['throughput']:>9.1f} {r['p50']:>7.3f}s "
+            f"{r['p99']:>7.3f}s {r['peak_rss_mb']:>8.1f} "
+            f"{r['peak_threads']:>7} {r['failures']:>6}"
+        )
+        base = baseline.get(key)
+        if base:
+            print(
+                f"{'  baseline':<32} {base['throughput']:>9.1f} "
+                f"{base['p50']:>7.3f}s {base['p99']:>7.3f}s "
+                f"{base['peak_rss_mb']:>8.1f} {base['peak_threads']:>7}"
+            )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the agent against fake SSH hosts."
+    )
+    parser.add_argument(
+        "--hosts", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    parser.add_argument(
+        "--cases", nargs="+", choices=sorted(CASES), default=list(CASES)
+    )
+    parser.add_argument("--backend", choices=["thread", "asyncio"])
+    parser.add_argument("--max-parallel", type=int, default=32)
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Worker processes for the async cases (0: one per CPU)",
+    )
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="Seconds per command"
+    )
+    parser.add_argument(
+        "--connect-latency",
+        type=float,
+        default=0.0,
+        help="Seconds before each SSH handshake starts",
+    )
+    parser.add_argument("--output-size", type=int, default=4096)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store these results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative change that counts as a regression",
+    )
+    parser.add_argument(
+        "--max-sequential-hosts",
+        type=int,
+        default=100,
+        help="Skip run_ssh_command above this many hosts",
+    )
+    args = parser.parse_args(argv)
+
+    # Per-host errors from simulated failures would drown the report
+    logging.basicConfig(level=logging.CRITICAL)
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+
+    options = {"max_parallel": args.max_parallel}
+    if args.backend:
+        options["backend"] = args.backend
+    if args.processes is not None:
+        options["processes"] = args.processes
+
+    results = {}
+    cwd = os.getcwd()
+    for host_count in args.hosts:
+        with tempfile.TemporaryDirectory() as tmp:
+            workdir = Path(tmp)
+            key = paramiko.ECDSAKey.generate()
+            key_path = workdir / "id_bench"
+            key.write_private_key_file(str(key_path))
+            known_hosts_path = workdir / "known_hosts"
+
+            # The fleet runs in its own process so its CPU time does not
+            # compete with the agent for the GIL
+            ready = multiprocessing.Queue()
+            stop = multiprocessing.Event()
+            fleet = multiprocessing.Process(
+                target=serve_fleet,
+                args=(
+                    {
+                        "count": host_count,
+                        "port": args.port,
+                        "latency": args.latency,
+                        "connect_latency": args.connect_latency,
+                        "output_size": args.output_size,
+                        "failure_rate": args.failure_rate,
+                    },
+                    ready,
+                    stop,
+                ),
+                daemon=True,
+            )
+            fleet.start()
+            try:
+                known_hosts_path.write_text(
+                    "\n".join(ready.get(timeout=120)) + "\n"
+                )
+                write_agent_files(
+                    workdir,
+                    fleet_addresses(host_count),
+                    args.port,
+                    key_path,
+                    known_hosts_path,
+                    options,
+                )
+                os.chdir(workdir)
+                for name in args.cases:
+                    if (
+                        name == "run_ssh_command"
+                        and host_count > args.max_sequential_hosts
+                    ):
+                        continue
+                    key_name = f"{name}@{host_count}"
+                    print(f"Running {key_name}...", file=sys.stderr)
+                    results[key_name] = run_case(name, host_count)
+            finally:
+                os.chdir(cwd)
+                stop.set()
+                fleet.join(timeout=30)
+
+    print_table(results, baseline)
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for key, metric, before, after in regressions:
+        print(f"REGRESSION {key} {metric}: {before:.3f} -> {after:.3f}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
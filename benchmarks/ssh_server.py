@@ -0,0 +1,231 @@
+import argparse
+import logging
+import random
+import selectors
+import socket
+import threading
+import time
+
+import paramiko
+
+logger = logging.getLogger("FakeSSHFleet")
+
+# What DetectOSCommand and the host facts script see on every fake host
+OS_RELEASE = (
+    "os_id=ubuntu\n"
+    "os_version=24.04\n"
+    "arch=x86_64\n"
+    "kernel=6.8.0-fake\n"
+    "package_manager=apt-get\n"
+)
+
+
+def fleet_addresses(count):
+    """Return ``count`` distinct loopback addresses (127.0.x.y)."""
+    if count > 254 * 256:
+        raise ValueError("At most 65024 fake hosts are supported")
+    return [f"127.0.{i // 254}.{i % 254 + 1}" for i in range(count)]
+
+
+class FakeHost(paramiko.ServerInterface):
+    """Accepts any key and answers every exec request with canned output."""
+
+    def __init__(self, fleet):
+        self.fleet = fleet
+        # paramiko allows one global request in flight per transport
+        self.sync_lock = threading.Lock()
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=self.fleet.respond,
+            args=(channel, command.decode(errors="replace"), self.sync_lock),
+            daemon=True,
+        ).start()
+        return True
+
+
+class FakeSSHFleet:
+    """``count`` fake SSH hosts on loopback addresses sharing one port.
+
+    Every host gets its own 127.0.x.y address, so the agent pools and
+    caches them as separate hosts. Commands are not run: each one sleeps
+    ``latency`` seconds and prints ``output_size`` bytes, except the host
+    facts probe (answered as Ubuntu/apt) and a ``failure_rate`` share of
+    commands that exit 1. ``sudo -S`` commands first read the password
+    line from stdin. Linux routes all of 127.0.0.0/8 to loopback;
+    other systems need the extra addresses configured first.
+    """
+
+    def __init__(
+        self,
+        count,
+        port=2222,
+        latency=0.0,
+        connect_latency=0.0,
+        output_size=4096,
+        failure_rate=0.0,
+        host_key=None,
+    ):
+        self.addresses = fleet_addresses(count)
+        self.port = port
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.output = (b"x" * 79 + b"\n") * (output_size // 80) + b"x" * (
+            output_size % 80
+        )
+        self.failure_rate = failure_rate
+        self.host_key = host_key or paramiko.ECDSAKey.generate()
+        self._selector = selectors.DefaultSelector()
+        self._sockets = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        for address in self.addresses:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((address, self.port))
+            sock.listen(128)
+            sock.setblocking(False)
+            self._selector.register(sock, selectors.EVENT_READ)
+            self._sockets.append(sock)
+        self._thread = threading.Thread(
+            target=self._accept_loop, name="fake-fleet", daemon=True
+        )
+        self._thread.start()
+        logger.info(
+            "Serving %d fake hosts on port %d", len(self.addresses), self.port
+        )
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for sock in self._sockets:
+            self._selector.unregister(sock)
+            sock.close()
+        self._sockets = []
+
+    def known_hosts_lines(self):
+        """known_hosts entries for every fake host."""
+        key = f"{self.host_key.get_name()} {self.host_key.get_base64()}"
+        return [
+            f"[{address}]:{self.port} {key}" for address in self.addresses
+        ]
+
+    def respond(self, channel, command, sync_lock):
+        try:
+            if "sudo -S" in command:
+                # Like sudo, read the password before doing anything
+                channel.settimeout(30)
+                channel.makefile("rb").readline()
+            if self.latency:
+                time.sleep(self.latency)
+            if random.random() < self.failure_rate:  # nosec B311
+                channel.sendall_stderr(b"simulated failure\n")
+                channel.send_exit_status(1)
+            elif "os-release" in command:
+                channel.sendall(OS_RELEASE.encode())
+                channel.send_exit_status(0)
+            else:
+                channel.sendall(self.output)
+                channel.send_exit_status(0)
+            # Closing right away can overtake the reply to the exec request.
+            # The transport handles packets in order, so it has sent that
+            # reply once the answer to a keepalive sent now is in.
+            with sync_lock:
+                channel.get_transport().global_request(
+                    "keepalive@openssh.com", wait=True
+                )
+        except (OSError, EOFError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+    def _accept_loop(self):
+        while not self._stop.is_set():
+            for key, _ in self._selector.select(timeout=0.2):
+                try:
+                    conn, _ = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(True)
+                # respond() waits on a small keepalive round trip, which
+                # Nagle would hold back until the client's delayed ACK
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                threading.Thread(
+                    target=self._serve, args=(conn,), daemon=True
+                ).start()
+
+    def _serve(self, conn):
+        if self.connect_latency:
+            time.sleep(self.connect_latency)
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=FakeHost(self))
+        except (OSError, EOFError, paramiko.SSHException):
+            transport.close()
+
+
+def serve_fleet(options, ready, stop):
+    """Run a fleet until ``stop`` is set; for use in a child process.
+
+    The known_hosts lines are put on the ``ready`` queue once every host
+    is listening.
+    """
+    fleet = FakeSSHFleet(**options)
+    fleet.start()
+    ready.put(fleet.known_hosts_lines())
+    stop.wait()
+    fleet.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run fake SSH hosts on loopback for benchmarking."
+    )
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--connect-latency", type=float, default=0.0)
+    parser.add_argument("--output-size", type=int, default=4096)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--known-hosts", help="Write known_hosts entries to this file"
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    fleet = FakeSSHFleet(
+        args.hosts,
+        port=args.port,
+        latency=args.latency,
+        connect_latency=args.connect_latency,
+        output_size=args.output_size,
+        failure_rate=args.failure_rate,
+    )
+    fleet.start()
+    if args.known_hosts:
+        with open(args.known_hosts, "w") as f:
+            f.write("\n".join(fleet.known_hosts_lines()) + "\n")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fleet.stop()
+
+
+if __name__ == "__main__":
+    main()
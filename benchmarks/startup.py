@@ -0,0 +1,175 @@
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess  # nosec B404
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import paramiko
+
+from benchmarks.run import write_agent_files
+from benchmarks.ssh_server import fleet_addresses, serve_fleet
+from modules.metrics import percentile
+
+BASELINE = Path(__file__).with_name("startup_baseline.json")
+ROOT = Path(__file__).resolve().parent.parent
+
+# Metric -> seconds, lower is better
+METRICS = ("import", "first_connection", "total")
+
+
+def time_import():
+    """Seconds for a fresh interpreter to import everything main.py does."""
+    started = time.perf_counter()
+    # Fixed argv of this interpreter, no shell
+    subprocess.run(  # nosec B603
+        [sys.executable, "-c", "import main"],
+        cwd=ROOT,
+        check=True,
+    )
+    return time.perf_counter() - started
+
+
+def time_main(workdir, env, timeout=120):
+    """Run ``python main.py`` in ``workdir``.
+
+    Returns ``(first_connection, total)``: seconds until the first
+    "Connected successfully" log line and until the process exited.
+    """
+    first = []
+    started = time.perf_counter()
+    # Fixed argv of this interpreter, no shell
+    process = subprocess.Popen(  # nosec B603
+        [sys.executable, str(ROOT / "main.py")],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+    def watch():
+        for line in process.stderr:
+            if not first and "Connected successfully" in line:
+                first.append(time.perf_counter() - started)
+
+    reader = threading.Thread(target=watch, daemon=True)
+    reader.start()
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+        raise
+    total = time.perf_counter() - started
+    reader.join()
+    if process.returncode != 0:
+        raise RuntimeError(f"main.py exited with {process.returncode}")
+    if not first:
+        raise RuntimeError("main.py never connected to a host")
+    return first[0], total
+
+
+def measure(workdir, env, runs):
+    samples = {metric: [] for metric in METRICS}
+    for _ in range(runs):
+        samples["import"].append(time_import())
+        first_connection, total = time_main(workdir, env)
+        samples["first_connection"].append(first_connection)
+        samples["total"].append(total)
+    # Startup is noisy; the median of a few runs is stable enough
+    return {
+        metric: percentile(values, 0.5) for metric, values in samples.items()
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time `python main.py` from start to first connection."
+    )
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--baseline", type=Path, default=BASELINE)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store these results as the new baseline",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative change that counts as a regression",
+    )
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text())
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = Path(tmp)
+        key = paramiko.ECDSAKey.generate()
+        key_path = workdir / "id_bench"
+        key.write_private_key_file(str(key_path))
+        known_hosts_path = workdir / "known_hosts"
+
+        ready = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        fleet = multiprocessing.Process(
+            target=serve_fleet,
+            args=({"count": args.hosts, "port": args.port}, ready, stop),
+            daemon=True,
+        )
+        fleet.start()
+        try:
+            known_hosts_path.write_text(
+                "\n".join(ready.get(timeout=120)) + "\n"
+            )
+            write_agent_files(
+                workdir,
+                fleet_addresses(args.hosts),
+                args.port,
+                key_path,
+                known_hosts_path,
+                {"result_store": "", "metrics_file": None},
+            )
+            env = dict(os.environ)
+            # The commands refuse to run without one; the fake hosts
+            # ignore it
+            env.setdefault("AV_AGENT_SUDO_PASSWORD", "benchmark")
+            results = measure(workdir, env, args.runs)
+        finally:
+            stop.set()
+            fleet.join(timeout=30)
+
+    print(f"{'metric':<20} {'current':>9} {'baseline':>9}")
+    for metric in METRICS:
+        base = baseline.get(metric)
+        print(
+            f"{metric:<20} {results[metric]:>8.3f}s "
+            + (f"{base:>8.3f}s" if base else f"{'-':>9}")
+        )
+    if args.save_baseline:
+        args.baseline.write_text(json.dumps(results, indent=2) + "\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    regressions = 0
+    for metric in METRICS:
+        base = baseline.get(metric)
+        if base and (results[metric] - base) / base > args.tolerance:
+            print(
+                f"REGRESSION {metric}: {base:.3f}s -> {results[metric]:.3f}s"
+            )
+            regressions += 1
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
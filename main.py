@@ -1,39 +1,84 @@
 from modules.agent import Agent
 from modules.commander import EchoCommand
 from modules.command_update import CommandUpdate
+from modules.metrics import METRICS
+from modules.scheduler import JobScheduler
+from modules import logging_setup
+from pathlib import Path
 import logging
 import argparse
+import yaml
 
 
-def setup_logging(log_level):
+def setup_logging(log_level, json_output=False):
     """Configure logging for all modules"""
-    # Clear any existing handlers to avoid duplication
-    for handler in logging.root.handlers[:]:
-        logging.root.removeHandler(handler)
-
-    logging.basicConfig(
-        level=log_level,
-        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-        handlers=[
-            logging.FileHandler("data/agent.log"),
-            logging.StreamHandler(),
-        ],
-    )
-
-    # Ensure all existing loggers respect the new level
-    for name in logging.root.manager.loggerDict:
-        logging.getLogger(name).setLevel(log_level)
+    # The logging section is read from the local config only, since logging
+    # has to be up before the agent fetches anything
+    options = {}
+    config_file = Path("config/config.yaml")
+    if config_file.exists():
+        with open(config_file) as f:
+            options = (yaml.safe_load(f) or {}).get("logging") or {}
+    if json_output:
+        options["json_output"] = True
+    logging_setup.setup_logging(log_level, **options)
 
 
-def main():
+def main(processes=None):
     logger = logging.getLogger("Main")
     logger.info("Starting main script")
-    agent = Agent(skip_logging=True)
+    agent = Agent(skip_logging=True, processes=processes)
 
     # agent.run_ssh_command(EchoCommand("Hello, world!"))
-    agent.run_ssh_command_async(CommandUpdate())
-    # agent.run_ssh_command_async(CommandGetLogs("/var/log/nginx/access.log"))
-    agent.run_ssh_command_async(EchoCommand("Hello, world!"))
+    handles = [
+        agent.run_ssh_command_async(CommandUpdate()),
+        # agent.run_ssh_command_async(
+        #     CommandGetLogs("/var/log/nginx/access.log")
+        # ),
+        agent.run_ssh_command_async(EchoCommand("Hello, world!")),
+    ]
+    for handle in handles:
+        if handle:
+            handle.wait()
+    agent.shutdown()
+    print(METRICS.summary_table())
+
+
+def run_rolling_update(processes=None):
+    logger = logging.getLogger("Main")
+    logger.info("Starting rolling update")
+    agent = Agent(skip_logging=True, processes=processes)
+    rollout = agent.run_rolling_update()
+    try:
+        rollout.wait()
+    except KeyboardInterrupt:
+        logger.info("Stopping after the current batch")
+        rollout.stop()
+        rollout.wait()
+    agent.shutdown()
+    print(
+        f"{len(rollout.results)} hosts updated in {len(rollout.batches)} "
+        f"batches, {rollout.failures} failed, {len(rollout.skipped)} "
+        f"skipped{' (aborted)' if rollout.aborted else ''}"
+    )
+    print(METRICS.summary_table())
+
+
+def run_daemon(processes=None):
+    logger = logging.getLogger("Main")
+    logger.info("Starting agent daemon")
+    agent = Agent(skip_logging=True, processes=processes)
+    scheduler = JobScheduler.from_config(agent, agent.config)
+    if not scheduler.jobs:
+        logger.error("No jobs configured, nothing to schedule")
+        return
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        logger.info("Stopping agent daemon")
+    finally:
+        scheduler.stop()
+        agent.shutdown()
 
 
 if __name__ == "__main__":
@@ -45,10 +90,38 @@ if __name__ == "__main__":
         default="INFO",
         help="Set the logging level (e.g., DEBUG, INFO, WARNING)",
     )
+    parser.add_argument(
+        "--log-json",
+        action="store_true",
+        help="Write log records as JSON lines",
+    )
+    parser.add_argument(
+        "--rolling-update",
+        action="store_true",
+        help="Update all hosts in adaptive batches (see rolling_update)",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and execute the jobs from config.yaml on schedule",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        nargs="?",
+        const=0,
+        help="Shard hosts over this many worker processes "
+        "(without a number: one per CPU)",
+    )
     args = parser.parse_args()
 
     # Configure logging
     log_level = getattr(logging, args.log_level.upper(), logging.INFO)
-    setup_logging(log_level)
+    setup_logging(log_level, args.log_json)
 
-    main()
+    if args.daemon:
+        run_daemon(args.processes)
+    elif args.rolling_update:
+        run_rolling_update(args.processes)
+    else:
+        main(args.processes)
@@ -1,5 +1,28 @@
-from .ssh_connector import SSHConnector  # noqa: F401
-from .commander import Command  # noqa: F401
-from .agent import Agent  # noqa: F401
-from .command_update import CommandUpdate  # noqa: F401
-from .command_get_logs import CommandGetLogs  # noqa: F401
+import importlib
+
+# Public names and the submodule each lives in; imported on first access
+# so ``import modules`` does not pull in paramiko or PyGithub
+_EXPORTS = {
+    "SSHConnector": "ssh_connector",
+    "Command": "commander",
+    "Agent": "agent",
+    "CommandUpdate": "command_update",
+    "CommandGetLogs": "command_get_logs",
+    "CommandPush": "command_transfer",
+    "CommandPull": "command_transfer",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f".{module}", __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -1,29 +1,35 @@
 import logging
 from pathlib import Path
 import yaml
-from github.GithubException import GithubException
 import os
 from dotenv import load_dotenv
 from modules.ssh_connector import SSHConnector
-from modules.commander import Command
-from modules.github_client import GitHubClient
-import threading
+from modules.commander import Command, check_backend
+from modules.executor import FanOutExecutor
+from modules.result_store import ResultStore
+from modules.rolling_update import RollingUpdate
+from modules.command_update import CommandUpdate
+from modules.command_get_logs import CommandGetLogs
+from modules.log_summary import merge_results
+from modules.logging_setup import log_context, setup_logging
+from modules.metrics import METRICS
+
+# PyGithub, asyncssh and the process backend are imported where they are
+# first needed; most runs use none of them and importing them dominated
+# startup
 
 load_dotenv()
 
+# Seconds a config/hosts file fetched from GitHub is used without asking
+# GitHub whether it changed
+CONFIG_TTL = float(os.getenv("AV_AGENT_CONFIG_TTL", "300"))
+
 
 class Agent:
-    def __init__(self, skip_logging=False):
+    def __init__(self, skip_logging=False, processes=None):
         # Initialize logging only if not skipped
         if not skip_logging:
-            logging.basicConfig(
-                level=logging.INFO,
-                format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                handlers=[
-                    logging.FileHandler(Path("data/agent.log")),
-                    logging.StreamHandler(),
-                ],
-            )
+            setup_logging(logging.INFO)
         self.logger = logging.getLogger("AVAgent")
 
         # Initialize directories (or create when not exists)
@@ -33,21 +39,44 @@ class Agent:
         self._create_directories()
 
         # Load config
+        self._github_client = None
         self.config = self._load_config()
 
-        # Initialize GitHubClient
-        self.github_client = GitHubClient(
-            token=os.getenv("AV_AGENT_GITHUB_TOKEN"),
-            repository=self.config["repository"],
-        )
-        self.logger.info("Agent initialized successfully with GitHubClient")
+        # The GitHubClient is created on first use, reusing the one that
+        # fetched the config when it is for the same repository
+        if (
+            self._github_client is not None
+            and self._github_client.repository_name
+            != self.config["repository"]
+        ):
+            self._github_client = None
 
-        # Initialize SSHConnector
-        self.ssh_connector = SSHConnector(
-            self.config["hosts_file"], self.config["private_key_path"]
-        )
+        # Bound how much command output is kept in memory
+        Command.configure_output(**(self.config.get("output") or {}))
+
+        # Initialize SSHConnector with either hosts list or file path
+        self.ssh_connector = SSHConnector(**self._connector_options())
         self.logger.info("Agent initialized successfully with SSHConnector")
 
+        # Initialize the fan-out executor shared by all async runs; the
+        # processes argument overrides the config (0 = one per CPU)
+        self.processes = processes
+        self.executor = self._create_executor()
+
+        # Initialize the result store (set result_store to "" to disable)
+        self.result_store = None
+        result_store_path = self.config.get(
+            "result_store", str(self.data_dir / "results.db")
+        )
+        if result_store_path:
+            self.result_store = ResultStore(result_store_path)
+
+        # Export connect/execute timings for Prometheus
+        self.metrics_file = self.config.get("metrics_file")
+        metrics_port = self.config.get("metrics_port")
+        if metrics_port:
+            METRICS.serve(metrics_port)
+
     def _load_config(self):
         """Load config & hosts from GitHub if not found locally."""
         config_file = self.config_dir / "config.yaml"
@@ -61,7 +90,7 @@ class Agent:
                 missing_files.append("hosts.txt")
 
             self.logger.info(
-                f"No local file(s) found: {', '.join(missing_files)}"
+                "No local file(s) found: %s", ", ".join(missing_files)
             )
             self.logger.info(
                 "Attempting to fetch configuration from GitHub repository..."
@@ -69,16 +98,15 @@ class Agent:
 
             try:
                 # Initialize GitHub client with minimal config
-                self.github_client = GitHubClient(
-                    token=os.getenv("AV_AGENT_GITHUB_TOKEN"),
-                    repository="Twanus/av-agent-fw",  # Default repository
+                self._github_client = self._create_github_client(
+                    "Twanus/av-agent-fw"  # Default repository
                 )
 
                 config_data = None
                 if not config_file.exists():
                     # Fetch config from GitHub
                     config_content = self.github_client.get_file_content(
-                        "config/config.yaml"
+                        "config/config.yaml", max_age=CONFIG_TTL
                     )
                     self.logger.info(
                         "Successfully fetched config.yaml from GitHub"
@@ -88,7 +116,7 @@ class Agent:
                 if not hosts_file.exists():
                     # Fetch hosts from GitHub
                     hosts_content = self.github_client.get_file_content(
-                        "config/hosts.txt"
+                        "config/hosts.txt", max_age=CONFIG_TTL
                     )
                     self.logger.info(
                         "Successfully fetched hosts.txt from GitHub"
@@ -99,7 +127,7 @@ class Agent:
                     return config_data
 
             except Exception as e:
-                self.logger.error(f"Failed to fetch from GitHub: {str(e)}")
+                self.logger.error("Failed to fetch from GitHub: %s", e)
                 self.logger.info("Using default configuration")
                 return {
                     "github_token": "",
@@ -108,104 +136,281 @@ class Agent:
                     "enabled_modules": [],
                     "hosts_file": "config/hosts.txt",
                     "private_key_path": "C:/Users/veree/.ssh/id_jacko",
+                    "backend": "thread",
+                    "max_parallel": 32,
+                    "host_timeout": 300,
+                    "run_timeout": 1800,
+                    "pool_size": 256,
+                    "pool_max_idle": 600,
+                    "keepalive": 30,
+                    "facts_ttl": 86400,
+                    "result_store": "data/results.db",
+                    "metrics_file": "data/metrics.prom",
                 }
 
         with open(config_file) as f:
             return yaml.safe_load(f)
 
+    @property
+    def github_client(self):
+        """GitHubClient for the configured repository, made on first use."""
+        if self._github_client is None:
+            self._github_client = self._create_github_client(
+                self.config["repository"]
+            )
+        return self._github_client
+
+    def _create_github_client(self, repository):
+        from modules.github_client import DEFAULT_API_URL, GitHubClient
+
+        return GitHubClient(
+            token=os.getenv("AV_AGENT_GITHUB_TOKEN"),
+            repository=repository,
+            api_url=os.getenv("AV_AGENT_GITHUB_API_URL", DEFAULT_API_URL),
+            cache_dir=self.data_dir / "github_cache",
+        )
+
     def sync_modules(self):
-        """Synchronize modules from GitHub repository."""
+        """Synchronize modules from GitHub, writing only changed files."""
+        from github.GithubException import GithubException
+        from modules.github_client import git_blob_sha
+
         try:
-            contents = self.github_client.get_module_contents()
-            for content in contents:
-                if content.type == "file" and content.name.endswith(".py"):
-                    module_path = self.modules_dir / content.name
-                    with open(module_path, "wb") as f:
-                        f.write(content.decoded_content)
-                    self.logger.info(
-                        f"Successfully synchronized module: {content.name}"
-                    )
+            entries = self.github_client.list_directory("modules")
+            for entry in entries:
+                name = entry["name"]
+                if entry["type"] != "file" or not name.endswith(".py"):
+                    continue
+                module_path = self.modules_dir / name
+                if (
+                    module_path.exists()
+                    and git_blob_sha(module_path.read_bytes()) == entry["sha"]
+                ):
+                    self.logger.debug("Module up to date: %s", name)
+                    continue
+                content = self.github_client.get_file_bytes(entry["path"])
+                with open(module_path, "wb") as f:
+                    f.write(content)
+                self.logger.info("Successfully synchronized module: %s", name)
         except GithubException as e:
-            self.logger.error(f"Failed to sync modules: {str(e)}")
+            self.logger.error("Failed to sync modules: %s", e)
             raise
 
-    def run_ssh_command(self, command: Command):
+    def run_ssh_command(self, command: Command, tags=None, groups=None):
         """Run a command on this agent's hosts using SSHConnector."""
-        hosts = self.ssh_connector.read_hosts()
+        hosts = self.ssh_connector.read_hosts(tags, groups)
         for host in hosts:
-            client = self.ssh_connector.connect_to_host(host)
+            if not self.ssh_connector.allow_connect(host):
+                continue
+            client, session_id = self.ssh_connector.connect_to_host(host)
             if client:
-                output = self.ssh_connector.execute_command(client, command)
-                self.ssh_connector.close_connection(client)
-                self.logger.info(f"Output from {host}: {output}")
+                output = self.ssh_connector.execute_command(
+                    client, command, session_id, host
+                )
+                self.ssh_connector.close_connection(client, session_id, host)
+                self.logger.info(
+                    "Output: %s", output, extra=log_context(session_id, host)
+                )
             else:
-                self.logger.error(f"Could not connect to {host}")
+                self.logger.error(
+                    "Could not connect", extra=log_context(session_id, host)
+                )
 
-    def run_ssh_command_async(self, command):
-        """Run SSH command asynchronously using SSHConnector."""
+    def run_ssh_command_async(
+        self,
+        command,
+        spread=0,
+        tags=None,
+        groups=None,
+        hosts=None,
+        host_timeout=None,
+        run_id=None,
+    ):
+        """Fan a command out over all hosts; returns a RunHandle.
+
+        ``tags`` and ``groups`` select a subset of the inventory, ``hosts``
+        replaces it. ``host_timeout`` overrides the configured one for this
+        run. Results go to the result-store run ``run_id`` if given (the
+        caller finishes it), else to a new run. Raises ValueError if the
+        configured backend cannot run ``command``.
+        """
+        check_backend(command, self.config.get("backend", "thread"))
         try:
-            # Initialize SSHConnector with either hosts list or file path
-            if hasattr(self, "hosts"):  # If we loaded hosts from GitHub
-                ssh_connector = SSHConnector(
-                    private_key_path=self.config.get("private_key_path"),
-                    hosts_list=self.hosts,
+            self.ssh_connector.evict_idle()
+            if hosts is None:
+                hosts = self.executor.ssh_connector.read_hosts(tags, groups)
+            handle = self.executor.submit(
+                command, hosts, spread=spread, host_timeout=host_timeout
+            )
+            if self.result_store is not None:
+                if run_id is None:
+                    run_id = self.result_store.start_run(
+                        type(command).__name__, handle.total
+                    )
+                    handle.add_done_callback(
+                        lambda _: self.result_store.finish_run(run_id)
+                    )
+                handle.add_result_callback(
+                    lambda result: self.result_store.record(run_id, result)
                 )
-            else:  # Fall back to hosts file
-                ssh_connector = SSHConnector(
-                    hosts_file=self.config.get("hosts_file"),
-                    private_key_path=self.config.get("private_key_path"),
+            handle.add_result_callback(self._log_result)
+            handle.add_result_callback(
+                lambda result: METRICS.observe(
+                    "host", result.duration, result.host
                 )
+            )
+            handle.add_done_callback(
+                lambda _: self.ssh_connector.flush_host_keys()
+            )
+            handle.add_done_callback(
+                lambda _: self.executor.ssh_connector.flush_breaker()
+            )
+            handle.add_done_callback(lambda _: self.write_metrics())
+            return handle
+        except Exception as e:
+            self.logger.error("Failed to run SSH command: %s", e)
+            return None
 
-            # Create and start the thread
-            thread = threading.Thread(
-                target=self._run_ssh_command_thread,
-                args=(ssh_connector, command),
+    def run_rolling_update(self, command=None, tags=None, groups=None):
+        """Roll ``command`` (default: CommandUpdate) out in batches.
+
+        Batch sizing, backoff and abort thresholds come from the
+        ``rolling_update`` config section. Returns the started
+        RollingUpdate.
+        """
+        options = dict(self.config.get("rolling_update") or {})
+        timeout = options.pop("timeout", 120)
+        proxy = options.pop("proxy", None)
+        if command is None:
+            command = CommandUpdate(timeout=timeout, proxy=proxy)
+        # Hosts must get at least as long as the rollout allows the update
+        host_timeout = self.config.get("host_timeout")
+        if host_timeout is not None:
+            host_timeout = max(host_timeout, timeout)
+        hosts = self.executor.ssh_connector.read_hosts(tags, groups)
+        rollout = RollingUpdate(
+            self, command, hosts, host_timeout=host_timeout, **options
+        )
+        if self.result_store is not None:
+            # One run for the whole rollout, so `failed` sees every batch
+            rollout.run_id = self.result_store.start_run(
+                type(command).__name__, len(rollout.hosts)
+            )
+            rollout.add_done_callback(
+                lambda r: self.result_store.finish_run(r.run_id)
             )
-            thread.start()
-            return thread
+        return rollout.start()
 
-        except Exception as e:
-            self.logger.error(f"Failed to run SSH command: {e}")
+    def aggregate_logs(self, log_path, tags=None, groups=None, **options):
+        """Summarise an access log on every host and merge the summaries.
+
+        ``options`` go to ``CommandGetLogs`` (e.g. ``top_k``,
+        ``incremental``). Returns the fleet-wide ``LogSummary``, or None if
+        the run could not start; the asyncio backend cannot run it and
+        raises ValueError.
+        """
+        command = CommandGetLogs(log_path, aggregate=True, **options)
+        handle = self.run_ssh_command_async(command, tags=tags, groups=groups)
+        if handle is None:
             return None
+        return merge_results(
+            handle.results(), command.top_k, command.bucket_seconds
+        )
 
-    def _execute_on_host(self, host, command: Command):
-        """Helper method to execute a command on a single host."""
-        client = self.ssh_connector.connect_to_host(host)
-        if client:
-            output = self.ssh_connector.execute_command(client, command)
-            self.ssh_connector.close_connection(client)
-            return output
-        else:
-            raise ConnectionError(f"Could not connect to {host}")
+    def shutdown(self):
+        """Wait for in-flight runs, stop the executor and close the pool."""
+        self.executor.shutdown(wait=True)
+        self.ssh_connector.shutdown()
+        if self.result_store is not None:
+            self.result_store.close()
+        self.write_metrics()
+        METRICS.stop_serving()
+
+    def write_metrics(self):
+        """Write the Prometheus text file, if ``metrics_file`` is set."""
+        if not self.metrics_file:
+            return
+        try:
+            METRICS.write(self.metrics_file)
+        except OSError as e:
+            self.logger.error("Failed to write metrics: %s", e)
+
+    def _create_executor(self):
+        """Build the executor for the configured ``backend``/``processes``."""
+        backend = self.config.get("backend", "thread")
+        if backend not in ("thread", "asyncio"):
+            raise ValueError(f"Unknown execution backend: {backend}")
+        options = {
+            "max_parallel": self.config.get("max_parallel", 32),
+            "host_timeout": self.config.get("host_timeout"),
+            "run_timeout": self.config.get("run_timeout"),
+        }
+        processes = self.processes
+        if processes is None:
+            processes = self.config.get("processes", 1)
+        if processes != 1:
+            from modules.process_executor import ProcessFanOutExecutor
+
+            return ProcessFanOutExecutor(
+                self.ssh_connector,
+                self._connector_options(),
+                processes=processes,
+                backend=backend,
+                **options,
+            )
+        if backend == "thread":
+            return FanOutExecutor(self.ssh_connector, **options)
+        from modules.async_ssh_connector import (
+            AsyncFanOutExecutor,
+            AsyncSSHConnector,
+        )
+
+        connector = AsyncSSHConnector(**self._connector_options())
+        self.logger.info("Using asyncio execution backend")
+        return AsyncFanOutExecutor(connector, **options)
+
+    def _connector_options(self):
+        """SSHConnector settings from the config."""
+        return {
+            "hosts_file": self.config.get("hosts_file"),
+            "private_key_path": self.config.get("private_key_path"),
+            "hosts_list": getattr(self, "hosts", None),
+            "pool_size": self.config.get("pool_size", 256),
+            "pool_max_idle": self.config.get("pool_max_idle", 600),
+            "keepalive": self.config.get("keepalive", 30),
+            "facts_ttl": self.config.get("facts_ttl", 86400),
+            "port": self.config.get("ssh_port", 22),
+            "known_hosts_file": self.config.get("known_hosts_file"),
+            "inventory": self.config.get("inventory"),
+            "connect_timeout": self.config.get("connect_timeout", 10),
+            "banner_timeout": self.config.get("banner_timeout", 15),
+            "auth_timeout": self.config.get("auth_timeout", 15),
+            "connect_retries": self.config.get("connect_retries", 2),
+            "retry_backoff": self.config.get("retry_backoff", 1.0),
+            "breaker_threshold": self.config.get("breaker_threshold", 3),
+            "breaker_cooldown": self.config.get("breaker_cooldown", 900),
+            "jump_host": self.config.get("jump_host"),
+            "jump_max_channels": self.config.get("jump_max_channels", 32),
+        }
 
     def _create_directories(self):
         """Ensure all required directories exist."""
         for directory in [self.config_dir, self.data_dir, self.modules_dir]:
             directory.mkdir(exist_ok=True)
 
-    def _run_ssh_command_thread(self, ssh_connector, command):
-        """Helper method to run SSH command in a thread."""
-        try:
-            hosts = ssh_connector.read_hosts()
-            self.logger.debug(
-                f"Running command '{command}' on {len(hosts)} hosts"
+    def _log_result(self, result):
+        """Log a single host result as it comes in."""
+        if result.exit_status == 0:
+            self.logger.info(
+                "OUTPUT (%.2fs):\n%s",
+                result.duration,
+                result.stdout,
+                extra=log_context(host=result.host),
+            )
+        else:
+            self.logger.error(
+                "FAILED (%.2fs): %s",
+                result.duration,
+                result.stderr,
+                extra=log_context(host=result.host),
             )
-
-            for host in hosts:
-                client, session_id = ssh_connector.connect_to_host(host)
-                if client:
-                    output = ssh_connector.execute_command(
-                        client, command, session_id, host
-                    )
-                    ssh_connector.close_connection(client, session_id, host)
-                    if output:
-                        self.logger.info(
-                            f"[{session_id}][{host}] OUTPUT:\n{output}"
-                        )
-                else:
-                    self.logger.error(
-                        f"[{session_id}][{host}] Connection failed"
-                    )
-
-        except Exception as e:
-            self.logger.error(f"Error in SSH command thread: {str(e)}")
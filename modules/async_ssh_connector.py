@@ -0,0 +1,512 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.bastion import parse_jump
+from modules.circuit_breaker import backoff_delay
+from modules.commander import Command, check_backend, read_process
+from modules.executor import (
+    HostResult,
+    RunHandle,
+    run_limits,
+    start_delays,
+    to_host_result,
+)
+from modules.logging_setup import log_context
+from modules.metrics import METRICS
+from modules.ssh_connector import SSHConnector, record_output
+
+try:
+    import asyncssh
+except ImportError:  # optional dependency, only needed for this backend
+    asyncssh = None
+
+CompletedProcess = namedtuple(
+    "CompletedProcess", ["exit_status", "stdout", "stderr"]
+)
+
+
+class AsyncConnection:
+    """An asyncssh connection bound to the host and loop it belongs to."""
+
+    def __init__(self, conn, host, session_id, loop, facts=None):
+        self.conn = conn
+        self.host = host
+        self.session_id = session_id
+        self.loop = loop
+        # The connector's HostFactsCache, shared by commands on this host
+        self.facts = facts
+        # [connection, users] of the bastion it was opened through
+        self.bastion = None
+
+    async def run(self, command, input=None, timeout=None):
+        """Run ``command`` and return its ``CompletedProcess``.
+
+        ``input`` is written to its stdin, which is then closed, so a
+        command reading stdin does not wait for more. The command is
+        closed and TimeoutError raised once it has sent nothing for
+        ``timeout`` seconds.
+        """
+        process = await self.start(command)
+        stdout = bytearray()
+        stderr = bytearray()
+        try:
+            if input:
+                process.stdin.write(input.encode())
+            process.stdin.write_eof()
+            await read_process(process, stdout.extend, stderr.extend, timeout)
+        finally:
+            process.close()
+        return CompletedProcess(
+            process.exit_status,
+            stdout.decode(errors="replace"),
+            stderr.decode(errors="replace"),
+        )
+
+    async def start(self, command):
+        """Start ``command`` and return its process, with bytes streams."""
+        return await self.conn.create_process(command, encoding=None)
+
+    def blocking(self):
+        """Return a paramiko-style client usable from a worker thread."""
+        return BlockingClient(self)
+
+    def close(self):
+        """Close the connection; safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self.conn.close)
+
+
+class BlockingClient:
+    """Minimal ``paramiko.SSHClient`` stand-in backed by an AsyncConnection.
+
+    Lets the existing thread-based ``Command.execute`` implementations run
+    unchanged on the asyncio backend. The remote command is started on the
+    event loop the first time its output or exit status is requested, with
+    anything written to stdin before that sent as its input and stdin then
+    closed. Output is only available once the command has finished; there
+    is no ``recv()`` for streaming it.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        # Like the paramiko clients SSHConnector hands out
+        self.av_host = conn.host
+        self.av_facts = conn.facts
+
+    def exec_command(self, command, timeout=None):
+        process = _RemoteProcess(self.conn, command, timeout)
+        return process.stdin, process.stdout, process.stderr
+
+    def close(self):
+        self.conn.close()
+
+
+class _RemoteProcess:
+    def __init__(self, conn, command, timeout):
+        self.conn = conn
+        self.command = command
+        self.timeout = timeout
+        self.result = None
+        self.input = []
+        self.lock = threading.Lock()
+        self.stdin = _Stdin(self)
+        self.stdout = _Stream(self, "stdout")
+        self.stderr = _Stream(self, "stderr")
+        self.channel = self.stdout.channel
+
+    def wait(self):
+        with self.lock:
+            if self.result is None:
+                future = asyncio.run_coroutine_threadsafe(
+                    self.conn.run(
+                        self.command,
+                        input="".join(self.input) or None,
+                        timeout=self.timeout,
+                    ),
+                    self.conn.loop,
+                )
+                self.result = future.result()
+                self.stdin.closed = True
+            return self.result
+
+
+class _Stdin:
+    def __init__(self, process):
+        self.process = process
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise OSError("stdin is closed")
+        if isinstance(data, bytes):
+            data = data.decode()
+        self.process.input.append(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        # Nothing is sent before the command starts; it then gets the input
+        # written so far followed by EOF
+        self.closed = True
+
+
+class _Stream:
+    def __init__(self, process, name):
+        self.process = process
+        self.name = name
+        self.channel = _Channel(process)
+
+    def read(self):
+        return (getattr(self.process.wait(), self.name) or "").encode()
+
+
+class _Channel:
+    def __init__(self, process):
+        self.process = process
+
+    def recv_exit_status(self):
+        return self.process.wait().exit_status
+
+
+class AsyncSSHConnector(SSHConnector):
+    """SSHConnector counterpart that drives hosts from one event loop."""
+
+    def __init__(
+        self, hosts_file=None, private_key_path=None, hosts_list=None, **kw
+    ):
+        if asyncssh is None:
+            raise RuntimeError(
+                "The asyncio backend requires the 'asyncssh' package"
+            )
+        # Pooling is SSHConnector's; the other settings are shared
+        kw.pop("pool_size", None)
+        super().__init__(
+            hosts_file=hosts_file,
+            private_key_path=private_key_path,
+            hosts_list=hosts_list,
+            **kw,
+        )
+        self._client_keys = {}
+        self._known_hosts = None
+        # Bastion name -> [connection, hosts using it]
+        self._bastions = {}
+        self._bastion_locks = {}
+
+    async def connect(self, host):
+        """Return ``(AsyncConnection, session_id)`` for ``host``."""
+        session_id = str(uuid.uuid4())[:8]
+        attempt = 0
+        with METRICS.timer("connect", host):
+            while True:
+                conn, transient = await self._try_connect(host, session_id)
+                if conn is not None:
+                    self.breaker.record_success(host)
+                    return conn, session_id
+                if not transient or attempt >= self.connect_retries:
+                    break
+                delay = backoff_delay(attempt, self.retry_backoff)
+                attempt += 1
+                self.logger.info(
+                    "Retrying connection in %.1fs (attempt %d of %d)",
+                    delay,
+                    attempt,
+                    self.connect_retries,
+                    extra=log_context(session_id, host),
+                )
+                METRICS.inc("connect_retries", host=host)
+                await asyncio.sleep(delay)
+        METRICS.inc("connect_failures", host=host)
+        self.breaker.record_failure(host)
+        return None, session_id
+
+    async def _try_connect(self, host, session_id):
+        """Return ``(AsyncConnection, transient)`` like _try_open_client."""
+        try:
+            self._load_credentials()
+            self.logger.debug(
+                "Attempting SSH connection",
+                extra=log_context(session_id, host),
+            )
+            jump = self._jump(host)
+            bastion = None
+            if jump:
+                bastion = await self._acquire_bastion(jump, session_id)
+            try:
+                conn = await asyncssh.connect(
+                    str(host),
+                    port=self._port(host),
+                    tunnel=bastion[0] if bastion else (),
+                    username=self._username(host),
+                    client_keys=self._client_keys_for(host),
+                    known_hosts=self._known_hosts,
+                    agent_path=None,
+                    connect_timeout=self.connect_timeout
+                    + self.banner_timeout,
+                    login_timeout=self.auth_timeout,
+                )
+            except BaseException:
+                if bastion:
+                    bastion[1] -= 1
+                raise
+            self.logger.info(
+                "Connected successfully", extra=log_context(session_id, host)
+            )
+            loop = asyncio.get_running_loop()
+            connection = AsyncConnection(
+                conn, host, session_id, loop, self.facts
+            )
+            connection.bastion = bastion
+            return connection, False
+        except socket.gaierror as e:
+            transient = False
+            self.logger.error(
+                "Could not resolve host: %s",
+                e,
+                extra=log_context(session_id, host),
+            )
+        except (OSError, asyncio.TimeoutError, asyncssh.ConnectionLost) as e:
+            transient = True
+            self.logger.error(
+                "Connection failed: %s", e, extra=log_context(session_id, host)
+            )
+        except asyncssh.Error as e:
+            transient = False
+            self.logger.error(
+                "Connection failed: %s", e, extra=log_context(session_id, host)
+            )
+        except Exception as e:
+            # e.g. an unreadable private key (KeyImportError)
+            transient = False
+            self.logger.error(
+                "Connection failed: %s", e, extra=log_context(session_id, host)
+            )
+        return None, transient
+
+    async def execute(self, conn, command: Command, session_id, host):
+        context = log_context(session_id, host)
+        if conn is None:
+            self.logger.error("SSH client is None", extra=context)
+            return None
+        try:
+            self.logger.debug("Executing command", extra=context)
+            with METRICS.timer("execute", host):
+                output = await command.execute_async(conn)
+            record_output(output, host)
+            return output
+        except Exception as e:
+            self.logger.error("Command failed: %s", e, extra=context)
+            METRICS.inc("command_failures", host=host)
+            return None
+
+    async def close(self, conn, session_id, host):
+        if conn:
+            with METRICS.timer("close", host):
+                conn.conn.close()
+                await conn.conn.wait_closed()
+                await self._release_bastion(conn.bastion)
+            self.logger.info(
+                "Connection closed", extra=log_context(session_id, host)
+            )
+
+    async def _acquire_bastion(self, jump, session_id):
+        """A ``[connection, users]`` entry for ``jump`` with a free slot.
+
+        Like ``BastionPool`` for the thread backend: hosts share bastion
+        connections up to ``max_channels`` each, and another connection
+        is opened when all are full.
+        """
+        lock = self._bastion_locks.setdefault(jump, asyncio.Lock())
+        async with lock:
+            entries = self._bastions.setdefault(jump, [])
+            entries[:] = [e for e in entries if not e[0].is_closed()]
+            free = [e for e in entries if e[1] < self.bastions.max_channels]
+            if free:
+                entry = min(free, key=lambda e: e[1])
+            else:
+                bastion = parse_jump(jump)
+                conn, _ = await self._try_connect(bastion, session_id)
+                if conn is None:
+                    raise OSError(f"Could not connect to bastion {jump}")
+                entry = [conn.conn, 0]
+                entries.append(entry)
+                METRICS.inc("bastion_connections")
+            entry[1] += 1
+            return entry
+
+    async def _release_bastion(self, entry):
+        """Drop a host from a bastion, closing it when no host is left."""
+        if not entry:
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            for entries in self._bastions.values():
+                if entry in entries:
+                    entries.remove(entry)
+            entry[0].close()
+            await entry[0].wait_closed()
+
+    def _client_keys_for(self, host):
+        # asyncssh keeps its own key objects; parse each key file once
+        path = self._key_path(host)
+        if path not in self._client_keys:
+            self._client_keys[path] = [asyncssh.read_private_key(path)]
+        return self._client_keys[path]
+
+    def _load_credentials(self):
+        if self._known_hosts is None:
+            if os.path.exists(self.known_hosts_file):
+                self._known_hosts = asyncssh.read_known_hosts(
+                    self.known_hosts_file
+                )
+            else:
+                self._known_hosts = asyncssh.import_known_hosts("")
+
+
+class AsyncFanOutExecutor:
+    """FanOutExecutor counterpart running every host on one event loop.
+
+    The loop lives in a background thread so ``submit()`` returns the same
+    ``RunHandle`` as the thread backend. ``max_parallel`` bounds the number
+    of live sessions; ``offload_workers`` bounds the threads used by
+    commands that have no native ``execute_async``.
+    """
+
+    def __init__(
+        self,
+        ssh_connector,
+        max_parallel=1000,
+        host_timeout=None,
+        run_timeout=None,
+        offload_workers=64,
+    ):
+        self.ssh_connector = ssh_connector
+        self.max_parallel = max_parallel
+        self.host_timeout = host_timeout
+        self.run_timeout = run_timeout
+        self.logger = logging.getLogger("AsyncFanOutExecutor")
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(
+            ThreadPoolExecutor(
+                max_workers=offload_workers, thread_name_prefix="offload"
+            )
+        )
+        self._semaphore = None
+        self._runs = set()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="asyncio-backend", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, command, hosts=None, spread=0, host_timeout=None):
+        """Start ``command`` on every host and return a ``RunHandle``."""
+        check_backend(command, "asyncio")
+        if hosts is None:
+            hosts = self.ssh_connector.read_hosts()
+        handle = RunHandle(hosts, *run_limits(self, host_timeout))
+        self.logger.debug(
+            "Running command '%s' on %d hosts (max_parallel=%d)",
+            command,
+            handle.total,
+            self.max_parallel,
+        )
+        future = asyncio.run_coroutine_threadsafe(
+            self._run(handle, command, spread), self._loop
+        )
+        self._runs.add(future)
+        future.add_done_callback(self._runs.discard)
+        return handle
+
+    def shutdown(self, wait=True):
+        if wait:
+            for future in list(self._runs):
+                future.result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    async def _run(self, handle, command, spread):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_parallel)
+        # Like the thread backend, a few workers pull hosts as they go
+        # rather than one coroutine per host
+        starts = zip(handle.hosts, start_delays(handle.total, spread))
+        await asyncio.gather(
+            *(
+                self._drain(handle, command, starts)
+                for _ in range(min(self.max_parallel, handle.total))
+            )
+        )
+
+    async def _drain(self, handle, command, starts):
+        # All on the loop thread, so the workers can share the iterator
+        for host, delay in starts:
+            if handle.expired:
+                return
+            await self._run_host(handle, host, command, delay)
+
+    async def _run_host(self, handle, host, command, delay=0):
+        wait = handle.started + delay - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        async with self._semaphore:
+            if handle.expired:
+                return
+            start = time.monotonic()
+            result = None
+            try:
+                result = await asyncio.wait_for(
+                    self._execute_on_host(handle, host, command, start),
+                    handle.host_timeout,
+                )
+            except asyncio.TimeoutError:
+                self.logger.warning(
+                    "Host deadline exceeded", extra=log_context(host=host)
+                )
+                result = HostResult(
+                    host,
+                    None,
+                    "",
+                    "host deadline exceeded",
+                    time.monotonic() - start,
+                )
+            except Exception as e:
+                self.logger.exception(
+                    "Running on host failed", extra=log_context(host=host)
+                )
+                result = HostResult(
+                    host, None, "", str(e), time.monotonic() - start
+                )
+            finally:
+                # Every host reports, or the run would hang until its
+                # deadline
+                if result is None:
+                    result = HostResult(
+                        host, None, "", "cancelled", time.monotonic() - start
+                    )
+                handle._set_result(result)
+
+    async def _execute_on_host(self, handle, host, command, start):
+        connector = self.ssh_connector
+        if not connector.allow_connect(host):
+            return HostResult(
+                host, None, "", "circuit open, host skipped", 0.0
+            )
+        conn, session_id = await connector.connect(host)
+        if conn is None:
+            return HostResult(
+                host, None, "", "connection failed", time.monotonic() - start
+            )
+        try:
+            handle._track(host, conn.close)
+            output = await connector.execute(conn, command, session_id, host)
+        finally:
+            handle._track(host, None)
+            await connector.close(conn, session_id, host)
+        return to_host_result(host, output, time.monotonic() - start)
@@ -0,0 +1,172 @@
+import logging
+import re
+import threading
+import time
+
+from modules.inventory import Host
+from modules.logging_setup import log_context
+from modules.metrics import METRICS
+
+logger = logging.getLogger("BastionPool")
+
+JUMP = re.compile(r"(?:(.+)@)?(?:\[([^\]]+)\]|([^:@]+))(?::(\d+))?")
+
+
+def parse_jump(spec):
+    """Return the ``Host`` for a ``[user@]host[:port]`` jump setting.
+
+    The bastion itself is always reached directly (its ``jump`` is "").
+    """
+    match = JUMP.fullmatch(str(spec).strip())
+    if match is None:
+        raise ValueError(f"Invalid jump host: {spec!r}")
+    user, bracketed, name, port = match.groups()
+    return Host(
+        bracketed or name,
+        user=user,
+        port=int(port) if port else None,
+        jump="",
+    )
+
+
+class _Bastion:
+    def __init__(self, client):
+        self.client = client
+        self.channels = []
+        # Slots handed out whose channel is still being opened
+        self.pending = 0
+        self.last_used = time.monotonic()
+
+    def alive(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def load(self):
+        self.channels = [c for c in self.channels if not c.closed]
+        return len(self.channels) + self.pending
+
+
+class BastionPool:
+    """Authenticated transports to bastion hosts, shared by their hosts.
+
+    Each host behind a bastion gets a ``direct-tcpip`` channel on a
+    transport to it, so a bastion handshake happens once rather than per
+    host. A transport carries at most ``max_channels`` channels; when all
+    are full another one is opened, and new channels go to the least
+    loaded. Transports without channels are closed after ``max_idle``
+    seconds. After a failed bastion connect, its hosts fail at once for
+    ``retry_after`` seconds instead of each waiting for a timeout.
+    """
+
+    def __init__(
+        self,
+        connect,
+        max_channels=32,
+        max_idle=600,
+        keepalive=30,
+        retry_after=30,
+    ):
+        self._connect = connect
+        self.max_channels = max_channels
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self.retry_after = retry_after
+        self._bastions = {}
+        self._locks = {}
+        self._failed = {}
+        self._lock = threading.Lock()
+
+    def open_channel(self, jump, host, port, session_id, timeout=None):
+        """Open a channel to ``host:port`` through the ``jump`` bastion."""
+        name = str(jump)
+        bastion = self._reserve(name, session_id)
+        try:
+            channel = bastion.client.get_transport().open_channel(
+                "direct-tcpip",
+                (str(host), port),
+                ("127.0.0.1", 0),
+                timeout=timeout,
+            )
+        except BaseException:
+            with self._lock:
+                bastion.pending -= 1
+            raise
+        with self._lock:
+            bastion.pending -= 1
+            bastion.channels.append(channel)
+            bastion.last_used = time.monotonic()
+        return channel
+
+    def evict_idle(self):
+        """Close bastion transports that have had no channels for a while."""
+        now = time.monotonic()
+        closing = []
+        with self._lock:
+            for name, bastions in self._bastions.items():
+                for bastion in list(bastions):
+                    if bastion.load() == 0 and (
+                        not bastion.alive()
+                        or now - bastion.last_used > self.max_idle
+                    ):
+                        bastions.remove(bastion)
+                        closing.append(bastion)
+        for bastion in closing:
+            bastion.client.close()
+
+    def close_all(self):
+        with self._lock:
+            bastions = [b for bs in self._bastions.values() for b in bs]
+            self._bastions.clear()
+        for bastion in bastions:
+            bastion.client.close()
+
+    def _reserve(self, name, session_id):
+        """Take a channel slot on a bastion transport, opening if needed."""
+        with self._lock:
+            lock = self._locks.setdefault(name, threading.Lock())
+        # One caller opens a new transport while the others wait for it
+        with lock:
+            bastion = self._least_loaded(name)
+            if bastion is not None:
+                return bastion
+            failed = self._failed.get(name)
+            if failed is not None and time.monotonic() - failed < (
+                self.retry_after
+            ):
+                raise OSError(f"Bastion {name} is unreachable")
+            client = self._connect(parse_jump(name), session_id)
+            if client is None:
+                self._failed[name] = time.monotonic()
+                raise OSError(f"Could not connect to bastion {name}")
+            self._failed.pop(name, None)
+            if self.keepalive:
+                client.get_transport().set_keepalive(self.keepalive)
+            bastion = _Bastion(client)
+            bastion.pending = 1
+            with self._lock:
+                bastions = self._bastions.setdefault(name, [])
+                bastions.append(bastion)
+                count = len(bastions)
+            METRICS.inc("bastion_connections")
+            logger.info(
+                "Opened bastion connection %d to %s",
+                count,
+                name,
+                extra=log_context(session_id, name),
+            )
+            return bastion
+
+    def _least_loaded(self, name):
+        with self._lock:
+            # Dead transports are dropped by evict_idle()
+            candidates = [
+                (bastion.load(), index, bastion)
+                for index, bastion in enumerate(self._bastions.get(name, []))
+                if bastion.alive()
+            ]
+            candidates = [c for c in candidates if c[0] < self.max_channels]
+            if not candidates:
+                return None
+            _, _, bastion = min(candidates)
+            bastion.pending += 1
+            return bastion
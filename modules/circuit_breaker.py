@@ -0,0 +1,116 @@
+import json
+import logging
+import random
+import threading
+import time
+from pathlib import Path
+
+from modules.state_file import update_json
+
+logger = logging.getLogger("CircuitBreaker")
+
+
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """Exponential backoff with full jitter for retry number ``attempt``."""
+    return random.uniform(0, min(cap, base * 2**attempt))  # nosec B311
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker, persisted under ``data/``.
+
+    After ``failure_threshold`` consecutive connection failures a host's
+    circuit opens and it is skipped for ``cooldown`` seconds. After that a
+    single probe is let through: success closes the circuit, failure opens
+    it for another cooldown. State changes are kept in memory and written
+    by ``flush()``, so a run with many dead hosts writes the file once;
+    only the hosts that changed are merged into it.
+    """
+
+    def __init__(
+        self,
+        path="data/circuit_breaker.json",
+        failure_threshold=3,
+        cooldown=900,
+    ):
+        self.path = Path(path)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._hosts = None
+        self._probing = set()
+        self._changed = set()
+
+    def allow(self, host):
+        """Whether a connection attempt to ``host`` should be made."""
+        host = str(host)
+        with self._lock:
+            entry = self._load().get(host)
+            if entry is None or entry.get("opened_at") is None:
+                return True
+            if time.time() - entry["opened_at"] < self.cooldown:
+                return False
+            # Half open: let one caller probe the host
+            if host in self._probing:
+                return False
+            self._probing.add(host)
+            return True
+
+    def is_open(self, host):
+        with self._lock:
+            entry = self._load().get(str(host))
+        return entry is not None and entry.get("opened_at") is not None
+
+    def record_success(self, host):
+        host = str(host)
+        with self._lock:
+            self._probing.discard(host)
+            if self._load().pop(host, None) is not None:
+                self._changed.add(host)
+
+    def record_failure(self, host):
+        host = str(host)
+        with self._lock:
+            probing = host in self._probing
+            self._probing.discard(host)
+            entry = self._load().setdefault(
+                host, {"failures": 0, "opened_at": None}
+            )
+            entry["failures"] += 1
+            if probing or entry["failures"] >= self.failure_threshold:
+                if entry["opened_at"] is None or probing:
+                    logger.warning(
+                        "Opening circuit for %s after %d failures, "
+                        "skipping it for %ss",
+                        host,
+                        entry["failures"],
+                        self.cooldown,
+                    )
+                entry["opened_at"] = time.time()
+            self._changed.add(host)
+
+    def reset(self, host=None):
+        """Close the circuit of ``host``, or of every host."""
+        with self._lock:
+            if host is None:
+                self._changed.update(self._load())
+                self._hosts = {}
+            else:
+                self._load().pop(str(host), None)
+                self._changed.add(str(host))
+
+    def flush(self):
+        """Persist state changes since the last flush."""
+        with self._lock:
+            if not self._changed:
+                return
+            self._hosts = update_json(self.path, self._hosts, self._changed)
+            self._changed.clear()
+
+    def _load(self):
+        if self._hosts is None:
+            try:
+                with open(self.path) as f:
+                    self._hosts = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._hosts = {}
+        return self._hosts
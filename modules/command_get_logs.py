@@ -1,31 +1,406 @@
-from modules.commander import Command
+from modules.commander import Command, CommandResult, OutputCapture, host_of
+from modules.logging_setup import log_context
+from modules.log_summary import LogSummary
+from modules import log_summary
+from modules.state_file import update_json
 from dotenv import load_dotenv
+from pathlib import Path
+import json
+import logging
 import os
+import re
+import shlex
+import socket
+import threading
+import zlib
 
 load_dotenv()
 
 sudo_password = os.getenv("AV_AGENT_SUDO_PASSWORD")
+logger = logging.getLogger("CommandGetLogs")
+
+CHUNK_SIZE = 64 * 1024
+MAX_STDERR = 64 * 1024
+
+# The summariser runs on the hosts from its own source
+SUMMARY_SCRIPT = Path(log_summary.__file__).read_text()
+
+
+class LogCheckpointStore:
+    """Per host and log path: inode, size and byte offset already fetched.
+
+    Kept in memory and persisted to a JSON file under ``data/`` after every
+    update so the next run only asks for bytes it has not seen.
+    """
+
+    def __init__(self, path="data/log_checkpoints.json"):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._checkpoints = None
+
+    def get(self, host, log_path):
+        """Return ``{"inode", "size", "offset"}`` or None if never fetched."""
+        with self._lock:
+            checkpoint = self._load().get(host, {}).get(log_path)
+            return dict(checkpoint) if checkpoint else None
+
+    def set(self, host, log_path, inode, size, offset):
+        with self._lock:
+            self._load().setdefault(host, {})[log_path] = {
+                "inode": inode,
+                "size": size,
+                "offset": offset,
+            }
+            self._save(host)
+
+    def _load(self):
+        if self._checkpoints is None:
+            try:
+                with open(self.path) as f:
+                    self._checkpoints = json.load(f)
+            except FileNotFoundError:
+                self._checkpoints = {}
+        return self._checkpoints
+
+    def _save(self, host):
+        self._checkpoints = update_json(self.path, self._checkpoints, [host])
+
+    def __getstate__(self):
+        # Sent to worker processes as just the path; each loads its own
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+
+class FileSink:
+    """Writes streamed log chunks to ``<directory>/<host>/<log name>``."""
+
+    def __init__(self, directory="data/logs"):
+        self.directory = Path(directory)
+
+    def open(self, host, log_path, append=False):
+        safe_host = re.sub(r"[^\w.-]", "_", str(host))
+        target = self.directory / safe_host / Path(log_path).name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        return open(target, "ab" if append else "wb")
 
 
 class CommandGetLogs(Command):
-    def __init__(self, log_path):
+    def __init__(
+        self,
+        log_path,
+        stream=False,
+        compress=False,
+        incremental=False,
+        sink=None,
+        checkpoints=None,
+        aggregate=False,
+        top_k=100,
+        bucket_seconds=60,
+        timeout=120,
+    ):
         self.log_path = log_path
+        self.stream = stream
+        self.compress = compress
+        self.incremental = incremental
+        self.aggregate = aggregate
+        self.top_k = top_k
+        self.bucket_seconds = bucket_seconds
+        # Seconds the host may send nothing before the fetch is given up
+        self.timeout = timeout
+        self.sink = sink or FileSink()
+        self.checkpoints = checkpoints or LogCheckpointStore()
 
     def execute(self, client):
+        if self.aggregate:
+            return self._execute_aggregate(client)
+        if self.stream:
+            return self._execute_streaming(client)
+        if self.incremental:
+            return self._execute_incremental(client)
+
         command = f"echo {sudo_password} | sudo -S cat {self.log_path}"
         try:
-            stdin, stdout, stderr = client.exec_command(command)
-            stdin.write(sudo_password + "\n")
-            stdin.flush()
-            output = stdout.read().decode()
-            error_output = stderr.read().decode()
-
-            if stdout.channel.recv_exit_status() == 0:
-                return output
-            else:
-                print(f"Error retrieving logs: {error_output}")
-                return None
+            result = self.capture(
+                client, command, input=sudo_password + "\n"
+            )
+            if result.exit_status != 0:
+                logger.error("Error retrieving logs: %s", result.stderr)
+            return result
 
         except Exception as e:
-            print(f"Command execution failed: {e}")
+            logger.error("Command execution failed: %s", e)
             return None
+
+    def needs_thread_backend(self):
+        # The asyncio backend's blocking client cannot read a channel
+        # while the command runs, which these modes rely on
+        return self.stream or self.incremental or self.aggregate
+
+    def script(self, client):
+        if self.stream or self.incremental or self.aggregate:
+            return None
+        return f"echo {sudo_password} | sudo -S cat {self.log_path}"
+
+    def open_stream(self, client, checkpoint=None):
+        """Start reading the log after ``checkpoint`` in one round-trip.
+
+        Returns ``((inode, size, offset), chunks)`` where ``offset`` is where
+        the transfer actually starts: the checkpoint's offset, or 0 when the
+        file was rotated (different inode, or smaller than the offset).
+        ``chunks`` yields the bytes from there on and raises
+        ``RuntimeError`` after the last chunk if the remote command failed.
+        """
+        pipe = " | gzip -c" if self.compress else ""
+        fields, channel, stderr, rest = self._open(client, checkpoint, pipe)
+        return (
+            tuple(fields[:3]),
+            self._chunks(channel, stderr, rest, self.compress),
+        )
+
+    def open_summary(self, client, checkpoint=None):
+        """Like ``open_stream()``, but summarised on the host if possible.
+
+        Returns ``((inode, size, offset), remote, chunks)``. When the host
+        has python3, ``remote`` is True and ``chunks`` yields the JSON of a
+        ``LogSummary``; otherwise it yields the log itself.
+        """
+        raw = "gzip -c" if self.compress else "cat"
+        pipe = (
+            ' | if [ -n "$py" ]; then '
+            f'"$py" -c {shlex.quote(SUMMARY_SCRIPT)} '
+            f"{int(self.top_k)} {int(self.bucket_seconds)}; "
+            f"else {raw}; fi"
+        )
+        fields, channel, stderr, rest = self._open(
+            client,
+            checkpoint,
+            pipe,
+            prefix="py=$(command -v python3); ",
+            mode=" ${py:+remote}",
+        )
+        remote = fields[3:] == ["remote"]
+        # The summary itself is sent uncompressed
+        compressed = self.compress and not remote
+        return (
+            tuple(fields[:3]),
+            remote,
+            self._chunks(channel, stderr, rest, compressed),
+        )
+
+    def _open(self, client, checkpoint, pipe, prefix="", mode=""):
+        """Run the stat + tail command; return its header and channel.
+
+        The header line is ``inode size offset`` followed by ``mode``.
+        """
+        checkpoint = checkpoint or {}
+        sudo = f"echo {sudo_password} | sudo -S"
+        command = (
+            f"{prefix}f={shlex.quote(self.log_path)}; "
+            f"out=$({sudo} stat -c '%i %s' \"$f\") || exit 1; "
+            "set -- $out; "
+            f"off={int(checkpoint.get('offset', 0))}; "
+            f"if [ \"$1\" != \"{checkpoint.get('inode', '')}\" ] "
+            '|| [ "$2" -lt "$off" ]; then off=0; fi; '
+            f'echo "$1 $2 $off{mode}"; '
+            f'{sudo} tail -c +$((off + 1)) "$f"{pipe}'
+        )
+        stdin, stdout, stderr = client.exec_command(command)
+        stdin.write(sudo_password + "\n")
+        stdin.flush()
+
+        channel = stdout.channel
+        channel.settimeout(self.timeout)
+        header = bytearray()
+        while b"\n" not in header:
+            data = self._recv(channel)
+            if not data:
+                error_output = stderr.read().decode(errors="replace")
+                raise RuntimeError(
+                    f"Reading {self.log_path} failed: {error_output}"
+                )
+            header += data
+        line, _, rest = bytes(header).partition(b"\n")
+        inode, size, offset, *fields = line.decode().split()
+        return (
+            [inode, int(size), int(offset)] + fields,
+            channel,
+            stderr,
+            rest,
+        )
+
+    def _chunks(self, channel, stderr, first, compressed):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        error_output = bytearray()
+        data = first
+        try:
+            while True:
+                # Drain stderr as we go so a chatty remote cannot stall us
+                while channel.recv_stderr_ready():
+                    error_output += channel.recv_stderr(CHUNK_SIZE)
+                    del error_output[:-MAX_STDERR]
+                if data and compressed:
+                    data = decompressor.decompress(data)
+                if data:
+                    yield data
+                data = self._recv(channel)
+                if not data:
+                    break
+            if compressed:
+                tail = decompressor.flush()
+                if tail:
+                    yield tail
+
+            exit_status = channel.recv_exit_status()
+            if exit_status != 0:
+                error_output += stderr.read()[-MAX_STDERR:]
+                raise RuntimeError(
+                    f"Reading {self.log_path} failed with exit status "
+                    f"{exit_status}: {error_output.decode(errors='replace')}"
+                )
+        finally:
+            # Also stops the remote tail if the reader gave up early
+            channel.close()
+
+    def _recv(self, channel):
+        try:
+            return channel.recv(CHUNK_SIZE)
+        except socket.timeout:
+            raise TimeoutError(
+                f"No data from {self.log_path} for {self.timeout}s"
+            ) from None
+
+    def _checkpoint_for(self, host):
+        if not self.incremental:
+            return None
+        return self.checkpoints.get(host, self.log_path)
+
+    def _log_rotation(self, host, checkpoint, offset):
+        if checkpoint and offset < checkpoint["offset"]:
+            logger.info(
+                "%s was rotated, fetching from the start",
+                self.log_path,
+                extra=log_context(host=host),
+            )
+
+    def _execute_incremental(self, client):
+        host = host_of(client)
+        checkpoint = self._checkpoint_for(host)
+        # Kept within the output limits like any other command's output
+        capture = OutputCapture(self.output_limits, host)
+        # Without a spill file a truncated middle would be lost for good,
+        # so stop at the limit and let the next fetch pick up from there
+        limit = None
+        if self.output_limits.spill_dir is None:
+            limit = self.output_limits.max_bytes
+        try:
+            (inode, size, offset), chunks = self.open_stream(
+                client, checkpoint
+            )
+            self._log_rotation(host, checkpoint, offset)
+            for chunk in chunks:
+                if limit is not None:
+                    chunk = chunk[: limit - capture.stdout.total]
+                # Already uncompressed, so not through feed_stdout()
+                capture.stdout.write(chunk)
+                if limit is not None and capture.stdout.total >= limit:
+                    chunks.close()
+                    logger.warning(
+                        "Fetched the first %d bytes of %s, the rest comes "
+                        "with the next fetch (or use stream mode)",
+                        limit,
+                        self.log_path,
+                        extra=log_context(host=host),
+                    )
+                    break
+        except Exception as e:
+            capture.close()
+            logger.error(
+                "Fetching %s failed: %s",
+                self.log_path,
+                e,
+                extra=log_context(host=host),
+            )
+            return None
+        self.checkpoints.set(
+            host, self.log_path, inode, size, offset + capture.stdout.total
+        )
+        return capture.finish(0)
+
+    def _execute_streaming(self, client):
+        host = host_of(client)
+        checkpoint = self._checkpoint_for(host)
+        written = 0
+        try:
+            (inode, size, offset), chunks = self.open_stream(
+                client, checkpoint
+            )
+            self._log_rotation(host, checkpoint, offset)
+            append = checkpoint is not None
+            with self.sink.open(host, self.log_path, append=append) as f:
+                try:
+                    for chunk in chunks:
+                        f.write(chunk)
+                        written += len(chunk)
+                finally:
+                    if self.incremental:
+                        self.checkpoints.set(
+                            host, self.log_path, inode, size, offset + written
+                        )
+        except Exception as e:
+            logger.error(
+                "Streaming %s failed: %s",
+                self.log_path,
+                e,
+                extra=log_context(host=host),
+            )
+            return None
+        return (
+            f"Streamed {written} bytes of {self.log_path} "
+            f"(from offset {offset})"
+        )
+
+    def _execute_aggregate(self, client):
+        host = host_of(client)
+        checkpoint = self._checkpoint_for(host)
+        try:
+            (inode, size, offset), remote, chunks = self.open_summary(
+                client, checkpoint
+            )
+            self._log_rotation(host, checkpoint, offset)
+            if remote:
+                summary = LogSummary.from_json(b"".join(chunks))
+            else:
+                logger.info(
+                    "No python3 on the host, summarising %s locally",
+                    self.log_path,
+                    extra=log_context(host=host),
+                )
+                summary = LogSummary(self.top_k, self.bucket_seconds)
+                summary.feed(_lines(chunks))
+        except Exception as e:
+            logger.error(
+                "Summarising %s failed: %s",
+                self.log_path,
+                e,
+                extra=log_context(host=host),
+            )
+            return None
+        if self.incremental:
+            self.checkpoints.set(
+                host, self.log_path, inode, size, offset + summary.bytes_read
+            )
+        return CommandResult(summary.to_json())
+
+
+def _lines(chunks):
+    """Split a stream of byte chunks into lines, keeping the newlines."""
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if pending:
+        yield pending
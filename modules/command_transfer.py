@@ -0,0 +1,386 @@
+from modules.commander import Command, CommandResult, host_of
+from modules.logging_setup import log_context
+from modules.metrics import METRICS
+from collections import deque
+from pathlib import Path
+import hashlib
+import logging
+import os
+import re
+import shlex
+import shutil
+import threading
+import uuid
+
+logger = logging.getLogger("CommandTransfer")
+
+BLOCK_SIZE = 1024 * 1024
+# Files at least this large are updated block by block when they changed
+DELTA_THRESHOLD = 8 * 1024 * 1024
+
+
+def hash_file(path, block_size=BLOCK_SIZE):
+    """Return ``(size, sha256, [md5 of each block])`` of a local file."""
+    whole = hashlib.sha256()
+    blocks = []
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            size += len(block)
+            whole.update(block)
+            # md5 only to spot changed blocks, compared with md5sum remotely
+            digest = hashlib.md5(block, usedforsecurity=False)
+            blocks.append(digest.hexdigest())
+    return size, whole.hexdigest(), blocks
+
+
+class DigestCache:
+    """Digests of local files, computed once per file version.
+
+    Pushing one artifact to many hosts hashes it once, not once per host;
+    a changed file (size or mtime) is hashed again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._digests = {}
+
+    def get(self, path, block_size=BLOCK_SIZE):
+        info = os.stat(path)
+        key = (str(path), info.st_size, info.st_mtime_ns, block_size)
+        with self._lock:
+            lock = self._locks.setdefault(key[0], threading.Lock())
+        # Hosts asking for the same file wait for the first one to hash it
+        with lock:
+            digest = self._digests.get(key)
+            if digest is None:
+                digest = hash_file(path, block_size)
+                self._digests = {
+                    k: v for k, v in self._digests.items() if k[0] != key[0]
+                }
+                self._digests[key] = digest
+        return digest
+
+
+DIGESTS = DigestCache()
+
+
+class _Transfer(Command):
+    """Shared parts of CommandPush and CommandPull.
+
+    One exec per host checks which files differ (by size, then sha256);
+    the rest are skipped. Changed files are sent over SFTP, up to
+    ``max_files`` at a time, each on its own SFTP channel of the host's
+    transport. Files of at least ``delta_threshold`` bytes that exist on
+    both sides only have their changed ``block_size`` blocks sent. Files
+    are written to a temporary name and renamed into place.
+    """
+
+    def __init__(
+        self,
+        max_files=4,
+        delta_threshold=DELTA_THRESHOLD,
+        block_size=BLOCK_SIZE,
+    ):
+        self.max_files = max_files
+        self.delta_threshold = delta_threshold
+        self.block_size = block_size
+
+    def needs_thread_backend(self):
+        return True
+
+    def execute(self, client):
+        host = host_of(client)
+        if not hasattr(client, "open_sftp"):
+            logger.error(
+                "File transfers need the thread backend",
+                extra=log_context(host=host),
+            )
+            return None
+        try:
+            jobs = self._plan(client, host)
+        except Exception as e:
+            logger.error(
+                "Checking files failed: %s", e, extra=log_context(host=host)
+            )
+            return None
+        stats = {"sent": 0, "bytes": 0, "delta": 0, "skipped": 0}
+        errors = []
+        pending = deque()
+        for job in jobs:
+            if job is None:
+                stats["skipped"] += 1
+            else:
+                pending.append(job)
+        lock = threading.Lock()
+
+        def worker(sftp):
+            while True:
+                try:
+                    job = pending.popleft()
+                except IndexError:
+                    return
+                try:
+                    sent, delta = self._transfer(client, sftp, *job)
+                except Exception as e:
+                    logger.error(
+                        "Transferring %s failed: %s",
+                        job[0],
+                        e,
+                        extra=log_context(host=host),
+                    )
+                    with lock:
+                        errors.append(f"{job[0]}: {e}")
+                    continue
+                METRICS.inc("transfer_bytes", sent, host=host)
+                with lock:
+                    stats["sent"] += 1
+                    stats["bytes"] += sent
+                    stats["delta"] += delta
+
+        threads = []
+        try:
+            for _ in range(min(self.max_files, len(pending))):
+                sftp = client.open_sftp()
+                thread = threading.Thread(
+                    target=worker, args=(sftp,), name="transfer"
+                )
+                thread.start()
+                threads.append((thread, sftp))
+        except Exception as e:
+            # Channels already open keep working through the queue
+            logger.error(
+                "Opening SFTP failed: %s", e, extra=log_context(host=host)
+            )
+            if not threads:
+                errors.append(f"SFTP: {e}")
+        for thread, sftp in threads:
+            thread.join()
+            sftp.close()
+        if pending:
+            errors.append(f"{len(pending)} files not sent")
+        METRICS.inc("transfer_skipped", stats["skipped"], host=host)
+        summary = (
+            f"{stats['sent']} files sent ({stats['bytes']} bytes, "
+            f"{stats['delta']} as delta), {stats['skipped']} unchanged"
+        )
+        if errors:
+            summary += f", {len(errors)} failed"
+        return CommandResult(
+            summary, stderr="\n".join(errors), exit_status=1 if errors else 0
+        )
+
+    def _probe(self, client, paths, sizes, mkdirs=()):
+        """Remote ``(size, sha256)`` per path; None if it does not exist.
+
+        The sha256 is only computed (else None) when the size equals the
+        one in ``sizes``, since a different size means the file changed.
+        """
+        lines = [
+            "probe() { [ -f \"$2\" ] || return 0; "
+            's=$(stat -c %s -- "$2") || return 0; h=-; '
+            'if [ "$s" = "$3" ]; then '
+            'h=$(sha256sum < "$2" | cut -c1-64); fi; echo "$1 $s $h"; }'
+        ]
+        lines += [f"mkdir -p -- {shlex.quote(d)}" for d in sorted(mkdirs)]
+        for index, (path, size) in enumerate(zip(paths, sizes)):
+            want = -1 if size is None else size
+            lines.append(f"probe {index} {shlex.quote(path)} {want}")
+        result = self.capture(client, "; ".join(lines))
+        if result.exit_status != 0:
+            raise RuntimeError(result.stderr.strip())
+        remote = [None] * len(paths)
+        for line in result.splitlines():
+            index, size, digest = line.split()
+            remote[int(index)] = (int(size), None if digest == "-" else digest)
+        return remote
+
+    def _remote_blocks(self, client, path, size, copy_to=None):
+        """md5 of each block of a remote file, optionally copying it."""
+        count = -(-size // self.block_size)
+        quoted = shlex.quote(path)
+        command = (
+            f"i=0; while [ $i -lt {count} ]; do "
+            f"dd if={quoted} bs={self.block_size} skip=$i count=1 "
+            "2>/dev/null | md5sum | cut -c1-32; i=$((i + 1)); done"
+        )
+        if copy_to is not None:
+            command = f"cp -p -- {quoted} {shlex.quote(copy_to)} && {command}"
+        result = self.capture(client, command)
+        blocks = result.split()
+        if result.exit_status != 0 or len(blocks) != count:
+            raise RuntimeError(
+                f"Hashing blocks failed: {result.stderr.strip()}"
+            )
+        return blocks
+
+    def _changed_blocks(self, size, ours, theirs):
+        """``(offset, length)`` of every block that differs from ``theirs``."""
+        changed = []
+        for index, digest in enumerate(ours):
+            if index < len(theirs) and theirs[index] == digest:
+                continue
+            offset = index * self.block_size
+            changed.append((offset, min(self.block_size, size - offset)))
+        return changed
+
+    def _use_delta(self, size, other_size):
+        """Whether to update a copy of ``other_size`` bytes block by block."""
+        return bool(other_size) and size >= self.delta_threshold
+
+
+class CommandPush(_Transfer):
+    """Copies local files to each host over SFTP, skipping unchanged ones.
+
+    ``files`` maps local paths to remote paths, or is a list of local
+    paths that are copied into ``remote_dir``. Remote directories are
+    created and the local file mode is kept.
+    """
+
+    def __init__(self, files, remote_dir=None, **options):
+        super().__init__(**options)
+        if isinstance(files, dict):
+            self.files = [(str(k), str(v)) for k, v in files.items()]
+        else:
+            if remote_dir is None:
+                raise ValueError("remote_dir is needed for a list of files")
+            self.files = [
+                (str(f), f"{remote_dir.rstrip('/')}/{Path(f).name}")
+                for f in files
+            ]
+
+    def __str__(self):
+        return f"push {len(self.files)} files"
+
+    def _plan(self, client, host):
+        digests = [
+            DIGESTS.get(local, self.block_size) for local, _ in self.files
+        ]
+        remote_paths = [remote for _, remote in self.files]
+        mkdirs = {os.path.dirname(p) for p in remote_paths} - {"", "/"}
+        remote = self._probe(
+            client, remote_paths, [d[0] for d in digests], mkdirs
+        )
+        jobs = []
+        for (local, path), digest, theirs in zip(self.files, digests, remote):
+            if theirs is not None and theirs[1] == digest[1]:
+                logger.debug(
+                    "Unchanged: %s", path, extra=log_context(host=host)
+                )
+                jobs.append(None)
+            else:
+                jobs.append((path, local, digest, theirs))
+        return jobs
+
+    def _transfer(self, client, sftp, path, local, digest, remote):
+        size, _, blocks = digest
+        temp = f"{path}.av-{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            if remote is not None and self._use_delta(size, remote[0]):
+                theirs = self._remote_blocks(
+                    client, path, remote[0], copy_to=temp
+                )
+                changed = self._changed_blocks(size, blocks, theirs)
+                sent = self._write_blocks(sftp, local, temp, changed, size)
+                delta = 1
+            else:
+                with open(local, "rb") as f:
+                    # putfo pipelines its writes
+                    sftp.putfo(f, temp, file_size=size)
+                sent, delta = size, 0
+            sftp.chmod(temp, os.stat(local).st_mode & 0o7777)
+            sftp.posix_rename(temp, path)
+        except BaseException:
+            try:
+                sftp.remove(temp)
+            except OSError:
+                pass
+            raise
+        return sent, delta
+
+    def _write_blocks(self, sftp, local, temp, changed, size):
+        sent = 0
+        with open(local, "rb") as source, sftp.open(temp, "r+b") as target:
+            target.set_pipelined(True)
+            for offset, length in changed:
+                source.seek(offset)
+                target.seek(offset)
+                target.write(source.read(length))
+                sent += length
+            target.truncate(size)
+        return sent
+
+
+class CommandPull(_Transfer):
+    """Copies remote files from each host to ``<local_dir>/<host>/<path>``.
+
+    A local copy from an earlier pull is compared first: unchanged files
+    are skipped and large ones only fetch their changed blocks. Reads are
+    prefetched so a file downloads without a round-trip per chunk.
+    """
+
+    def __init__(self, paths, local_dir="data/pull", **options):
+        super().__init__(**options)
+        self.paths = [str(p) for p in paths]
+        self.local_dir = str(local_dir)
+
+    def __str__(self):
+        return f"pull {len(self.paths)} files"
+
+    def local_path(self, host, path):
+        safe_host = re.sub(r"[^\w.-]", "_", str(host))
+        return Path(self.local_dir, safe_host, path.lstrip("/"))
+
+    def _plan(self, client, host):
+        targets = [self.local_path(host, p) for p in self.paths]
+        sizes = [t.stat().st_size if t.exists() else None for t in targets]
+        remote = self._probe(client, self.paths, sizes)
+        jobs = []
+        for path, target, theirs in zip(self.paths, targets, remote):
+            if theirs is None:
+                raise FileNotFoundError(f"{path} does not exist")
+            if theirs[1] is not None and target.exists():
+                if hash_file(target, self.block_size)[1] == theirs[1]:
+                    jobs.append(None)
+                    continue
+            jobs.append((path, target, theirs))
+        return jobs
+
+    def _transfer(self, client, sftp, path, target, remote):
+        size = remote[0]
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temp = target.with_name(f"{target.name}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            local_size = target.stat().st_size if target.exists() else 0
+            if self._use_delta(size, local_size):
+                ours = hash_file(target, self.block_size)[2]
+                theirs = self._remote_blocks(client, path, size)
+                changed = self._changed_blocks(size, theirs, ours)
+                shutil.copyfile(target, temp)
+                sent = self._read_blocks(sftp, path, temp, changed, size)
+                delta = 1
+            else:
+                with open(temp, "wb") as f:
+                    # getfo prefetches the whole file
+                    sftp.getfo(path, f)
+                sent, delta = size, 0
+            os.replace(temp, target)
+        except BaseException:
+            temp.unlink(missing_ok=True)
+            raise
+        return sent, delta
+
+    def _read_blocks(self, sftp, path, temp, changed, size):
+        sent = 0
+        with sftp.open(path, "rb") as source, open(temp, "r+b") as target:
+            # readv requests every block up front
+            for (offset, _), data in zip(changed, source.readv(changed)):
+                target.seek(offset)
+                target.write(data)
+                sent += len(data)
+            target.truncate(size)
+        return sent
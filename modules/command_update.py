@@ -1,60 +1,79 @@
-from modules.commander import Command, DetectOSCommand
+from modules.commander import Command
+from modules.host_facts import host_facts
 from dotenv import load_dotenv
 import os
 import logging
+import shlex
 
 load_dotenv()
 sudo_password = os.getenv("AV_AGENT_SUDO_PASSWORD")
 logger = logging.getLogger("CommandUpdate")
 
+YUM_OS_IDS = ["centos", "rhel", "rocky", "fedora"]
+
 
 class CommandUpdate(Command):
-    def __init__(self):
+    """Upgrade all packages with apt or yum.
+
+    ``proxy`` (e.g. an apt-cacher-ng or squid URL) makes the package
+    manager download through a local caching mirror instead of upstream.
+    """
+
+    def __init__(self, timeout=120, proxy=None):
+        self.timeout = timeout
+        self.proxy = proxy
         logger.debug("CommandUpdate initialized")
 
     def execute(self, client):
         logger.debug("Executing command update")
+        update_command = self.script(client)
 
-        # Detect the OS
-        os_command = DetectOSCommand()
-        os_id = os_command.execute(client).strip().strip('"')
-        logger.debug("OS detected: %s", os_id)
-
-        # Determine OS and which update command to use
-        if os_id in ["ubuntu", "debian"]:
-            logger.debug("OS found: Ubuntu/Debian - using apt")
-            update_command = (
-                f"echo {sudo_password} | sudo -S apt update && "
-                f"echo {sudo_password} | sudo -S apt upgrade -y"
-            )
-        elif os_id in ["centos", "rhel", "rocky", "fedora"]:
-            logger.debug("OS found: CentOS/RHEL/Rocky/Fedora - using yum")
-            update_command = f"echo {sudo_password} | sudo -S yum update -y"
-        else:
-            logger.error("Unsupported OS ID: %s", os_id)
-            raise ValueError(f"Unsupported OS ID: {os_id}")
-
-        # Execute command with timeout
+        # Execute command with timeout; output is read while it runs, so a
+        # chatty upgrade cannot fill the channel and stall
         try:
-            stdin, stdout, stderr = client.exec_command(
-                update_command, timeout=120
+            result = self.capture(
+                client, update_command, timeout=self.timeout
             )
-            logger.debug("Command executed, waiting for exit status")
+            logger.debug("Exit status: %s", result.exit_status)
 
-            exit_status = stdout.channel.recv_exit_status()
-            logger.debug("Exit status: %d", exit_status)
-
-            output = stdout.read().decode()
-            error_output = stderr.read().decode()
-
-            if exit_status == 0:
+            if result.exit_status == 0:
                 logger.debug("Command executed successfully")
             else:
                 logger.error(
-                    "Command execution failed with error: %s", error_output
+                    "Command execution failed with error: %s", result.stderr
                 )
 
-            return output if exit_status == 0 else None
+            # Failures keep their exit status and stderr for the caller
+            return result
         except Exception:
             logger.exception("Command execution failed")
             return None
+
+    def script(self, client):
+        # Detect the OS (cached per host, no extra round-trip when fresh)
+        facts = host_facts(client)
+        os_id = facts["os_id"]
+        package_manager = facts["package_manager"]
+        logger.debug("OS detected: %s (%s)", os_id, package_manager)
+
+        # Determine OS and which update command to use
+        if package_manager == "apt-get" or os_id in ["ubuntu", "debian"]:
+            logger.debug("OS found: Ubuntu/Debian - using apt")
+            options = ""
+            if self.proxy:
+                options = " -o " + shlex.quote(
+                    f"Acquire::http::Proxy={self.proxy}"
+                )
+            return (
+                f"echo {sudo_password} | sudo -S apt{options} update && "
+                f"echo {sudo_password} | sudo -S apt{options} upgrade -y"
+            )
+        elif package_manager in ["dnf", "yum"] or os_id in YUM_OS_IDS:
+            logger.debug("OS found: CentOS/RHEL/Rocky/Fedora - using yum")
+            options = ""
+            if self.proxy:
+                options = " --setopt=" + shlex.quote(f"proxy={self.proxy}")
+            return f"echo {sudo_password} | sudo -S yum{options} update -y"
+        else:
+            logger.error("Unsupported OS ID: %s", os_id)
+            raise ValueError(f"Unsupported OS ID: {os_id}")
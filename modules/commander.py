@@ -1,19 +1,413 @@
+import asyncio
+import re
+import socket
+import time
+import uuid
+import zlib
 from abc import ABC, abstractmethod
+from pathlib import Path
+
+CHUNK_SIZE = 32 * 1024
+
+# How often the reader wakes up to check a channel without new data
+POLL_INTERVAL = 0.1
+
+# Longest possible exit status trailer of a compressed command
+TRAILER_SIZE = 64
+
+
+class CommandResult(str):
+    """Command stdout that also carries stderr and the exit status.
+
+    ``stdout_bytes`` and ``stderr_bytes`` count everything the command
+    printed; when ``truncated`` is set the text only holds its start and
+    end, and ``stdout_file``/``stderr_file`` point at the full output if
+    it was spilled to disk.
+    """
+
+    def __new__(
+        cls,
+        stdout,
+        stderr="",
+        exit_status=0,
+        stdout_bytes=None,
+        stderr_bytes=None,
+        truncated=False,
+        stdout_file=None,
+        stderr_file=None,
+    ):
+        result = super().__new__(cls, stdout)
+        result.stderr = stderr
+        result.exit_status = exit_status
+        result.stdout_bytes = (
+            len(stdout) if stdout_bytes is None else stdout_bytes
+        )
+        result.stderr_bytes = (
+            len(stderr) if stderr_bytes is None else stderr_bytes
+        )
+        result.truncated = truncated
+        result.stdout_file = stdout_file
+        result.stderr_file = stderr_file
+        return result
+
+
+class OutputLimits:
+    """How much of a command's stdout and stderr is kept in memory.
+
+    A stream of up to ``max_bytes`` is kept whole. Beyond that only its
+    first ``head_bytes`` and last ``max_bytes - head_bytes`` are kept,
+    joined by a note of how many bytes were left out. With ``spill_dir``
+    a stream that gets truncated is also written in full to a file there.
+    ``compress`` pipes stdout through ``gzip`` on the host, which must
+    have it installed.
+    """
+
+    def __init__(
+        self,
+        max_bytes=1024 * 1024,
+        head_bytes=None,
+        spill_dir=None,
+        compress=False,
+    ):
+        self.max_bytes = max_bytes
+        if head_bytes is None:
+            head_bytes = max_bytes // 2
+        self.head_bytes = min(head_bytes, max_bytes)
+        self.tail_bytes = max_bytes - self.head_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.compress = compress
+
+
+class _StreamBuffer:
+    """One output stream, truncated (and spilled) once it gets too big."""
+
+    def __init__(self, limits, spill_path=None):
+        self.limits = limits
+        self.spill_path = spill_path
+        self.total = 0
+        self.head = bytearray()
+        self.tail = None
+        self.path = None
+        self._file = None
+
+    @property
+    def truncated(self):
+        return self.tail is not None
+
+    def write(self, data):
+        if not data:
+            return
+        self.total += len(data)
+        if self._file is not None:
+            self._file.write(data)
+        if self.tail is None:
+            self.head += data
+            if len(self.head) <= self.limits.max_bytes:
+                return
+            self._truncate()
+        else:
+            self.tail += data
+        keep = self.limits.tail_bytes
+        del self.tail[: len(self.tail) - keep]
+
+    def _truncate(self):
+        if self.spill_path is not None:
+            self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.spill_path, "wb")
+            self._file.write(self.head)
+            self.path = str(self.spill_path)
+        keep = self.limits.head_bytes
+        self.tail = self.head[keep:]
+        del self.head[keep:]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def text(self):
+        text = self.head.decode(errors="replace")
+        if self.tail is None:
+            return text
+        omitted = self.total - len(self.head) - len(self.tail)
+        return (
+            f"{text}\n[... {omitted} bytes omitted ...]\n"
+            f"{self.tail.decode(errors='replace')}"
+        )
+
+
+class OutputCapture:
+    """Collects the output of one remote command within ``limits``.
+
+    Used by ``Command.capture``/``capture_async``; stdout goes through
+    ``feed_stdout`` (which undoes the remote compression) and stderr is
+    written to ``stderr`` directly.
+    """
+
+    def __init__(self, limits, host=None):
+        self.limits = limits
+        spill = None
+        if limits.spill_dir is not None and host is not None:
+            name = re.sub(r"[^\w.-]", "_", str(host))
+            stamp = time.strftime("%Y%m%dT%H%M%S")
+            spill = limits.spill_dir / name / f"{stamp}-{uuid.uuid4().hex[:8]}"
+        self.stdout = _StreamBuffer(
+            limits, spill and spill.with_suffix(".stdout")
+        )
+        self.stderr = _StreamBuffer(
+            limits, spill and spill.with_suffix(".stderr")
+        )
+        self._token = uuid.uuid4().hex if limits.compress else None
+        self._decompressor = None
+        self._pending = b""
+        if self._token:
+            self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def wrap(self, command):
+        """The remote command line, compressing stdout if configured.
+
+        gzip would hide the exit status, so it is appended to the
+        compressed stream and split off again in ``finish()``.
+        """
+        if self._token is None:
+            return command
+        return (
+            "{ (\n"
+            f"{command}\n"
+            f"); printf '\\n__AVZ_{self._token}_%d\\n' \"$?\"; }} | gzip -c"
+        )
+
+    def feed_stdout(self, data):
+        if self._decompressor is None:
+            self.stdout.write(data)
+            return
+        # Hold back the end of the stream, it may be the exit status
+        data = self._pending + self._decompressor.decompress(data)
+        self.stdout.write(data[:-TRAILER_SIZE])
+        self._pending = data[-TRAILER_SIZE:]
+
+    def finish(self, exit_status):
+        """Close the streams and return the ``CommandResult``."""
+        try:
+            if self._decompressor is not None:
+                data = self._pending + self._decompressor.flush()
+                match = re.search(
+                    rb"\n__AVZ_" + self._token.encode() + rb"_(\d+)\n\Z",
+                    data,
+                )
+                if match:
+                    data = data[: match.start()]
+                    exit_status = int(match.group(1))
+                self.stdout.write(data)
+        finally:
+            self.close()
+        return CommandResult(
+            self.stdout.text(),
+            self.stderr.text(),
+            exit_status,
+            stdout_bytes=self.stdout.total,
+            stderr_bytes=self.stderr.total,
+            truncated=self.stdout.truncated or self.stderr.truncated,
+            stdout_file=self.stdout.path,
+            stderr_file=self.stderr.path,
+        )
+
+    def close(self):
+        self.stdout.close()
+        self.stderr.close()
+
+    def read_channel(self, channel, timeout=None):
+        """Read stdout and stderr of a paramiko channel side by side.
+
+        Reading one stream to the end before the other stalls the remote
+        command once the unread stream fills its SSH window, so stderr is
+        drained whenever stdout has nothing new for ``POLL_INTERVAL``.
+        Once the command has sent nothing for ``timeout`` seconds the
+        channel is closed and TimeoutError raised.
+        """
+        last_data = time.monotonic()
+        channel.settimeout(POLL_INTERVAL)
+        while True:
+            while channel.recv_stderr_ready():
+                self.stderr.write(channel.recv_stderr(CHUNK_SIZE))
+                last_data = time.monotonic()
+            try:
+                data = channel.recv(CHUNK_SIZE)
+            except socket.timeout:
+                if timeout and time.monotonic() - last_data > timeout:
+                    channel.close()
+                    raise TimeoutError(
+                        f"Command sent nothing for {timeout}s"
+                    ) from None
+                continue
+            if not data:
+                break
+            last_data = time.monotonic()
+            self.feed_stdout(data)
+        # stdout is at EOF, so is stderr once its buffer is empty
+        while True:
+            data = channel.recv_stderr(CHUNK_SIZE)
+            if not data:
+                break
+            self.stderr.write(data)
+        return channel.recv_exit_status()
+
+
+async def read_process(process, stdout_write, stderr_write, timeout=None):
+    """Pass an asyncssh process's output on until it has closed.
+
+    Raises TimeoutError once it has sent nothing for ``timeout`` seconds.
+    """
+    last_data = time.monotonic()
+
+    async def pump(stream, write):
+        nonlocal last_data
+        while True:
+            data = await stream.read(CHUNK_SIZE)
+            if not data:
+                return
+            last_data = time.monotonic()
+            write(data)
+
+    tasks = [
+        asyncio.ensure_future(pump(process.stdout, stdout_write)),
+        asyncio.ensure_future(pump(process.stderr, stderr_write)),
+        asyncio.ensure_future(process.wait_closed()),
+    ]
+    try:
+        pending = set(tasks)
+        while pending:
+            wait = None
+            if timeout:
+                wait = last_data + timeout - time.monotonic()
+                if wait <= 0:
+                    raise TimeoutError(f"Command sent nothing for {timeout}s")
+            done, pending = await asyncio.wait(
+                pending, timeout=wait, return_when=asyncio.FIRST_EXCEPTION
+            )
+            for task in done:
+                task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 class Command(ABC):
+    # Shared by every command, see configure_output()
+    output_limits = OutputLimits()
+
     @abstractmethod
     def execute(self, client):
         pass
 
+    @classmethod
+    def configure_output(cls, **options):
+        """Set the ``OutputLimits`` used by every command."""
+        Command.output_limits = OutputLimits(**options)
+
+    def capture(self, client, command, input=None, timeout=None):
+        """Run ``command`` on a paramiko client and return its result.
+
+        stdout and stderr are read together and kept within
+        ``output_limits``; ``input`` is written to the command's stdin.
+        ``timeout`` is how long the command may go without any output.
+        """
+        limits = self.output_limits
+        host = host_of(client) if limits.spill_dir else None
+        capture = OutputCapture(limits, host)
+        stdin, stdout, stderr = client.exec_command(
+            capture.wrap(command), timeout=timeout
+        )
+        try:
+            if input is not None:
+                stdin.write(input)
+                stdin.flush()
+            # Nothing more to send; a command reading stdin gets EOF
+            stdin.close()
+            channel = stdout.channel
+            if hasattr(channel, "recv_stderr_ready"):
+                exit_status = capture.read_channel(channel, timeout)
+            else:
+                # The asyncio backend's blocking client has already
+                # buffered the output
+                capture.feed_stdout(stdout.read())
+                capture.stderr.write(stderr.read())
+                exit_status = channel.recv_exit_status()
+        except Exception:
+            capture.close()
+            raise
+        return capture.finish(exit_status)
+
+    async def capture_async(self, conn, command, input=None, timeout=None):
+        """``capture()`` for an ``AsyncConnection``."""
+        limits = self.output_limits
+        capture = OutputCapture(limits, conn.host)
+        process = await conn.start(capture.wrap(command))
+        try:
+            if input is not None:
+                process.stdin.write(input.encode())
+            process.stdin.write_eof()
+            await read_process(
+                process, capture.feed_stdout, capture.stderr.write, timeout
+            )
+        except Exception:
+            capture.close()
+            raise
+        finally:
+            process.close()
+        return capture.finish(process.exit_status)
+
+    def script(self, client):
+        """Return this command as one shell line, for use in a batch.
+
+        Commands that cannot be expressed as a single remote shell command
+        return None and are not accepted by ``CommandBatch``.
+        """
+        return None
+
+    async def execute_async(self, conn):
+        """Run execute() in a worker thread against a blocking view of conn.
+
+        Commands that can talk to an ``AsyncConnection`` directly override
+        this so they never occupy a thread.
+        """
+        return await asyncio.to_thread(self.execute, conn.blocking())
+
+    def needs_thread_backend(self):
+        """True when execute() needs a real paramiko client or channel."""
+        return False
+
+
+def check_backend(command, backend):
+    """Raise ValueError if ``command`` cannot run on ``backend``."""
+    if backend == "asyncio" and command.needs_thread_backend():
+        raise ValueError(
+            f"{type(command).__name__} cannot run on the asyncio backend, "
+            "use the thread backend"
+        )
+
+
+def host_of(client):
+    """Return the inventory host name a client was opened for."""
+    host = getattr(client, "av_host", None)
+    if host is None:
+        host = client.get_transport().getpeername()[0]
+    return host
+
 
 # TESTING
 class DetectOSCommand(Command):
     def execute(self, client):
-        stdin, stdout, stderr = client.exec_command(
-            "cat /etc/os-release | grep '^ID='"
+        output = self.capture(client, "cat /etc/os-release | grep '^ID='")
+        return output.split("=")[1].strip()
+
+    def script(self, client):
+        return "cat /etc/os-release | grep '^ID='"
+
+    async def execute_async(self, conn):
+        output = await self.capture_async(
+            conn, "cat /etc/os-release | grep '^ID='"
         )
-        output = stdout.read().decode()
         return output.split("=")[1].strip()
 
 
@@ -22,8 +416,13 @@ class PlainCommand(Command):
         self.command = command
 
     def execute(self, client):
-        stdin, stdout, stderr = client.exec_command(f"{self.command}")
-        return stdout.read().decode()
+        return self.capture(client, f"{self.command}")
+
+    def script(self, client):
+        return f"{self.command}"
+
+    async def execute_async(self, conn):
+        return await self.capture_async(conn, f"{self.command}")
 
 
 class EchoCommand(Command):
@@ -31,8 +430,13 @@ class EchoCommand(Command):
         self.message = message
 
     def execute(self, client):
-        stdin, stdout, stderr = client.exec_command(f"echo {self.message}")
-        return stdout.read().decode()
+        return self.capture(client, f"echo {self.message}")
+
+    def script(self, client):
+        return f"echo {self.message}"
+
+    async def execute_async(self, conn):
+        return await self.capture_async(conn, f"echo {self.message}")
 
 
 class ListFilesCommand(Command):
@@ -40,5 +444,96 @@ class ListFilesCommand(Command):
         self.directory = directory
 
     def execute(self, client):
-        stdin, stdout, stderr = client.exec_command(f"ls {self.directory}")
-        return stdout.read().decode()
+        return self.capture(client, f"ls {self.directory}")
+
+    def script(self, client):
+        return f"ls {self.directory}"
+
+    async def execute_async(self, conn):
+        return await self.capture_async(conn, f"ls {self.directory}")
+
+
+class CommandBatch(Command):
+    """Runs several commands as one remote script on a single channel.
+
+    Each step's stdout and stderr are framed with unique markers and its
+    exit code is reported in the closing marker, so one round-trip yields
+    a ``CommandResult`` per step (``result.steps``). With
+    ``stop_on_error`` the script stops at the first failing step; steps
+    that never ran, or whose markers were cut out by the output limits,
+    get ``exit_status=None``.
+    """
+
+    def __init__(self, commands, stop_on_error=False):
+        self.commands = list(commands)
+        self.stop_on_error = stop_on_error
+        for command in self.commands:
+            if type(command).script is Command.script:
+                raise TypeError(
+                    f"{type(command).__name__} cannot be used in a batch"
+                )
+
+    def execute(self, client):
+        token = uuid.uuid4().hex
+        output = self.capture(client, self._build_script(client, token))
+        result = self._parse(token, output, output.stderr)
+        result.stdout_bytes = output.stdout_bytes
+        result.stderr_bytes = output.stderr_bytes
+        result.truncated = output.truncated
+        result.stdout_file = output.stdout_file
+        result.stderr_file = output.stderr_file
+        return result
+
+    def script(self, client):
+        return self._build_script(client, uuid.uuid4().hex)
+
+    def _build_script(self, client, token):
+        lines = []
+        for i, command in enumerate(self.commands):
+            step = command.script(client)
+            if step is None:
+                raise TypeError(
+                    f"{type(command).__name__} cannot be used in a batch"
+                )
+            marker = f"__AVB_{token}_{i}"
+            lines.append(
+                f"printf '\\n{marker}_BEGIN\\n'; "
+                f"printf '\\n{marker}_BEGIN\\n' >&2; "
+                f"( {step} ); rc=$?; "
+                f"printf '\\n{marker}_END_%d\\n' $rc; "
+                f"printf '\\n{marker}_END\\n' >&2"
+            )
+            if self.stop_on_error:
+                lines.append('[ "$rc" -eq 0 ] || exit "$rc"')
+        return "\n".join(lines)
+
+    def _parse(self, token, output, error_output):
+        pattern = re.compile(
+            rf"\n__AVB_{token}_(\d+)_BEGIN\n(.*?)"
+            rf"\n__AVB_{token}_\1_END(?:_(\d+))?\n",
+            re.S,
+        )
+        outputs = {
+            int(i): (text, int(rc)) for i, text, rc in pattern.findall(output)
+        }
+        errors = {
+            int(i): text for i, text, _ in pattern.findall(error_output)
+        }
+
+        steps = []
+        for i in range(len(self.commands)):
+            if i in outputs:
+                text, rc = outputs[i]
+                steps.append(CommandResult(text, errors.get(i, ""), rc))
+            else:
+                steps.append(CommandResult("", "", None))
+        exit_status = next(
+            (step.exit_status for step in steps if step.exit_status != 0), 0
+        )
+        result = CommandResult(
+            "".join(steps),
+            "".join(step.stderr for step in steps),
+            exit_status,
+        )
+        result.steps = steps
+        return result
@@ -0,0 +1,163 @@
+import logging
+import threading
+import time
+
+from modules.logging_setup import log_context
+from modules.metrics import METRICS
+
+logger = logging.getLogger("ConnectionPool")
+
+
+class _PooledConnection:
+    def __init__(self, client):
+        self.client = client
+        self.users = 0
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+    """Per-host pool of authenticated SSH clients.
+
+    One transport is kept per host and shared by every command run against
+    it; paramiko multiplexes each ``exec_command`` onto its own channel.
+    Idle transports are evicted after ``max_idle`` seconds and the pool never
+    holds more than ``max_size`` hosts; when it is full and nothing is idle
+    the connection is handed out unpooled and closed on release.
+    """
+
+    def __init__(self, connect, max_size=256, max_idle=600, keepalive=30):
+        self._connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.keepalive = keepalive
+        self._entries = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, host, session_id):
+        """Return a healthy client for ``host``, reconnecting if needed."""
+        with self._lock:
+            host_lock = self._host_locks.setdefault(host, threading.Lock())
+        # Serialise handshakes per host so parallel callers share one
+        with host_lock:
+            with self._lock:
+                entry = self._entries.get(host)
+            if entry is not None:
+                if self._is_healthy(entry.client):
+                    with self._lock:
+                        entry.users += 1
+                        entry.last_used = time.monotonic()
+                    logger.debug(
+                        "Reusing pooled connection",
+                        extra=log_context(session_id, host),
+                    )
+                    METRICS.inc("pool_reuse", host=host)
+                    return entry.client
+                logger.info(
+                    "Pooled connection is dead, reconnecting",
+                    extra=log_context(session_id, host),
+                )
+                self._discard(host, entry)
+
+            client = self._connect(host, session_id)
+            if client is None:
+                return None
+            transport = client.get_transport()
+            if transport is not None and self.keepalive:
+                transport.set_keepalive(self.keepalive)
+
+            with self._lock:
+                self._evict_idle_locked()
+                if len(self._entries) >= self.max_size:
+                    self._evict_lru_locked()
+                if len(self._entries) >= self.max_size:
+                    logger.debug(
+                        "Pool full, connection is not pooled",
+                        extra=log_context(session_id, host),
+                    )
+                    return client
+                entry = _PooledConnection(client)
+                entry.users = 1
+                self._entries[host] = entry
+            return client
+
+    def release(self, host, client):
+        """Hand a client back; unpooled or dead clients are closed."""
+        with self._lock:
+            entry = self._entries.get(host)
+            pooled = entry is not None and entry.client is client
+            if pooled:
+                entry.users = max(entry.users - 1, 0)
+                entry.last_used = time.monotonic()
+        if not pooled:
+            client.close()
+        elif not self._is_healthy(client):
+            self._discard(host, entry)
+
+    def discard(self, host, client):
+        """Close ``client`` and drop it from the pool, e.g. after an abort.
+
+        Later ``acquire`` calls for ``host`` open a new connection.
+        """
+        with self._lock:
+            entry = self._entries.get(host)
+            if entry is not None and entry.client is client:
+                del self._entries[host]
+        client.close()
+
+    def evict_idle(self):
+        """Close transports that have been idle longer than ``max_idle``."""
+        with self._lock:
+            self._evict_idle_locked()
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry.client.close()
+        logger.debug("Closed %d pooled connections", len(entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _discard(self, host, entry):
+        with self._lock:
+            if self._entries.get(host) is entry:
+                del self._entries[host]
+        entry.client.close()
+
+    def _evict_idle_locked(self):
+        now = time.monotonic()
+        for host, entry in list(self._entries.items()):
+            if entry.users == 0 and now - entry.last_used > self.max_idle:
+                logger.debug(
+                    "Evicting idle connection", extra=log_context(host=host)
+                )
+                del self._entries[host]
+                entry.client.close()
+
+    def _evict_lru_locked(self):
+        idle = [
+            (entry.last_used, host)
+            for host, entry in self._entries.items()
+            if entry.users == 0
+        ]
+        if idle:
+            _, host = min(idle)
+            logger.debug(
+                "Evicting least recently used connection",
+                extra=log_context(host=host),
+            )
+            self._entries.pop(host).client.close()
+
+    @staticmethod
+    def _is_healthy(client):
+        # Dead peers are noticed by the transport's keepalive, which flips
+        # is_active(); probing with SSH_MSG_IGNORE upsets some servers.
+        transport = client.get_transport()
+        return (
+            transport is not None
+            and transport.is_active()
+            and transport.is_authenticated()
+        )
@@ -0,0 +1,138 @@
+import logging
+import os
+import tempfile
+import threading
+
+import paramiko
+from paramiko.hostkeys import HostKeyEntry
+
+from modules.state_file import file_lock
+
+logger = logging.getLogger("CredentialStore")
+
+KEY_CLASSES = (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey)
+
+
+class CredentialStore:
+    """Thread-safe cache of parsed private keys and known host keys.
+
+    Private keys are parsed once per path. ``known_hosts`` is loaded once
+    into an index keyed by hostname; keys learned during a run are kept in
+    memory and written back in one locked, atomic ``flush()``.
+    """
+
+    def __init__(self, known_hosts_file):
+        self.known_hosts_file = known_hosts_file
+        self._keys = {}
+        self._loaded = False
+        self._index = {}
+        self._hashed = []
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def private_key(self, path):
+        """Return the parsed key at ``path`` (Ed25519, ECDSA or RSA)."""
+        with self._lock:
+            key = self._keys.get(path)
+            if key is None:
+                key = self._load_private_key(path)
+                self._keys[path] = key
+            return key
+
+    def host_keys_for(self, hostname):
+        """Return the known ``{keytype: key}`` entries for ``hostname``."""
+        with self._lock:
+            self._ensure_host_keys()
+            if hostname not in self._index:
+                # Hashed entries can only be found by a scan; index the hit
+                self._index[hostname] = self._scan_hashed(hostname)
+            return dict(self._index[hostname])
+
+    def add_host_key(self, hostname, key):
+        """Remember ``key`` for ``hostname``; returns True if it is new."""
+        with self._lock:
+            known = self.host_keys_for(hostname)
+            if known.get(key.get_name()) == key:
+                return False
+            self._index.setdefault(hostname, {})[key.get_name()] = key
+            self._pending[(hostname, key.get_name())] = key
+            return True
+
+    def flush(self):
+        """Merge newly learned host keys into ``known_hosts`` on disk."""
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending = dict(self._pending)
+            self._pending.clear()
+
+        directory = os.path.dirname(self.known_hosts_file) or "."
+        os.makedirs(directory, exist_ok=True)
+        with file_lock(self.known_hosts_file + ".lock"):
+            # Re-read under the lock so keys added by other processes stay
+            on_disk = paramiko.HostKeys()
+            if os.path.exists(self.known_hosts_file):
+                on_disk.load(self.known_hosts_file)
+            for (hostname, keytype), key in pending.items():
+                on_disk.add(hostname, keytype, key)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=directory, prefix=".known_hosts."
+            )
+            os.close(fd)
+            try:
+                on_disk.save(tmp_path)
+                os.replace(tmp_path, self.known_hosts_file)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+        logger.debug("Flushed %d new host keys to known_hosts", len(pending))
+        return len(pending)
+
+    def _ensure_host_keys(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.known_hosts_file):
+            return
+        with open(self.known_hosts_file) as f:
+            for lineno, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    entry = HostKeyEntry.from_line(line, lineno)
+                except paramiko.SSHException:
+                    continue
+                if entry is None:
+                    continue
+                for hostname in entry.hostnames:
+                    if hostname.startswith("|1|"):
+                        self._hashed.append((hostname, entry.key))
+                    else:
+                        keys = self._index.setdefault(hostname, {})
+                        keys[entry.key.get_name()] = entry.key
+        logger.debug(
+            "Loaded %d known hosts from %s",
+            len(self._index) + len(self._hashed),
+            self.known_hosts_file,
+        )
+
+    def _scan_hashed(self, hostname):
+        keys = {}
+        for hashed, key in self._hashed:
+            salt = hashed.split("|")[2]
+            if paramiko.HostKeys.hash_host(hostname, salt) == hashed:
+                keys[key.get_name()] = key
+        return keys
+
+    @staticmethod
+    def _load_private_key(path):
+        errors = []
+        for key_class in KEY_CLASSES:
+            try:
+                return key_class.from_private_key_file(path)
+            except paramiko.SSHException as e:
+                errors.append(f"{key_class.__name__}: {e}")
+        raise paramiko.SSHException(
+            f"Unsupported private key {path}: {'; '.join(errors)}"
+        )
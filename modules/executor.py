@@ -0,0 +1,345 @@
+import functools
+import itertools
+import logging
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.logging_setup import log_context
+
+logger = logging.getLogger("FanOutExecutor")
+
+HostResult = namedtuple(
+    "HostResult", ["host", "exit_status", "stdout", "stderr", "duration"]
+)
+
+
+class RunHandle:
+    """Future-like handle over a fan-out run, yielding results as they land.
+
+    Results are queued by the workers in completion order, so iterating the
+    handle yields each host's ``HostResult`` as soon as it finishes. Hosts
+    that miss the global deadline are reported with ``exit_status=None``.
+    ``host_timeout`` is the per-host deadline the executor applies.
+    """
+
+    def __init__(self, hosts, run_timeout=None, host_timeout=None):
+        self.hosts = list(dict.fromkeys(hosts))
+        self.host_timeout = host_timeout
+        self.total = len(self.hosts)
+        self.started = time.monotonic()
+        self.deadline = (
+            self.started + run_timeout if run_timeout is not None else None
+        )
+        self._queue = queue.Queue()
+        self._results = []
+        self._reported = set()
+        self._active = {}
+        self._callbacks = []
+        self._done_callbacks = []
+        self._expire_callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._expired = threading.Event()
+        self._timer = None
+        if self.total == 0:
+            self._done.set()
+        elif run_timeout is not None:
+            self._timer = threading.Timer(run_timeout, self.expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    @property
+    def expired(self):
+        return self._expired.is_set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_result_callback(self, callback):
+        """Call ``callback(result)`` for every result, past and future."""
+        with self._lock:
+            self._callbacks.append(callback)
+            results = list(self._results)
+        for result in results:
+            callback(result)
+
+    def add_done_callback(self, callback):
+        """Call ``callback(handle)`` once every host has reported."""
+        with self._lock:
+            if not self._done.is_set():
+                self._done_callbacks.append(callback)
+                return
+        callback(self)
+
+    def add_expire_callback(self, callback):
+        """Call ``callback()`` once if the run is aborted by ``expire()``."""
+        with self._lock:
+            if not self._expired.is_set():
+                self._expire_callbacks.append(callback)
+                return
+        callback()
+
+    def results(self, timeout=None):
+        """Block until the run is finished and return all results."""
+        self.wait(timeout)
+        with self._lock:
+            return list(self._results)
+
+    def wait(self, timeout=None):
+        """Wait for the run to finish; returns True when it has."""
+        if timeout is None and self.deadline is not None:
+            timeout = max(self.deadline - time.monotonic(), 0) + 1
+        return self._done.wait(timeout)
+
+    def __iter__(self):
+        yielded = 0
+        while yielded < self.total:
+            try:
+                result = self._queue.get(timeout=0.5)
+            except queue.Empty:
+                if self.deadline and time.monotonic() > self.deadline:
+                    self.expire()
+                continue
+            yielded += 1
+            yield result
+
+    def expire(self):
+        """Abort the run: close live sessions and fail unfinished hosts."""
+        with self._lock:
+            self._expired.set()
+            sessions = list(self._active.items())
+            unfinished = [h for h in self.hosts if h not in self._reported]
+            callbacks, self._expire_callbacks = self._expire_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Expire callback failed")
+        for host, abort in sessions:
+            logger.warning(
+                "Run deadline exceeded, closing session",
+                extra=log_context(host=host),
+            )
+            _abort_quietly(abort)
+        for host in unfinished:
+            self._set_result(
+                HostResult(
+                    host,
+                    None,
+                    "",
+                    "run deadline exceeded",
+                    time.monotonic() - self.started,
+                )
+            )
+
+    def _track(self, host, abort):
+        """Remember how to abort ``host``'s session; None when it ended."""
+        with self._lock:
+            if abort is None:
+                self._active.pop(host, None)
+            else:
+                self._active[host] = abort
+
+    def _set_result(self, result):
+        with self._lock:
+            if result.host in self._reported:
+                return
+            self._reported.add(result.host)
+            self._active.pop(result.host, None)
+            self._results.append(result)
+            callbacks = list(self._callbacks)
+            finished = len(self._results) == self.total
+        self._queue.put(result)
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception:
+                logger.exception("Result callback failed for %s", result.host)
+        if finished:
+            if self._timer is not None:
+                self._timer.cancel()
+            with self._lock:
+                self._done.set()
+                done_callbacks = list(self._done_callbacks)
+            for callback in done_callbacks:
+                try:
+                    callback(self)
+                except Exception:
+                    logger.exception("Done callback failed")
+
+
+def run_limits(executor, host_timeout=None):
+    """``(run_timeout, host_timeout)`` for one run of ``executor``.
+
+    A run given its own ``host_timeout`` gets a run deadline at least as
+    long, so the global limit does not cut its hosts short.
+    """
+    run_timeout = executor.run_timeout
+    if host_timeout is None:
+        return run_timeout, executor.host_timeout
+    if run_timeout is not None:
+        run_timeout = max(run_timeout, host_timeout)
+    return run_timeout, host_timeout
+
+
+class FanOutExecutor:
+    """Runs a command on many hosts through a bounded worker pool."""
+
+    def __init__(
+        self,
+        ssh_connector,
+        max_parallel=32,
+        host_timeout=None,
+        run_timeout=None,
+    ):
+        self.ssh_connector = ssh_connector
+        self.max_parallel = max_parallel
+        self.host_timeout = host_timeout
+        self.run_timeout = run_timeout
+        self._pool = ThreadPoolExecutor(
+            max_workers=max_parallel, thread_name_prefix="fanout"
+        )
+
+    def submit(self, command, hosts=None, spread=0, host_timeout=None):
+        """Start ``command`` on every host and return a ``RunHandle``.
+
+        With ``spread`` the host start times are staggered over that many
+        seconds (with jitter) instead of all starting at once.
+        ``host_timeout`` replaces the executor's for this run.
+        """
+        if hosts is None:
+            hosts = self.ssh_connector.read_hosts()
+        handle = RunHandle(hosts, *run_limits(self, host_timeout))
+        logger.debug(
+            "Running command '%s' on %d hosts (max_parallel=%d)",
+            command,
+            handle.total,
+            self.max_parallel,
+        )
+        # A few workers pull hosts as they go instead of one queued
+        # future per host, so a big fleet does not fill the pool's queue
+        starts = zip(handle.hosts, start_delays(handle.total, spread))
+        lock = threading.Lock()
+        for _ in range(min(self.max_parallel, handle.total)):
+            self._pool.submit(self._drain, handle, command, starts, lock)
+        return handle
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+    def _drain(self, handle, command, starts, lock):
+        while not handle.expired:
+            with lock:
+                start = next(starts, None)
+            if start is None:
+                return
+            host, delay = start
+            try:
+                self._run_host(handle, host, command, delay)
+            except Exception as e:
+                logger.exception(
+                    "Running on host failed", extra=log_context(host=host)
+                )
+                handle._set_result(HostResult(host, None, "", str(e), 0.0))
+
+    def _run_host(self, handle, host, command, delay=0):
+        wait = handle.started + delay - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        start = time.monotonic()
+        if handle.expired:
+            return
+        connector = self.ssh_connector
+        timer = None
+        timed_out = threading.Event()
+        if not connector.allow_connect(host):
+            handle._set_result(
+                HostResult(host, None, "", "circuit open, host skipped", 0.0)
+            )
+            return
+        client, session_id = connector.connect_to_host(host)
+        if client is None:
+            handle._set_result(
+                HostResult(
+                    host,
+                    None,
+                    "",
+                    "connection failed",
+                    time.monotonic() - start,
+                )
+            )
+            return
+        abort = functools.partial(
+            connector.abort_connection, client, session_id, host
+        )
+        try:
+            handle._track(host, abort)
+            if handle.host_timeout is not None:
+                remaining = handle.host_timeout - (time.monotonic() - start)
+                timer = threading.Timer(
+                    max(remaining, 0),
+                    self._expire_host,
+                    args=(abort, host, timed_out),
+                )
+                timer.daemon = True
+                timer.start()
+            output = connector.execute_command(
+                client, command, session_id, host
+            )
+        finally:
+            if timer is not None:
+                timer.cancel()
+            handle._track(host, None)
+            connector.close_connection(client, session_id, host)
+        duration = time.monotonic() - start
+        if timed_out.is_set():
+            result = HostResult(
+                host, None, "", "host deadline exceeded", duration
+            )
+        else:
+            result = to_host_result(host, output, duration)
+        handle._set_result(result)
+
+    def _expire_host(self, abort, host, timed_out):
+        logger.warning(
+            "Host deadline exceeded, closing session",
+            extra=log_context(host=host),
+        )
+        timed_out.set()
+        _abort_quietly(abort)
+
+
+def start_delays(count, spread):
+    """Offsets that spread ``count`` host starts evenly over ``spread`` s."""
+    if not spread or count == 0:
+        return itertools.repeat(0, count)
+    slot = spread / count
+    return (
+        i * slot + random.uniform(0, slot)  # nosec B311
+        for i in range(count)
+    )
+
+
+def to_host_result(host, output, duration):
+    """Normalise a command's return value into a ``HostResult``."""
+    if output is None:
+        return HostResult(host, 1, "", "command failed", duration)
+    return HostResult(
+        host,
+        getattr(output, "exit_status", 0),
+        # A CommandResult stays one, keeping its byte counts
+        output if isinstance(output, str) else str(output),
+        getattr(output, "stderr", ""),
+        duration,
+    )
+
+
+def _abort_quietly(abort):
+    try:
+        abort()
+    except Exception:
+        logger.debug("Error while closing client", exc_info=True)
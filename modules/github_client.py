@@ -1,32 +1,139 @@
 from github import Github
 from github.GithubException import GithubException
+from pathlib import Path
+import hashlib
+import json
 import logging
+import os
+import threading
+import time
+import requests
+
+from modules.metrics import METRICS
 
 # Create logger at module level
 logger = logging.getLogger("GitHubClient")
 
+DEFAULT_API_URL = "https://api.github.com"
+
+
+def git_blob_sha(data):
+    """Return the SHA git (and the GitHub contents API) uses for a blob."""
+    header = f"blob {len(data)}\0".encode()
+    return hashlib.sha1(header + data, usedforsecurity=False).hexdigest()
+
+
+class ResponseCache:
+    """On-disk cache of GitHub API responses keyed by URL, with ETags."""
+
+    def __init__(self, directory="data/github_cache"):
+        self.directory = Path(directory)
+        self.index_path = self.directory / "index.json"
+        self._lock = threading.Lock()
+        self._index = None
+
+    def get(self, url):
+        """Return ``(etag, body)`` for ``url`` or ``(None, None)``."""
+        with self._lock:
+            entry = self._load().get(url)
+        if entry is None:
+            return None, None
+        try:
+            body = (self.directory / entry["file"]).read_bytes()
+        except FileNotFoundError:
+            return None, None
+        return entry["etag"], body
+
+    def fresh(self, url, max_age):
+        """Return the body for ``url`` if it was fetched within ``max_age``."""
+        with self._lock:
+            entry = self._load().get(url)
+        if entry is None or time.time() - entry.get("fetched_at", 0) > max_age:
+            return None
+        return self.get(url)[1]
+
+    def put(self, url, etag, body):
+        name = hashlib.sha256(url.encode()).hexdigest()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / name).write_bytes(body)
+        with self._lock:
+            self._load()[url] = {
+                "etag": etag,
+                "file": name,
+                "fetched_at": time.time(),
+            }
+            self._save()
+
+    def touch(self, url):
+        """Mark the cached ``url`` as just confirmed unchanged."""
+        with self._lock:
+            entry = self._load().get(url)
+            if entry is not None:
+                entry["fetched_at"] = time.time()
+                self._save()
+
+    def _save(self):
+        tmp_path = self.index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _load(self):
+        if self._index is None:
+            try:
+                with open(self.index_path) as f:
+                    self._index = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._index = {}
+        return self._index
+
 
 class GitHubClient:
-    def __init__(self, token, repository):
+    def __init__(
+        self,
+        token,
+        repository,
+        api_url=DEFAULT_API_URL,
+        cache_dir="data/github_cache",
+    ):
         self.token = token
         self.repository_name = repository
-        self.github = None
-        self.repo = None
+        self.api_url = api_url.rstrip("/")
+        self.cache = ResponseCache(cache_dir)
+        self.session = requests.Session()
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+        self._github = None
+        self._repo = None
         logger.debug(
             "Initializing GitHubClient for repository: %s", repository
         )
-        self._authenticate()
+
+    @property
+    def github(self):
+        if self._github is None:
+            self._authenticate()
+        return self._github
+
+    @property
+    def repo(self):
+        """PyGithub repository, authenticated on first use."""
+        if self._repo is None:
+            self._authenticate()
+        return self._repo
 
     def _authenticate(self):
         logger.debug("Attempting to authenticate with GitHub")
         try:
-            self.github = Github(self.token)
-            user = self.github.get_user()
-            logger.info(f"Authenticated as GitHub user: {user.login}")
-            logger.debug("Attempting to connect to repository")
-            self.repo = self.github.get_repo(self.repository_name)
+            with METRICS.timer("github_auth"):
+                self._github = Github(self.token)
+                user = self._github.get_user()
+                logger.info("Authenticated as GitHub user: %s", user.login)
+                logger.debug("Attempting to connect to repository")
+                self._repo = self._github.get_repo(self.repository_name)
             logger.info(
-                f"Successfully connected to repository: {self.repository_name}"
+                "Successfully connected to repository: %s",
+                self.repository_name,
             )
         except GithubException as e:
             logger.debug(
@@ -41,37 +148,99 @@ class GitHubClient:
                 "Authentication failed. Please check your GitHub token"
             )
         elif e.status == 404:
-            logger.error(f"Repository {self.repository_name} not found")
+            logger.error("Repository %s not found", self.repository_name)
         else:
-            logger.error(f"GitHub API error: {str(e)}")
+            logger.error("GitHub API error: %s", e)
         logger.debug("Full exception data: %s", e.data)
 
     def get_module_contents(self, path="modules"):
         logger.debug("Fetching contents from path: %s", path)
         try:
-            contents = self.repo.get_contents(path)
+            repo = self.repo
+            with METRICS.timer("github_request"):
+                contents = repo.get_contents(path)
             logger.debug(
                 "Successfully retrieved %d items from %s", len(contents), path
             )
             return contents
         except GithubException as e:
-            logger.error(f"Failed to get contents from GitHub: {str(e)}")
+            logger.error("Failed to get contents from GitHub: %s", e)
             logger.debug(
                 "Error details - Status: %d, Data: %s", e.status, e.data
             )
             raise
 
-    def get_file_content(self, path):
+    def get_file_content(self, path, max_age=None):
         """Fetch raw content of a file from GitHub."""
-        logger.info(f"Fetching file content from path: {path}")
+        logger.info("Fetching file content from path: %s", path)
         try:
-            content = self.repo.get_contents(path)
-            if isinstance(content, list):
-                raise ValueError(f"Path {path} is a directory, not a file")
-
-            logger.debug(f"Successfully retrieved file: {path}")
-            return content.decoded_content.decode("utf-8")
+            content = self.get_file_bytes(path, max_age=max_age)
+            logger.debug("Successfully retrieved file: %s", path)
+            return content.decode("utf-8")
         except GithubException as e:
-            logger.error(f"Failed to get file content from GitHub: {str(e)}")
-            logger.debug(f"Error details - Status: {e.status}, Data: {e.data}")
+            logger.error("Failed to get file content from GitHub: %s", e)
+            logger.debug(
+                "Error details - Status: %s, Data: %s", e.status, e.data
+            )
             raise
+
+    def get_file_bytes(self, path, max_age=None):
+        """Fetch a file's raw bytes, served from cache when unchanged.
+
+        With ``max_age`` a copy fetched less than that many seconds ago is
+        used without asking GitHub at all.
+        """
+        return self._conditional_get(
+            self._contents_url(path),
+            "application/vnd.github.raw+json",
+            max_age=max_age,
+        )
+
+    def list_directory(self, path="modules"):
+        """List a directory as dicts with ``name``, ``path``, ``sha``..."""
+        body = self._conditional_get(
+            self._contents_url(path), "application/vnd.github+json"
+        )
+        entries = json.loads(body)
+        if not isinstance(entries, list):
+            raise ValueError(f"Path {path} is a file, not a directory")
+        return entries
+
+    def _contents_url(self, path):
+        return (
+            f"{self.api_url}/repos/{self.repository_name}/contents/"
+            f"{path.strip('/')}"
+        )
+
+    def _conditional_get(self, url, accept, max_age=None):
+        """GET ``url`` with If-None-Match; a 304 is answered from cache."""
+        cache_key = f"{accept} {url}"
+        if max_age:
+            cached = self.cache.fresh(cache_key, max_age)
+            if cached is not None:
+                logger.debug("Using recently fetched copy of %s", url)
+                METRICS.inc("github_cache_fresh")
+                return cached
+        etag, cached = self.cache.get(cache_key)
+        headers = {"Accept": accept}
+        if etag:
+            headers["If-None-Match"] = etag
+        with METRICS.timer("github_request"):
+            response = self.session.get(url, headers=headers, timeout=30)
+        if response.status_code == 304 and cached is not None:
+            logger.debug("Not modified, using cached copy of %s", url)
+            METRICS.inc("github_not_modified")
+            self.cache.touch(cache_key)
+            return cached
+        if response.status_code != 200:
+            try:
+                data = response.json()
+            except ValueError:
+                data = {"message": response.text}
+            raise GithubException(
+                response.status_code, data, dict(response.headers)
+            )
+        if response.headers.get("ETag"):
+            etag = response.headers["ETag"]
+            self.cache.put(cache_key, etag, response.content)
+        return response.content
@@ -0,0 +1,94 @@
+import json
+import logging
+import threading
+import time
+from pathlib import Path
+
+from modules.commander import host_of
+from modules.logging_setup import log_context
+from modules.state_file import update_json
+
+logger = logging.getLogger("HostFacts")
+
+# One round-trip for everything commands usually branch on
+FACTS_SCRIPT = (
+    ". /etc/os-release 2>/dev/null; "
+    'echo "os_id=$ID"; '
+    'echo "os_version=$VERSION_ID"; '
+    'echo "arch=$(uname -m)"; '
+    'echo "kernel=$(uname -r)"; '
+    "for pm in apt-get dnf yum zypper apk pacman; do "
+    "if command -v $pm >/dev/null 2>&1; then "
+    'echo "package_manager=$pm"; break; fi; done'
+)
+
+
+def gather_facts(client):
+    """Collect OS id/version, arch, kernel and package manager remotely."""
+    stdin, stdout, stderr = client.exec_command(FACTS_SCRIPT)
+    output = stdout.read().decode()
+    facts = {
+        "os_id": "",
+        "os_version": "",
+        "arch": "",
+        "kernel": "",
+        "package_manager": "",
+    }
+    for line in output.splitlines():
+        key, sep, value = line.partition("=")
+        if sep and key in facts:
+            facts[key] = value.strip().strip('"')
+    return facts
+
+
+def host_facts(client, refresh=False):
+    """Return facts for the host behind ``client``, cached when possible."""
+    cache = getattr(client, "av_facts", None)
+    if cache is None:
+        return gather_facts(client)
+    return cache.get(client, refresh=refresh)
+
+
+class HostFactsCache:
+    """Host facts kept in memory and under ``data/`` for ``ttl`` seconds."""
+
+    def __init__(self, path="data/host_facts.json", ttl=86400):
+        self.path = Path(path)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._facts = None
+
+    def get(self, client, refresh=False):
+        host = host_of(client)
+        with self._lock:
+            entry = self._load().get(host)
+        if (
+            not refresh
+            and entry is not None
+            and time.time() - entry["gathered_at"] < self.ttl
+        ):
+            return dict(entry["facts"])
+
+        logger.debug("Gathering host facts", extra=log_context(host=host))
+        facts = gather_facts(client)
+        with self._lock:
+            self._load()[host] = {"gathered_at": time.time(), "facts": facts}
+            self._save(host)
+        return dict(facts)
+
+    def invalidate(self, host):
+        with self._lock:
+            if self._load().pop(host, None) is not None:
+                self._save(host)
+
+    def _load(self):
+        if self._facts is None:
+            try:
+                with open(self.path) as f:
+                    self._facts = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._facts = {}
+        return self._facts
+
+    def _save(self, host):
+        self._facts = update_json(self.path, self._facts, [host])
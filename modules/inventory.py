@@ -0,0 +1,374 @@
+import ipaddress
+import json
+import logging
+import os
+import re
+import threading
+from pathlib import Path
+
+import yaml
+
+logger = logging.getLogger("Inventory")
+
+HOST_SETTINGS = ("user", "port", "key", "jump", "tags")
+
+# web[01:20].example.com, 10.0.0.[1:254], rack-[a:f] and [1:100:2]
+RANGE = re.compile(r"\[([0-9a-zA-Z]+):([0-9a-zA-Z]+)(?::(\d+))?\]")
+
+# Bump when the compiled layout changes so stale caches are rebuilt
+CACHE_VERSION = 1
+
+
+class Host(str):
+    """A host name that also carries its connection settings and tags.
+
+    It compares, hashes and formats as the bare name, so it can be used
+    anywhere a host string is expected.
+    """
+
+    def __new__(
+        cls,
+        name,
+        user=None,
+        port=None,
+        key=None,
+        tags=(),
+        groups=(),
+        vars=None,
+        jump=None,
+    ):
+        host = super().__new__(cls, name)
+        host.user = user
+        host.port = port
+        host.key = key
+        host.jump = jump
+        host.tags = frozenset(tags)
+        host.groups = tuple(groups)
+        host.vars = vars or {}
+        return host
+
+
+def expand_pattern(pattern):
+    """Lazily expand ranges (``web[01:20]``) and CIDR blocks in ``pattern``."""
+    if "/" in pattern:
+        try:
+            network = ipaddress.ip_network(pattern, strict=False)
+        except ValueError:
+            pass
+        else:
+            for address in network.hosts():
+                yield str(address)
+            return
+
+    parts = RANGE.split(pattern, maxsplit=1)
+    if len(parts) == 1:
+        yield pattern
+        return
+    head, start, end, step, tail = parts
+    for value in _range_values(start, end, step):
+        for rest in expand_pattern(tail):
+            yield head + value + rest
+
+
+def count_pattern(pattern):
+    """Number of hosts ``expand_pattern`` yields, without expanding."""
+    if "/" in pattern:
+        try:
+            network = ipaddress.ip_network(pattern, strict=False)
+        except ValueError:
+            pass
+        else:
+            if network.num_addresses <= 2:
+                return network.num_addresses
+            return network.num_addresses - 2
+    count = 1
+    for match in RANGE.finditer(pattern):
+        start, end, step = match.groups()
+        if start.isdigit():
+            count *= len(range(int(start), int(end) + 1, int(step or 1)))
+        else:
+            count *= len(range(ord(start), ord(end) + 1, int(step or 1)))
+    return count
+
+
+def _range_values(start, end, step):
+    step = int(step or 1)
+    if start.isdigit() and end.isdigit():
+        # Keep zero padding: [01:20] gives 01, 02, ... 20
+        width = len(start) if start.startswith("0") else 0
+        for number in range(int(start), int(end) + 1, step):
+            yield str(number).zfill(width)
+    elif len(start) == 1 and len(end) == 1:
+        for code in range(ord(start), ord(end) + 1, step):
+            yield chr(code)
+    else:
+        raise ValueError(f"Invalid host range [{start}:{end}]")
+
+
+def _parse_settings(pairs):
+    """Turn ``key=value`` tokens into host settings."""
+    settings = {}
+    for pair in pairs:
+        key, sep, value = pair.partition("=")
+        if not sep:
+            raise ValueError(f"Expected key=value, got {pair!r}")
+        settings[key] = value
+    return _normalise(settings)
+
+
+def _normalise(settings):
+    settings = dict(settings or {})
+    if "port" in settings:
+        settings["port"] = int(settings["port"])
+    if "tags" in settings:
+        tags = settings["tags"]
+        if isinstance(tags, str):
+            tags = [t for t in tags.split(",") if t]
+        settings["tags"] = sorted(str(t) for t in tags)
+    return settings
+
+
+class Inventory:
+    """Hosts from a YAML, INI or plain text inventory, iterated lazily.
+
+    Parsing an inventory produces a compiled form: host patterns with
+    their own settings plus the groups they are in. It is kept in memory
+    and in ``cache_path`` and rebuilt only when the inventory or one of
+    its includes changes (by mtime and size). Patterns are expanded only
+    while iterating, so ``10.0.0.0/8`` costs a single entry.
+
+    Host settings are ``user``, ``port``, ``key``, ``jump`` and ``tags``;
+    other keys end up in ``Host.vars``. Group vars apply to every host in
+    the group and its child groups, host settings win over group vars and
+    tags are combined.
+    """
+
+    def __init__(self, path, cache_path="data/inventory_cache.json"):
+        self.path = Path(path)
+        self.cache_path = Path(cache_path) if cache_path else None
+        self._compiled = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Compile the inventory if needed and return the compiled form."""
+        with self._lock:
+            if self._compiled is None or self._stale(self._compiled):
+                self._compiled = self._read_cache()
+                if self._compiled is None or self._stale(self._compiled):
+                    self._compiled = self._compile()
+                    self._write_cache(self._compiled)
+            return self._compiled
+
+    @property
+    def groups(self):
+        return sorted(self.load()["groups"])
+
+    def hosts(self, tags=None, groups=None):
+        """Yield ``Host`` objects, filtered by tags (all) and groups (any).
+
+        Nothing is collected along the way, so a host listed twice is
+        yielded twice; the executor drops duplicates.
+        """
+        compiled = self.load()
+        tags = set(tags or ())
+        groups = set(groups or ())
+        resolved = {}
+        for pattern, entry_groups, settings in compiled["entries"]:
+            key = tuple(entry_groups)
+            if key not in resolved:
+                resolved[key] = self._group_settings(compiled, entry_groups)
+            group_names, group_vars = resolved[key]
+            if groups and not groups.intersection(group_names):
+                continue
+            merged = dict(group_vars)
+            merged.update(settings)
+            host_tags = set(group_vars.get("tags", ()))
+            host_tags.update(settings.get("tags", ()))
+            if not tags.issubset(host_tags):
+                continue
+            merged["tags"] = host_tags
+            for name in expand_pattern(pattern):
+                yield self._host(name, group_names, merged)
+
+    def __iter__(self):
+        return self.hosts()
+
+    def count(self, tags=None, groups=None):
+        """Number of matching hosts; without filters nothing is expanded."""
+        compiled = self.load()
+        if tags or groups:
+            return sum(1 for _ in self.hosts(tags, groups))
+        return sum(count_pattern(e[0]) for e in compiled["entries"])
+
+    @staticmethod
+    def _host(name, groups, settings):
+        extra = {
+            k: v for k, v in settings.items() if k not in HOST_SETTINGS
+        }
+        return Host(
+            name,
+            user=settings.get("user"),
+            port=settings.get("port"),
+            key=settings.get("key"),
+            tags=settings.get("tags", ()),
+            groups=groups,
+            vars=extra,
+            jump=settings.get("jump"),
+        )
+
+    @staticmethod
+    def _group_settings(compiled, entry_groups):
+        """Groups (with ancestors) and the vars they give their hosts."""
+        all_groups = compiled["groups"]
+        names = []
+        pending = list(entry_groups)
+        while pending:
+            name = pending.pop(0)
+            if name in names:
+                continue
+            names.append(name)
+            pending.extend(all_groups.get(name, {}).get("parents", ()))
+        merged = dict(all_groups.get("all", {}).get("vars", {}))
+        tags = set(merged.get("tags", ()))
+        # Ancestors first so the closest group's vars win
+        for name in reversed(names):
+            group_vars = all_groups.get(name, {}).get("vars", {})
+            merged.update(group_vars)
+            tags.update(group_vars.get("tags", ()))
+        merged["tags"] = sorted(tags)
+        return tuple(n for n in names if n != "all"), merged
+
+    def _stale(self, compiled):
+        for path, stamp in compiled["files"].items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return True
+            if [stat.st_mtime_ns, stat.st_size] != stamp:
+                return True
+        return False
+
+    def _compile(self):
+        logger.debug("Compiling inventory %s", self.path)
+        compiled = {
+            "version": CACHE_VERSION,
+            "source": str(self.path.resolve()),
+            "files": {},
+            "groups": {},
+            "entries": [],
+        }
+        self._parse_file(self.path, compiled)
+        return compiled
+
+    def _parse_file(self, path, compiled):
+        path = Path(path).resolve()
+        if str(path) in compiled["files"]:
+            return
+        stat = path.stat()
+        compiled["files"][str(path)] = [stat.st_mtime_ns, stat.st_size]
+        if path.suffix in (".yaml", ".yml"):
+            self._parse_yaml(path, compiled)
+        else:
+            self._parse_ini(path, compiled)
+
+    def _parse_yaml(self, path, compiled):
+        with open(path) as f:
+            data = yaml.safe_load(f) or {}
+        for include in data.get("include", []):
+            self._parse_file(path.parent / include, compiled)
+        if data.get("vars"):
+            self._group(compiled, "all")["vars"].update(
+                _normalise(data["vars"])
+            )
+        for spec in data.get("hosts", []):
+            self._add_yaml_host(compiled, spec, [])
+        for name, group_spec in (data.get("groups") or {}).items():
+            group_spec = group_spec or {}
+            group = self._group(compiled, name)
+            group["vars"].update(_normalise(group_spec.get("vars")))
+            for child in group_spec.get("children", []):
+                self._group(compiled, child)["parents"].append(name)
+            for spec in group_spec.get("hosts", []):
+                self._add_yaml_host(compiled, spec, [name])
+
+    def _add_yaml_host(self, compiled, spec, groups):
+        if isinstance(spec, dict):
+            spec = dict(spec)
+            pattern = str(spec.pop("host"))
+            compiled["entries"].append([pattern, groups, _normalise(spec)])
+        else:
+            compiled["entries"].append([str(spec), groups, {}])
+
+    def _parse_ini(self, path, compiled):
+        # [group], [group:vars], [group:children] and [include] sections;
+        # lines before any section are ungrouped, so a plain hosts.txt is a
+        # valid inventory too
+        section, kind = None, None
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.split("#", 1)[0].strip()
+                if not line or line.startswith(";"):
+                    continue
+                if line.startswith("[") and line.endswith("]"):
+                    section, _, kind = line[1:-1].partition(":")
+                    if section != "include":
+                        self._group(compiled, section)
+                    continue
+                try:
+                    if section == "include":
+                        self._parse_file(path.parent / line, compiled)
+                    elif kind == "vars":
+                        key, _, value = line.partition("=")
+                        settings = _parse_settings(
+                            [f"{key.strip()}={value.strip()}"]
+                        )
+                        self._group(compiled, section)["vars"].update(
+                            settings
+                        )
+                    elif kind == "children":
+                        self._group(compiled, line)["parents"].append(section)
+                    else:
+                        pattern, *pairs = line.split()
+                        compiled["entries"].append(
+                            [
+                                pattern,
+                                [section] if section else [],
+                                _parse_settings(pairs),
+                            ]
+                        )
+                except ValueError as e:
+                    raise ValueError(f"{path}:{number}: {e}") from None
+
+    @staticmethod
+    def _group(compiled, name):
+        return compiled["groups"].setdefault(
+            name, {"vars": {}, "parents": []}
+        )
+
+    def _read_cache(self):
+        if self.cache_path is None:
+            return None
+        try:
+            with open(self.cache_path) as f:
+                caches = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        compiled = caches.get(str(self.path.resolve()))
+        if compiled is None or compiled.get("version") != CACHE_VERSION:
+            return None
+        return compiled
+
+    def _write_cache(self, compiled):
+        if self.cache_path is None:
+            return
+        try:
+            with open(self.cache_path) as f:
+                caches = json.load(f)
+        except (FileNotFoundError, ValueError):
+            caches = {}
+        caches[compiled["source"]] = compiled
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.cache_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(caches, f)
+        os.replace(tmp_path, self.cache_path)
@@ -0,0 +1,209 @@
+"""Streaming summary of an nginx access log (combined format).
+
+This module only uses the standard library and is shipped as-is to the
+hosts by ``CommandGetLogs(aggregate=True)``, where it reads the log on
+stdin and prints one JSON summary. The agent merges the summaries of the
+whole fleet, and uses the same parser itself when a host has no Python.
+Keep it runnable on Python 3.5.
+"""
+
+import json
+import re
+import sys
+from bisect import bisect_left
+from datetime import datetime
+
+# $remote_addr - $remote_user [$time_local] "$request" $status
+# $body_bytes_sent, optionally followed by referer, user agent and a
+# trailing $request_time
+LINE = re.compile(
+    rb'^\S+ \S+ \S+ \[([^\]]+)\] "(?:[A-Z]+ )?([^ "]*)[^"]*" '
+    rb"(\d{3}) (\d+|-)(?:.*? (\d+\.\d+))?\s*$"
+)
+
+# Request time upper bounds in seconds, 1ms to about 17 minutes in steps
+# of 19%
+LATENCY_BUCKETS = [0.001 * 2 ** (i / 4) for i in range(81)]
+
+TIME_FORMAT = "%d/%b/%Y:%H:%M:%S %z"
+
+
+class LogSummary:
+    """Mergeable summary of access log lines.
+
+    Counts requests by status and per ``bucket_seconds`` of time, sums the
+    bytes served and keeps a histogram of ``$request_time``.
+    Paths are kept in a bounded top-k sketch: once more than twice
+    ``top_k`` distinct paths are tracked, only the ``top_k`` most frequent
+    are kept, so the counts of rarely seen paths are underestimates.
+    """
+
+    def __init__(self, top_k=100, bucket_seconds=60):
+        self.top_k = top_k
+        self.bucket_seconds = bucket_seconds
+        self.lines = 0
+        self.parsed = 0
+        self.bytes_read = 0
+        self.bytes_sent = 0
+        self.status = {}
+        self.paths = {}
+        self.latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.timeline = {}
+        self._last_time = (None, None)
+
+    def add(self, line):
+        """Count one log line (bytes, including its newline).
+
+        A last line without its newline is still being written; it is
+        skipped, so an incremental checkpoint at ``bytes_read`` reads it
+        again once it is complete.
+        """
+        if not line.endswith(b"\n"):
+            return
+        self.lines += 1
+        self.bytes_read += len(line)
+        match = LINE.match(line)
+        if match is None:
+            return
+        self.parsed += 1
+        stamp, path, status, size, latency = match.groups()
+        status = status.decode()
+        self.status[status] = self.status.get(status, 0) + 1
+        if size != b"-":
+            self.bytes_sent += int(size)
+        path = path.split(b"?", 1)[0].decode("utf-8", "replace")
+        self.paths[path] = self.paths.get(path, 0) + 1
+        if len(self.paths) > 2 * self.top_k:
+            self._prune()
+        if latency is not None:
+            self.latency[bisect_left(LATENCY_BUCKETS, float(latency))] += 1
+        bucket = self._bucket(stamp)
+        if bucket is not None:
+            self.timeline[bucket] = self.timeline.get(bucket, 0) + 1
+
+    def feed(self, lines):
+        for line in lines:
+            self.add(line)
+        return self
+
+    def merge(self, other):
+        """Add another summary (object or ``to_dict()`` output) to this."""
+        if isinstance(other, dict):
+            other = LogSummary.from_dict(other)
+        self.lines += other.lines
+        self.parsed += other.parsed
+        self.bytes_read += other.bytes_read
+        self.bytes_sent += other.bytes_sent
+        for target, source in (
+            (self.status, other.status),
+            (self.paths, other.paths),
+            (self.timeline, other.timeline),
+        ):
+            for key, count in source.items():
+                target[key] = target.get(key, 0) + count
+        self.latency = [a + b for a, b in zip(self.latency, other.latency)]
+        if len(self.paths) > 2 * self.top_k:
+            self._prune()
+        return self
+
+    def latency_quantile(self, q):
+        """Upper bound of the bucket holding quantile ``q``, or None."""
+        total = sum(self.latency)
+        if not total:
+            return None
+        seen = 0
+        for index, count in enumerate(self.latency):
+            seen += count
+            if seen >= q * total:
+                break
+        if index < len(LATENCY_BUCKETS):
+            return LATENCY_BUCKETS[index]
+        return float("inf")
+
+    def top_paths(self, count=10):
+        return sorted(self.paths.items(), key=lambda item: -item[1])[:count]
+
+    def report(self, top=10):
+        """The summary as plain numbers, e.g. for printing or storing."""
+        return {
+            "requests": self.parsed,
+            "unparsed": self.lines - self.parsed,
+            "bytes_sent": self.bytes_sent,
+            "status": dict(sorted(self.status.items())),
+            "top_paths": self.top_paths(top),
+            "latency": {
+                "p50": self.latency_quantile(0.5),
+                "p90": self.latency_quantile(0.9),
+                "p99": self.latency_quantile(0.99),
+            },
+            "timeline": dict(sorted(self.timeline.items())),
+        }
+
+    def to_dict(self):
+        return {
+            "top_k": self.top_k,
+            "bucket_seconds": self.bucket_seconds,
+            "lines": self.lines,
+            "parsed": self.parsed,
+            "bytes_read": self.bytes_read,
+            "bytes_sent": self.bytes_sent,
+            "status": self.status,
+            "paths": self.paths,
+            "latency": self.latency,
+            # JSON object keys are strings
+            "timeline": {str(k): v for k, v in self.timeline.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        summary = cls(data["top_k"], data["bucket_seconds"])
+        for name in ("lines", "parsed", "bytes_read", "bytes_sent"):
+            setattr(summary, name, data[name])
+        summary.status = dict(data["status"])
+        summary.paths = dict(data["paths"])
+        summary.latency = list(data["latency"])
+        summary.timeline = {int(k): v for k, v in data["timeline"].items()}
+        return summary
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), separators=(",", ":"))
+
+    def _prune(self):
+        keep = self.top_paths(self.top_k)
+        self.paths = dict(keep)
+
+    def _bucket(self, stamp):
+        # Consecutive lines mostly share their timestamp
+        if stamp != self._last_time[0]:
+            try:
+                when = datetime.strptime(stamp.decode(), TIME_FORMAT)
+                seconds = int(when.timestamp())
+                bucket = seconds - seconds % self.bucket_seconds
+            except ValueError:
+                bucket = None
+            self._last_time = (stamp, bucket)
+        return self._last_time[1]
+
+
+def merge_results(results, top_k=100, bucket_seconds=60):
+    """Merge the summaries in ``HostResult``s; failed hosts are skipped."""
+    merged = LogSummary(top_k, bucket_seconds)
+    for result in results:
+        if result.exit_status == 0 and result.stdout:
+            merged.merge(LogSummary.from_json(result.stdout))
+    return merged
+
+
+def main(argv):
+    top_k = int(argv[1]) if len(argv) > 1 else 100
+    bucket_seconds = int(argv[2]) if len(argv) > 2 else 60
+    summary = LogSummary(top_k, bucket_seconds).feed(sys.stdin.buffer)
+    sys.stdout.write(summary.to_json() + "\n")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
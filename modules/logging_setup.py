@@ -0,0 +1,158 @@
+import atexit
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+from pathlib import Path
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(context)s%(message)s"
+
+_listener = None
+
+
+def log_context(session_id=None, host=None):
+    """``extra`` mapping that tags a record with its session and host."""
+    return {"session_id": session_id, "host": host}
+
+
+class ContextFilter(logging.Filter):
+    """Gives every record ``session_id``/``host`` fields and a text prefix.
+
+    Callers pass them as ``extra={"session_id": ..., "host": ...}``; the
+    text formatter renders them as ``[session][host]`` and the JSON
+    formatter as separate fields.
+    """
+
+    def filter(self, record):
+        record.session_id = getattr(record, "session_id", None)
+        record.host = getattr(record, "host", None)
+        parts = [str(p) for p in (record.session_id, record.host) if p]
+        record.context = "".join(f"[{p}]" for p in parts) + (
+            " " if parts else ""
+        )
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with context fields kept separate."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "session_id", None):
+            entry["session_id"] = record.session_id
+        if getattr(record, "host", None):
+            entry["host"] = str(record.host)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+def _gzip_namer(name):
+    return name + ".gz"
+
+
+def _gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+def setup_logging(
+    log_level=logging.INFO,
+    log_file="data/agent.log",
+    json_output=False,
+    rotation="size",
+    max_bytes=10 * 1024 * 1024,
+    backup_count=5,
+    when="midnight",
+    compress=True,
+):
+    """Route all logging through a queue to rotating file and console output.
+
+    Loggers only put records on an in-memory queue; a single listener thread
+    formats them and does the I/O, so SSH workers never block on the log
+    file. ``rotation`` is ``"size"`` (``max_bytes``) or ``"time"``
+    (``when``); rotated files are gzipped when ``compress`` is set.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    Path(log_file).parent.mkdir(parents=True, exist_ok=True)
+    if rotation == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            log_file, when=when, backupCount=backup_count
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=max_bytes, backupCount=backup_count
+        )
+    if compress:
+        file_handler.namer = _gzip_namer
+        file_handler.rotator = _gzip_rotator
+    console_handler = logging.StreamHandler()
+
+    formatter = (
+        JsonFormatter() if json_output else logging.Formatter(TEXT_FORMAT)
+    )
+    for handler in (file_handler, console_handler):
+        handler.setFormatter(formatter)
+        handler.addFilter(ContextFilter())
+
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+
+    # Clear any existing handlers to avoid duplication
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(log_level)
+
+    # Ensure all existing loggers respect the new level
+    for name in logging.root.manager.loggerDict:
+        logging.getLogger(name).setLevel(log_level)
+
+    _listener = logging.handlers.QueueListener(
+        log_queue,
+        file_handler,
+        console_handler,
+        respect_handler_level=True,
+    )
+    _listener.start()
+    return _listener
+
+
+def setup_worker_logging(log_queue, log_level=logging.INFO):
+    """Send a worker process's records to its parent over ``log_queue``.
+
+    The parent hands them to its own loggers, so worker output ends up in
+    the same files and format as everything else.
+    """
+    global _listener
+    # A forked worker inherits the parent's listener, but not its thread
+    _listener = None
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(log_level)
+
+
+def stop_logging():
+    """Flush queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
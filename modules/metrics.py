@@ -0,0 +1,292 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+logger = logging.getLogger("Metrics")
+
+# Seconds; spans a local loopback handshake up to a slow package upgrade
+BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+)
+
+PREFIX = "av_agent_"
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, counts, count, total, maximum):
+        self.counts = [a + b for a, b in zip(self.counts, counts)]
+        self.count += count
+        self.sum += total
+        self.max = max(self.max, maximum)
+
+    def quantile(self, q):
+        """Estimate a quantile from the bucket counts."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if index < len(self.buckets):
+                    return min(self.buckets[index], self.max)
+                return self.max
+        return self.max
+
+
+class Metrics:
+    """Timing histograms and counters, fleet-wide and per host.
+
+    Every observation is recorded twice: once for the fleet-wide view and
+    once under its host (sum and count only, to keep the number of series
+    down). ``render()`` returns the Prometheus text format, which
+    ``write()`` puts in a file (for the node exporter's textfile collector)
+    and ``serve()`` exposes over HTTP.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def observe(self, name, seconds, host=None):
+        with self._lock:
+            for key in self._keys(name, host):
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.observe(seconds)
+
+    def inc(self, name, value=1, host=None):
+        with self._lock:
+            for key in self._keys(name, host):
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, host=None):
+        """Observe how long the ``with`` block takes, even if it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, host)
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self, reset=False):
+        """Everything recorded so far as plain data, for ``merge()``."""
+        with self._lock:
+            histograms = {
+                key: (list(h.counts), h.count, h.sum, h.max)
+                for key, h in self._histograms.items()
+            }
+            counters = dict(self._counters)
+            if reset:
+                self._histograms.clear()
+                self._counters.clear()
+        return histograms, counters
+
+    def merge(self, snapshot):
+        """Add a ``snapshot()`` taken elsewhere, e.g. in a worker process."""
+        histograms, counters = snapshot
+        with self._lock:
+            for key, values in histograms.items():
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram()
+                histogram.merge(*values)
+            for key, value in counters.items():
+                self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = sorted(self._histograms.items(), key=_sort_key)
+            counters = sorted(self._counters.items(), key=_sort_key)
+            lines = []
+            typed = set()
+            for (name, host), histogram in histograms:
+                labels = _labels(host)
+                if host is None:
+                    metric = f"{PREFIX}{name}_seconds"
+                    lines.append(f"# TYPE {metric} histogram")
+                    cumulative = 0
+                    for bound, count in zip(
+                        self._bounds(histogram), histogram.counts
+                    ):
+                        cumulative += count
+                        lines.append(
+                            f"{metric}_bucket{_labels(le=bound)} "
+                            f"{cumulative}"
+                        )
+                else:
+                    # Buckets per host would multiply the series count by
+                    # the fleet size; sum and count give the per-host mean
+                    metric = f"{PREFIX}host_{name}_seconds"
+                    if metric not in typed:
+                        typed.add(metric)
+                        lines.append(f"# TYPE {metric} summary")
+                lines.append(f"{metric}_sum{labels} {histogram.sum:.6f}")
+                lines.append(f"{metric}_count{labels} {histogram.count}")
+            for (name, host), value in counters:
+                metric = f"{PREFIX}{name}_total"
+                if host is not None:
+                    metric = f"{PREFIX}host_{name}_total"
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric}{_labels(host)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Atomically write ``render()`` to ``path``."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, address="127.0.0.1"):
+        """Expose ``render()`` on ``http://address:port/metrics``."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header(
+                    "Content-Type", "text/plain; version=0.0.4"
+                )
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        self.stop_serving()
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        ).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", address, port)
+
+    def stop_serving(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def summary(self, host=None):
+        """Return ``[(phase, count, mean, p95, max)]`` for one host or all."""
+        with self._lock:
+            rows = [
+                (
+                    name,
+                    histogram.count,
+                    histogram.sum / histogram.count,
+                    histogram.quantile(0.95),
+                    histogram.max,
+                )
+                for (name, key_host), histogram in self._histograms.items()
+                if key_host == host and histogram.count
+            ]
+        return sorted(rows)
+
+    def summary_table(self, host=None):
+        """Format ``summary()`` as a plain text table."""
+        lines = [
+            f"{'phase':<20} {'count':>7} {'mean':>9} {'p95':>9} {'max':>9}"
+        ]
+        for name, count, mean, p95, maximum in self.summary(host):
+            lines.append(
+                f"{name:<20} {count:>7} {mean:>8.3f}s {p95:>8.3f}s "
+                f"{maximum:>8.3f}s"
+            )
+        with self._lock:
+            counters = sorted(
+                (name, value)
+                for (name, key_host), value in self._counters.items()
+                if key_host == host
+            )
+        for name, value in counters:
+            lines.append(f"{name:<20} {value:>7}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _keys(name, host):
+        if host is None:
+            return ((name, None),)
+        return ((name, None), (name, str(host)))
+
+    @staticmethod
+    def _bounds(histogram):
+        return [str(bound) for bound in histogram.buckets] + ["+Inf"]
+
+
+def percentile(values, q):
+    """Nearest-rank ``q`` quantile (0 to 1) of ``values``; 0.0 if empty."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(int(round(q * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def _sort_key(item):
+    (name, host), _ = item
+    return name, host or ""
+
+
+def _labels(host=None, le=None):
+    labels = []
+    if host is not None:
+        escaped = host.replace("\\", "\\\\").replace('"', '\\"')
+        labels.append(f'host="{escaped}"')
+    if le is not None:
+        labels.append(f'le="{le}"')
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+# Shared by the connectors, the GitHub client and main.py
+METRICS = Metrics()
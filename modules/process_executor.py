@@ -0,0 +1,294 @@
+import functools
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+import zlib
+from multiprocessing.reduction import ForkingPickler
+
+from modules.commander import Command, check_backend
+from modules.executor import (
+    FanOutExecutor,
+    HostResult,
+    RunHandle,
+    run_limits,
+)
+from modules.logging_setup import setup_worker_logging
+from modules.metrics import METRICS
+from modules.ssh_connector import SSHConnector
+
+logger = logging.getLogger("ProcessFanOutExecutor")
+
+
+def shard_of(host, count):
+    """Index of the worker that handles ``host``, stable across runs."""
+    return zlib.crc32(str(host).encode()) % count
+
+
+class ProcessFanOutExecutor:
+    """Shards hosts over worker processes so handshakes use every core.
+
+    paramiko's key exchange and ciphers hold the GIL, so a single process
+    tops out on one core once a few hundred sessions are active. Each
+    worker process runs its own connector, connection pool and thread (or
+    asyncio) executor with ``max_parallel / processes`` slots. A host is
+    always sent to the same worker, which keeps its pooled connection and
+    cached state there.
+
+    Results, log records and metrics stream back over queues into the
+    parent: ``submit()`` returns the same ``RunHandle`` as the other
+    backends. Commands are pickled to reach the workers. When the run
+    expires (``run_timeout``) the workers are told to close its sessions
+    too. If a worker dies, its unfinished hosts fail and later runs use the
+    remaining workers.
+    """
+
+    def __init__(
+        self,
+        ssh_connector,
+        connector_options,
+        processes=None,
+        backend="thread",
+        max_parallel=32,
+        host_timeout=None,
+        run_timeout=None,
+    ):
+        self.ssh_connector = ssh_connector
+        self.processes = processes or os.cpu_count() or 1
+        self.host_timeout = host_timeout
+        self.run_timeout = run_timeout
+        self.backend = backend
+        options = {
+            "connector": connector_options,
+            "backend": backend,
+            "executor": {
+                "max_parallel": max(1, -(-max_parallel // self.processes)),
+                "host_timeout": host_timeout,
+                "run_timeout": run_timeout,
+            },
+            "output_limits": Command.output_limits,
+            "log_level": logging.getLogger().getEffectiveLevel(),
+        }
+        # Forking a process that runs threads (logging, pools, metrics
+        # server) can copy a held lock, so workers always start fresh
+        context = multiprocessing.get_context("spawn")
+        self._messages = context.Queue()
+        self._logs = context.Queue()
+        self._workers = []
+        for index in range(self.processes):
+            tasks = context.Queue()
+            process = context.Process(
+                target=_worker,
+                args=(index, options, tasks, self._messages, self._logs),
+                name=f"fanout-worker-{index}",
+                daemon=True,
+            )
+            process.start()
+            self._workers.append((process, tasks))
+        self._dead = set()
+        self._closing = False
+        self._runs = {}
+        self._run_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(
+            target=self._read_messages, name="fanout-results", daemon=True
+        )
+        self._reader.start()
+        self._log_reader = threading.Thread(
+            target=self._read_logs, name="fanout-logs", daemon=True
+        )
+        self._log_reader.start()
+        logger.info(
+            "Started %d worker processes (%s backend)",
+            self.processes,
+            backend,
+        )
+
+    def submit(self, command, hosts=None, spread=0, host_timeout=None):
+        """Start ``command`` on every host and return a ``RunHandle``."""
+        check_backend(command, self.backend)
+        if hosts is None:
+            hosts = self.ssh_connector.read_hosts()
+        # Pickle once now, as the queues will, so an unpicklable command
+        # fails here and not in a queue's feeder thread
+        ForkingPickler.dumps(command)
+        handle = RunHandle(hosts, *run_limits(self, host_timeout))
+        with self._lock:
+            alive = [
+                index
+                for index in range(len(self._workers))
+                if index not in self._dead
+            ]
+        if not alive:
+            for host in handle.hosts:
+                handle._set_result(
+                    HostResult(host, None, "", "no worker processes", 0.0)
+                )
+            return handle
+
+        shards = {}
+        for host in handle.hosts:
+            index = alive[shard_of(host, len(alive))]
+            shards.setdefault(index, []).append(host)
+        run_id = next(self._run_ids)
+        if shards:
+            with self._lock:
+                self._runs[run_id] = (handle, shards)
+        logger.debug(
+            "Running command '%s' on %d hosts over %d processes",
+            command,
+            handle.total,
+            len(shards),
+        )
+        for index, shard in shards.items():
+            self._workers[index][1].put(
+                ("run", run_id, command, shard, spread, host_timeout)
+            )
+        handle.add_expire_callback(
+            functools.partial(self._expire_run, run_id, list(shards))
+        )
+        return handle
+
+    def _expire_run(self, run_id, indexes):
+        """Have the workers close what is left of an expired run."""
+        for index in indexes:
+            if index not in self._dead and not self._closing:
+                self._workers[index][1].put(("expire", run_id))
+
+    def shutdown(self, wait=True):
+        """Stop the workers once their runs are done."""
+        self._closing = True
+        for index, (process, tasks) in enumerate(self._workers):
+            if index not in self._dead:
+                tasks.put(None)
+        if not wait:
+            return
+        for process, _ in self._workers:
+            process.join()
+        # Workers flushed their queues before exiting, so these come last
+        self._messages.put(None)
+        self._logs.put(None)
+        self._reader.join()
+        self._log_reader.join()
+
+    def _read_messages(self):
+        while True:
+            try:
+                message = self._messages.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if message is None:
+                return
+            run_id, result, snapshot = message
+            METRICS.merge(snapshot)
+            with self._lock:
+                run = self._runs.get(run_id)
+            if run is None:
+                continue
+            handle = run[0]
+            handle._set_result(result)
+            if handle.done():
+                with self._lock:
+                    self._runs.pop(run_id, None)
+
+    def _read_logs(self):
+        while True:
+            record = self._logs.get()
+            if record is None:
+                return
+            logging.getLogger(record.name).handle(record)
+
+    def _check_workers(self):
+        if self._closing:
+            return
+        for index, (process, _) in enumerate(self._workers):
+            if index in self._dead or process.is_alive():
+                continue
+            logger.error(
+                "Worker process %d exited with code %s",
+                index,
+                process.exitcode,
+            )
+            with self._lock:
+                self._dead.add(index)
+                runs = list(self._runs.items())
+            for run_id, (handle, shards) in runs:
+                # Hosts that already reported keep their result
+                for host in shards.get(index, ()):
+                    handle._set_result(
+                        HostResult(
+                            host,
+                            None,
+                            "",
+                            "worker process died",
+                            time.monotonic() - handle.started,
+                        )
+                    )
+                if handle.done():
+                    with self._lock:
+                        self._runs.pop(run_id, None)
+
+
+def _create_executor(options):
+    executor_options = options["executor"]
+    if options["backend"] == "asyncio":
+        from modules.async_ssh_connector import (
+            AsyncFanOutExecutor,
+            AsyncSSHConnector,
+        )
+
+        connector = AsyncSSHConnector(**options["connector"])
+        return AsyncFanOutExecutor(connector, **executor_options)
+    connector = SSHConnector(**options["connector"])
+    return FanOutExecutor(connector, **executor_options)
+
+
+def _worker(index, options, tasks, messages, logs):
+    """Worker process: run the shards it is sent until it gets None."""
+    # Ctrl-C goes to the whole process group; the parent stops us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    setup_worker_logging(logs, options["log_level"])
+    Command.output_limits = options["output_limits"]
+    executor = _create_executor(options)
+    connector = executor.ssh_connector
+
+    def send(run_id, result):
+        messages.put((run_id, result, METRICS.snapshot(reset=True)))
+
+    def finish(_):
+        connector.flush_host_keys()
+        connector.flush_breaker()
+
+    handles = {}
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        if task[0] == "expire":
+            handle = handles.get(task[1])
+            if handle is not None:
+                handle.expire()
+            continue
+        _, run_id, command, hosts, spread, host_timeout = task
+        connector.evict_idle()
+        handle = executor.submit(
+            command, hosts, spread=spread, host_timeout=host_timeout
+        )
+        handles[run_id] = handle
+        handle.add_result_callback(
+            lambda result, run_id=run_id: send(run_id, result)
+        )
+        handle.add_done_callback(finish)
+        handle.add_done_callback(
+            lambda _, run_id=run_id: handles.pop(run_id, None)
+        )
+
+    executor.shutdown(wait=True)
+    connector.shutdown()
+    messages.put((None, None, METRICS.snapshot(reset=True)))
+    logger.debug("Worker process %d stopped", index)
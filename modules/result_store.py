@@ -0,0 +1,322 @@
+import argparse
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from contextlib import closing
+from pathlib import Path
+
+from modules import metrics
+
+logger = logging.getLogger("ResultStore")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id TEXT PRIMARY KEY,
+    command TEXT NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL,
+    host_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL REFERENCES runs(id),
+    host_id INTEGER NOT NULL REFERENCES hosts(id),
+    status TEXT NOT NULL,
+    exit_code INTEGER,
+    duration REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    stdout BLOB,
+    stderr BLOB,
+    stdout_bytes INTEGER NOT NULL,
+    truncated INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_command ON runs(command, started_at);
+CREATE INDEX IF NOT EXISTS results_run ON results(run_id, status);
+CREATE INDEX IF NOT EXISTS results_host ON results(host_id, finished_at);
+"""
+
+
+def result_status(exit_status):
+    if exit_status == 0:
+        return "ok"
+    if exit_status is None:
+        return "error"
+    return "failed"
+
+
+class ResultStore:
+    """SQLite store of runs and per-host results under ``data/``.
+
+    Writes are queued and committed in batches by one background thread,
+    so workers never wait on the disk. Output is truncated to
+    ``max_output`` bytes and zlib-compressed before it is stored.
+    """
+
+    def __init__(
+        self,
+        path="data/results.db",
+        max_output=64 * 1024,
+        batch_size=500,
+        flush_interval=1.0,
+    ):
+        self.path = Path(path)
+        self.max_output = max_output
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(
+            target=self._write_loop, name="result-store", daemon=True
+        )
+        self._writer.start()
+
+    def start_run(self, command, host_count):
+        """Register a new run and return its id."""
+        run_id = uuid.uuid4().hex
+        self._queue.put(
+            (
+                "INSERT INTO runs (id, command, started_at, host_count) "
+                "VALUES (?, ?, ?, ?)",
+                (run_id, command, time.time(), host_count),
+            )
+        )
+        return run_id
+
+    def record(self, run_id, result):
+        """Queue a ``HostResult`` for ``run_id``."""
+        text = result.stdout or ""
+        stdout = text.encode()
+        stderr = (result.stderr or "").encode()
+        # A CommandResult counts all the command printed, not only the
+        # (possibly truncated) text it kept
+        stdout_bytes = getattr(text, "stdout_bytes", len(stdout))
+        truncated = getattr(text, "truncated", False)
+        self._queue.put(
+            (
+                "INSERT OR IGNORE INTO hosts (name) VALUES (?)",
+                (str(result.host),),
+            )
+        )
+        self._queue.put(
+            (
+                "INSERT INTO results (run_id, host_id, status, exit_code, "
+                "duration, finished_at, stdout, stderr, stdout_bytes, "
+                "truncated) VALUES "
+                "(?, (SELECT id FROM hosts WHERE name = ?), "
+                "?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    run_id,
+                    str(result.host),
+                    result_status(result.exit_status),
+                    result.exit_status,
+                    result.duration,
+                    time.time(),
+                    zlib.compress(stdout[: self.max_output]),
+                    zlib.compress(stderr[: self.max_output]),
+                    stdout_bytes,
+                    int(truncated or len(stdout) > self.max_output),
+                ),
+            )
+        )
+
+    def finish_run(self, run_id):
+        self._queue.put(
+            (
+                "UPDATE runs SET finished_at = ? WHERE id = ?",
+                (time.time(), run_id),
+            )
+        )
+
+    def flush(self):
+        """Block until everything queued so far is committed."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+
+    def last_run(self, command=None):
+        """Return the most recent run as a dict, optionally per command."""
+        query = "SELECT * FROM runs"
+        params = ()
+        if command:
+            query += " WHERE command = ?"
+            params = (command,)
+        query += " ORDER BY started_at DESC LIMIT 1"
+        with closing(self._connect()) as conn:
+            row = conn.execute(query, params).fetchone()
+        return dict(row) if row else None
+
+    def failed_hosts(self, command=None, run_id=None):
+        """Hosts that did not succeed in ``run_id`` (default: last run)."""
+        if run_id is None:
+            run = self.last_run(command)
+            if run is None:
+                return []
+            run_id = run["id"]
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT hosts.name, results.status, results.exit_code, "
+                "results.stderr FROM results "
+                "JOIN hosts ON hosts.id = results.host_id "
+                "WHERE results.run_id = ? AND results.status != 'ok' "
+                "ORDER BY hosts.name",
+                (run_id,),
+            ).fetchall()
+        return [
+            {
+                "host": row["name"],
+                "status": row["status"],
+                "exit_code": row["exit_code"],
+                "stderr": zlib.decompress(row["stderr"]).decode(
+                    errors="replace"
+                ),
+            }
+            for row in rows
+        ]
+
+    def duration_percentiles(self, percentile=0.95, command=None, since=None):
+        """Return ``{host: duration}`` at ``percentile`` for each host."""
+        query = (
+            "SELECT hosts.name, results.duration FROM results "
+            "JOIN hosts ON hosts.id = results.host_id "
+            "JOIN runs ON runs.id = results.run_id WHERE 1 = 1"
+        )
+        params = []
+        if command:
+            query += " AND runs.command = ?"
+            params.append(command)
+        if since:
+            query += " AND results.finished_at >= ?"
+            params.append(since)
+        durations = {}
+        with closing(self._connect()) as conn:
+            for name, duration in conn.execute(query, params):
+                durations.setdefault(name, []).append(duration)
+        return {
+            host: metrics.percentile(values, percentile)
+            for host, values in durations.items()
+        }
+
+    def output(self, run_id, host):
+        """Return the stored (possibly truncated) stdout of one host."""
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT results.stdout FROM results "
+                "JOIN hosts ON hosts.id = results.host_id "
+                "WHERE results.run_id = ? AND hosts.name = ?",
+                (run_id, host),
+            ).fetchone()
+        if row is None:
+            return None
+        return zlib.decompress(row["stdout"]).decode(errors="replace")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _write_loop(self):
+        conn = self._connect()
+        closing = False
+        while not closing:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                if item is None or isinstance(item, threading.Event):
+                    break
+
+            statements = []
+            waiters = []
+            for item in batch:
+                if item is None:
+                    closing = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    statements.append(item)
+            try:
+                self._write(conn, statements)
+            finally:
+                # Set even if writing failed, or flush() would never return
+                for waiter in waiters:
+                    waiter.set()
+        conn.close()
+
+    def _write(self, conn, statements):
+        """Commit ``statements`` in one transaction, or one by one."""
+        try:
+            with conn:
+                for statement in statements:
+                    conn.execute(*statement)
+            return
+        except Exception:
+            logger.exception(
+                "Failed to write %d statements, retrying one by one",
+                len(statements),
+            )
+        # Only the statements that fail again are lost
+        for statement in statements:
+            try:
+                with conn:
+                    conn.execute(*statement)
+            except Exception:
+                logger.exception("Failed to write %s", statement[0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query agent run results.")
+    parser.add_argument("--db", default="data/results.db")
+    subparsers = parser.add_subparsers(dest="query", required=True)
+    failed = subparsers.add_parser(
+        "failed", help="Hosts that failed the last run"
+    )
+    failed.add_argument("--command", help="e.g. CommandUpdate")
+    durations = subparsers.add_parser(
+        "durations", help="Duration percentile per host"
+    )
+    durations.add_argument("--command", help="e.g. CommandUpdate")
+    durations.add_argument("--percentile", type=float, default=0.95)
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.db)
+    try:
+        if args.query == "failed":
+            for row in store.failed_hosts(args.command):
+                print(
+                    f"{row['host']}\t{row['status']}\t{row['exit_code']}\t"
+                    f"{row['stderr'].strip()}"
+                )
+        else:
+            percentiles = store.duration_percentiles(
+                args.percentile, args.command
+            )
+            for host, duration in sorted(percentiles.items()):
+                print(f"{host}\t{duration:.3f}s")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
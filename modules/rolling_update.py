@@ -0,0 +1,226 @@
+import logging
+import math
+import threading
+import time
+
+from modules.metrics import percentile
+
+logger = logging.getLogger("RollingUpdate")
+
+
+def batch_count(size, total):
+    """Resolve a batch size like ``10`` or ``"10%"`` against ``total``."""
+    if isinstance(size, str) and size.endswith("%"):
+        return max(1, math.ceil(total * float(size[:-1]) / 100))
+    return max(1, int(size))
+
+
+class BatchStats:
+    def __init__(self, number, hosts, results, duration):
+        self.number = number
+        self.size = len(hosts)
+        self.failures = sum(1 for r in results if r.exit_status != 0)
+        self.failure_rate = self.failures / self.size if self.size else 0.0
+        durations = [r.duration for r in results]
+        self.p90 = percentile(durations, 0.9)
+        self.duration = duration
+
+
+class RollingUpdate:
+    """Runs a command over the fleet in batches, adapting the batch size.
+
+    The first ``canary`` hosts run on their own and set the latency
+    baseline. After that batches start at ``batch_size`` (a host count or
+    a percentage of the fleet) and grow by that step after every healthy
+    batch, up to ``max_batch_size``. A batch whose failure rate exceeds
+    ``backoff_failure_rate`` or whose p90 duration exceeds
+    ``latency_factor`` times the baseline halves the next batch instead.
+    The rollout aborts once more than ``max_failure_rate`` of the hosts
+    done so far (and at least ``min_hosts`` of them) have failed;
+    the remaining hosts are reported as skipped.
+
+    Batches run with ``host_timeout`` as their per-host deadline and are
+    recorded under the result-store run ``run_id`` when it is set.
+
+    ``start()`` runs it in the background; like a RunHandle it has
+    ``done()``, ``wait()`` and ``add_done_callback()``.
+    """
+
+    def __init__(
+        self,
+        agent,
+        command,
+        hosts,
+        batch_size="10%",
+        max_batch_size="25%",
+        canary=1,
+        pause=0,
+        backoff_failure_rate=0.05,
+        latency_factor=2.0,
+        max_failure_rate=0.1,
+        min_hosts=5,
+        host_timeout=None,
+        run_id=None,
+    ):
+        self.agent = agent
+        self.command = command
+        self.hosts = list(dict.fromkeys(hosts))
+        total = len(self.hosts)
+        self.step = batch_count(batch_size, total)
+        self.max_batch_size = max(
+            batch_count(max_batch_size, total), self.step
+        )
+        self.canary = canary
+        self.pause = pause
+        self.backoff_failure_rate = backoff_failure_rate
+        self.latency_factor = latency_factor
+        self.max_failure_rate = max_failure_rate
+        self.min_hosts = min_hosts
+        self.host_timeout = host_timeout
+        self.run_id = run_id
+        self.batches = []
+        self.results = []
+        self.skipped = []
+        self.aborted = False
+        self.baseline_p90 = None
+        self._stop = threading.Event()
+        self._done = threading.Event()
+        self._done_callbacks = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.run, name="rolling-update", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def run(self):
+        """Roll the command out over every host; blocks until finished."""
+        try:
+            self._run()
+        finally:
+            with self._lock:
+                self._done.set()
+                callbacks = list(self._done_callbacks)
+            for callback in callbacks:
+                try:
+                    callback(self)
+                except Exception:
+                    logger.exception("Done callback failed")
+        return self
+
+    def stop(self):
+        """Finish the current batch and skip the rest."""
+        self._stop.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._done_callbacks.append(callback)
+                return
+        callback(self)
+
+    @property
+    def failures(self):
+        return sum(1 for r in self.results if r.exit_status != 0)
+
+    def _run(self):
+        remaining = list(self.hosts)
+        size = min(self.canary, self.step) if self.canary else self.step
+        logger.info(
+            "Rolling out to %d hosts in batches of %d (max %d)",
+            len(remaining),
+            self.step,
+            self.max_batch_size,
+        )
+        while remaining and not self._stop.is_set():
+            batch, remaining = remaining[:size], remaining[size:]
+            stats = self._run_batch(batch)
+            if stats is None:
+                remaining = batch + remaining
+                break
+
+            if self._should_abort():
+                self.aborted = True
+                logger.error(
+                    "Aborting rollout: %d of %d hosts failed",
+                    self.failures,
+                    len(self.results),
+                )
+                break
+            size = self._next_size(size, stats)
+            if remaining and self.pause:
+                self._stop.wait(self.pause)
+
+        self.skipped = remaining
+        logger.info(
+            "Rollout finished: %d hosts done, %d failed, %d skipped",
+            len(self.results),
+            self.failures,
+            len(self.skipped),
+        )
+
+    def _run_batch(self, batch):
+        number = len(self.batches) + 1
+        logger.info("Starting batch %d with %d hosts", number, len(batch))
+        started = time.monotonic()
+        handle = self.agent.run_ssh_command_async(
+            self.command,
+            hosts=batch,
+            host_timeout=self.host_timeout,
+            run_id=self.run_id,
+        )
+        if handle is None:
+            logger.error("Batch %d could not be started", number)
+            self.aborted = True
+            return None
+        results = handle.results()
+        stats = BatchStats(
+            number, batch, results, time.monotonic() - started
+        )
+        self.results.extend(results)
+        self.batches.append(stats)
+        if self.baseline_p90 is None and stats.failures < stats.size:
+            self.baseline_p90 = stats.p90
+        logger.info(
+            "Batch %d done in %.1fs: %d/%d failed, p90 %.1fs",
+            number,
+            stats.duration,
+            stats.failures,
+            stats.size,
+            stats.p90,
+        )
+        return stats
+
+    def _should_abort(self):
+        done = len(self.results)
+        if done < self.min_hosts:
+            # Too few hosts to judge a rate, unless all of them failed
+            return done > 0 and self.failures == done and done >= self.canary
+        return self.failures / done > self.max_failure_rate
+
+    def _next_size(self, size, stats):
+        slow = (
+            self.baseline_p90
+            and stats.p90 > self.latency_factor * self.baseline_p90
+        )
+        if stats.failure_rate > self.backoff_failure_rate or slow:
+            new_size = max(1, size // 2)
+            logger.warning(
+                "Batch %d was %s, backing off to %d hosts",
+                stats.number,
+                "slow" if slow else "failing",
+                new_size,
+            )
+            return new_size
+        if stats.number == 1 and self.canary:
+            return self.step
+        return min(self.max_batch_size, size + self.step)
@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+
+import schedule
+
+from modules.command_get_logs import CommandGetLogs
+from modules.command_update import CommandUpdate
+from modules.commander import (
+    EchoCommand,
+    ListFilesCommand,
+    PlainCommand,
+    check_backend,
+)
+
+logger = logging.getLogger("JobScheduler")
+
+# Command names usable in the ``jobs`` section of config.yaml
+COMMANDS = {
+    "update": CommandUpdate,
+    "get_logs": CommandGetLogs,
+    "echo": EchoCommand,
+    "plain": PlainCommand,
+    "list_files": ListFilesCommand,
+}
+
+
+def build_command(spec):
+    """Create a Command from a job spec like ``{"command": "echo", ...}``."""
+    name = spec["command"]
+    if name not in COMMANDS:
+        raise ValueError(f"Unknown command in job spec: {name}")
+    return COMMANDS[name](**spec.get("args", {}))
+
+
+class Job:
+    def __init__(
+        self,
+        name,
+        command,
+        interval,
+        jitter=0,
+        spread=0,
+        tags=None,
+        groups=None,
+        rolling=False,
+    ):
+        self.name = name
+        self.command = command
+        self.interval = interval
+        self.jitter = jitter
+        self.spread = spread
+        self.tags = tags
+        self.groups = groups
+        self.rolling = rolling
+        self.handle = None
+        self.pending = False
+        self.lock = threading.RLock()
+
+
+class JobScheduler:
+    """Runs jobs on the agent at their interval, never overlapping a job.
+
+    Each tick starts a fan-out on the shared Agent, so pools and caches are
+    reused between runs. Interval ``jitter`` keeps many agents from firing
+    at the same second and ``spread`` staggers host starts within a run.
+    If a job is still running when it is due again, the missed ticks are
+    coalesced into a single run started as soon as the current one ends.
+    """
+
+    def __init__(self, agent):
+        self.agent = agent
+        self.jobs = []
+        self._scheduler = schedule.Scheduler()
+        self._stop = threading.Event()
+
+    @classmethod
+    def from_config(cls, agent, config):
+        scheduler = cls(agent)
+        interval = config.get("check_interval", 300)
+        jitter = config.get("jitter", 0)
+        spread = config.get("host_spread", 0)
+        rolling = config.get("rolling_update") or {}
+        for spec in config.get("jobs", []):
+            if spec.get("rolling") and spec["command"] == "update":
+                # Rolling updates use the rolling_update timeout and proxy
+                args = {
+                    "timeout": rolling.get("timeout", 120),
+                    "proxy": rolling.get("proxy"),
+                }
+                args.update(spec.get("args", {}))
+                spec = dict(spec, args=args)
+            scheduler.add_job(
+                spec.get("name", spec["command"]),
+                build_command(spec),
+                interval=spec.get("interval", interval),
+                jitter=spec.get("jitter", jitter),
+                spread=spec.get("spread", spread),
+                tags=spec.get("tags"),
+                groups=spec.get("groups"),
+                rolling=spec.get("rolling", False),
+            )
+        return scheduler
+
+    def add_job(
+        self,
+        name,
+        command,
+        interval,
+        jitter=0,
+        spread=0,
+        tags=None,
+        groups=None,
+        rolling=False,
+    ):
+        # Refuse the job now rather than on every tick
+        check_backend(command, self.agent.config.get("backend", "thread"))
+        job = Job(
+            name, command, interval, jitter, spread, tags, groups, rolling
+        )
+        self.jobs.append(job)
+        every = self._scheduler.every(interval)
+        if jitter:
+            every = every.to(interval + jitter)
+        every.seconds.do(self._tick, job).tag(name)
+        logger.info(
+            "Scheduled job %s every %ss (+%ss jitter)", name, interval, jitter
+        )
+        return job
+
+    def run_forever(self, run_immediately=True):
+        """Block running due jobs until ``stop()`` is called."""
+        if run_immediately:
+            for job in self.jobs:
+                self._tick(job)
+        while not self._stop.is_set():
+            self._scheduler.run_pending()
+            idle = self._scheduler.idle_seconds
+            self._stop.wait(1 if idle is None else min(max(idle, 0), 1))
+
+    def stop(self):
+        self._stop.set()
+        self._scheduler.clear()
+
+    def _tick(self, job):
+        with job.lock:
+            if job.handle is not None and not job.handle.done():
+                if not job.pending:
+                    logger.warning(
+                        "Job %s is still running, coalescing this tick",
+                        job.name,
+                    )
+                job.pending = True
+                return
+            job.pending = False
+            self._start(job)
+
+    def _start(self, job):
+        logger.info("Starting job %s", job.name)
+        started = time.monotonic()
+        if job.rolling:
+            handle = self.agent.run_rolling_update(
+                job.command, tags=job.tags, groups=job.groups
+            )
+        else:
+            handle = self.agent.run_ssh_command_async(
+                job.command, job.spread, tags=job.tags, groups=job.groups
+            )
+        job.handle = handle
+        if handle is not None:
+            handle.add_done_callback(
+                lambda _: self._finished(job, time.monotonic() - started)
+            )
+
+    def _finished(self, job, duration):
+        logger.info("Job %s finished in %.1fs", job.name, duration)
+        with job.lock:
+            if job.pending and not self._stop.is_set():
+                job.pending = False
+                self._start(job)
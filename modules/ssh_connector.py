@@ -1,96 +1,379 @@
 import paramiko
 import logging
+import time
 import uuid
+from modules.bastion import BastionPool
+from modules.circuit_breaker import CircuitBreaker, backoff_delay
 from modules.commander import Command
+from modules.connection_pool import ConnectionPool
+from modules.credentials import CredentialStore
+from modules.host_facts import HostFactsCache
+from modules.inventory import Inventory
+from modules.logging_setup import log_context
+from modules.metrics import METRICS
 import os
+import socket
+
+
+def record_output(output, host):
+    """Count a command's output (before truncation) in the metrics."""
+    if output is None:
+        return
+    size = getattr(output, "stdout_bytes", len(output))
+    METRICS.inc("output_bytes", size, host=host)
+    if getattr(output, "truncated", False):
+        METRICS.inc("output_truncated", host=host)
 
 
 class SSHConnector:
     def __init__(
-        self, hosts_file=None, private_key_path=None, hosts_list=None
+        self,
+        hosts_file=None,
+        private_key_path=None,
+        hosts_list=None,
+        pool_size=0,
+        pool_max_idle=600,
+        keepalive=30,
+        facts_ttl=86400,
+        port=22,
+        known_hosts_file=None,
+        inventory=None,
+        connect_timeout=10,
+        banner_timeout=15,
+        auth_timeout=15,
+        connect_retries=2,
+        retry_backoff=1.0,
+        breaker_threshold=3,
+        breaker_cooldown=900,
+        jump_host=None,
+        jump_max_channels=32,
     ):
         self.logger = logging.getLogger(__name__)
         self.hosts_file = hosts_file
         self.hosts_list = hosts_list
+        self.inventory = None
+        if inventory or hosts_file:
+            self.inventory = Inventory(inventory or hosts_file)
         self.private_key_path = private_key_path
-        self.known_hosts_file = os.path.expanduser("~/.ssh/known_hosts")
+        self.username = "jacko"
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.banner_timeout = banner_timeout
+        self.auth_timeout = auth_timeout
+        self.connect_retries = connect_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = CircuitBreaker(
+            failure_threshold=breaker_threshold, cooldown=breaker_cooldown
+        )
+        self.known_hosts_file = os.path.expanduser(
+            known_hosts_file or "~/.ssh/known_hosts"
+        )
+        self.credentials = CredentialStore(self.known_hosts_file)
+        self.facts = HostFactsCache(ttl=facts_ttl)
+        # Hosts without their own ``jump`` setting go through this one
+        self.jump_host = jump_host
+        self.bastions = BastionPool(
+            self._open_client,
+            max_channels=jump_max_channels,
+            max_idle=pool_max_idle,
+            keepalive=keepalive,
+        )
+        self.pool = None
+        if pool_size:
+            self.pool = ConnectionPool(
+                self._open_client,
+                max_size=pool_size,
+                max_idle=pool_max_idle,
+                keepalive=keepalive,
+            )
 
-    def read_hosts(self):
-        """Reads the hosts from either the hosts file or the provided list."""
+    def read_hosts(self, tags=None, groups=None):
+        """Reads the hosts from either the inventory or the provided list.
+
+        Inventory hosts are yielded lazily, optionally only those carrying
+        all ``tags`` or in one of ``groups``.
+        """
         if self.hosts_list is not None:
             self.logger.debug("Using provided hosts list")
             return self.hosts_list
+        if self.inventory is None:
+            self.logger.error("No hosts file or inventory configured")
+            return []
 
         try:
-            with open(self.hosts_file, "r") as file:
-                hosts = file.read().splitlines()
-            self.logger.info(f"Loaded hosts from {self.hosts_file}")
-            return hosts
+            self.inventory.load()
+            self.logger.info("Loaded hosts from %s", self.inventory.path)
+            return self.inventory.hosts(tags=tags, groups=groups)
         except FileNotFoundError:
-            self.logger.error(f"Hosts file {self.hosts_file} not found.")
+            self.logger.error("Hosts file %s not found.", self.inventory.path)
             return []
         except Exception as e:
             self.logger.error(
-                f"Error reading hosts file {self.hosts_file}: {e}"
+                "Error reading hosts file %s: %s", self.inventory.path, e
             )
             return []
 
     def add_host_key(self, client, hostname, session_id):
+        """Record the server key; written to disk by flush_host_keys()."""
         host_key = client.get_transport().get_remote_server_key()
-        host_keys = paramiko.HostKeys()
-        if os.path.exists(self.known_hosts_file):
-            host_keys.load(self.known_hosts_file)
-        host_keys.add(hostname, host_key.get_name(), host_key)
-        host_keys.save(self.known_hosts_file)
+        if self.credentials.add_host_key(
+            self._known_hosts_name(hostname), host_key
+        ):
+            self.logger.debug(
+                "Host key queued for known_hosts",
+                extra=log_context(session_id, hostname),
+            )
+
+    def flush_host_keys(self):
+        """Write host keys learned during this run to known_hosts."""
+        try:
+            self.credentials.flush()
+        except Exception as e:
+            self.logger.error("Failed to update known_hosts: %s", e)
+
+    def flush_breaker(self):
+        """Persist circuit breaker state changed during this run."""
+        try:
+            self.breaker.flush()
+        except OSError as e:
+            self.logger.error("Failed to save circuit breaker state: %s", e)
+
+    def allow_connect(self, host):
+        """False while ``host`` is skipped by its open circuit."""
+        if self.breaker.allow(host):
+            return True
+        METRICS.inc("circuit_open_skips", host=host)
         self.logger.debug(
-            f"[{session_id}][{hostname}] Host key added to known_hosts"
+            "Circuit open, skipping host", extra=log_context(host=host)
         )
+        return False
 
     def connect_to_host(self, host):
+        """Return ``(client, session_id)``, reusing a pooled transport."""
         session_id = str(uuid.uuid4())[:8]
+        with METRICS.timer("connect", host):
+            if self.pool is not None:
+                client = self.pool.acquire(host, session_id)
+            else:
+                client = self._open_client(host, session_id)
+        if client is None:
+            METRICS.inc("connect_failures", host=host)
+            self.breaker.record_failure(host)
+        else:
+            self.breaker.record_success(host)
+        return client, session_id
+
+    def _open_client(self, host, session_id):
+        """Open a client to ``host``, retrying transient failures."""
+        attempt = 0
+        while True:
+            client, transient = self._try_open_client(host, session_id)
+            if client is not None or not transient:
+                return client
+            if attempt >= self.connect_retries:
+                return None
+            delay = backoff_delay(attempt, self.retry_backoff)
+            attempt += 1
+            self.logger.info(
+                "Retrying connection in %.1fs (attempt %d of %d)",
+                delay,
+                attempt,
+                self.connect_retries,
+                extra=log_context(session_id, host),
+            )
+            METRICS.inc("connect_retries", host=host)
+            time.sleep(delay)
+
+    def _try_open_client(self, host, session_id):
+        """Return ``(client, transient)``; ``transient`` if worth a retry."""
         client = paramiko.SSHClient()
+        sock = None
+        port = self._port(host)
         try:
-            key = paramiko.RSAKey.from_private_key_file(self.private_key_path)
-            if os.path.exists(self.known_hosts_file):
-                client.load_system_host_keys(self.known_hosts_file)
+            key = self.credentials.private_key(self._key_path(host))
+            name = self._known_hosts_name(host)
+            known = self.credentials.host_keys_for(name)
+            for keytype, host_key in known.items():
+                client.get_host_keys().add(name, keytype, host_key)
 
             client.set_missing_host_key_policy(paramiko.RejectPolicy())
 
             self.logger.debug(
-                f"[{session_id}][{host}] Attempting SSH connection"
+                "Attempting SSH connection",
+                extra=log_context(session_id, host),
             )
-            client.connect(
-                hostname=host,
-                username="jacko",
-                pkey=key,
-                allow_agent=False,
-                look_for_keys=False,
+            # Resolve and connect ourselves so each phase can be timed;
+            # paramiko does key exchange and auth in a single call
+            jump = self._jump(host)
+            if jump:
+                # The bastion resolves and connects to the host for us
+                with METRICS.timer("jump_channel", host):
+                    sock = self.bastions.open_channel(
+                        jump, host, port, session_id, self.connect_timeout
+                    )
+            else:
+                with METRICS.timer("dns", host):
+                    addrinfo = socket.getaddrinfo(
+                        host, port, type=socket.SOCK_STREAM
+                    )
+                with METRICS.timer("tcp_connect", host):
+                    sock = self._open_socket(addrinfo)
+            with METRICS.timer("handshake", host):
+                client.connect(
+                    hostname=host,
+                    port=port,
+                    username=self._username(host),
+                    pkey=key,
+                    allow_agent=False,
+                    look_for_keys=False,
+                    sock=sock,
+                    banner_timeout=self.banner_timeout,
+                    auth_timeout=self.auth_timeout,
+                )
+            with METRICS.timer("host_key", host):
+                self.add_host_key(client, host, session_id)
+            # Let commands know which host they run on and share its facts
+            client.av_host = host
+            client.av_facts = self.facts
+            self.logger.info(
+                "Connected successfully", extra=log_context(session_id, host)
+            )
+            return client, False
+        except socket.gaierror as e:
+            # DNS failures are not going to fix themselves within a run
+            transient = False
+            self.logger.error(
+                "Could not resolve host: %s",
+                e,
+                extra=log_context(session_id, host),
+            )
+        except (
+            paramiko.AuthenticationException,
+            paramiko.BadHostKeyException,
+        ) as ssh_err:
+            transient = False
+            self.logger.error(
+                "SSH error: %s", ssh_err, extra=log_context(session_id, host)
             )
-            self.add_host_key(client, host, session_id)
-            self.logger.info(f"[{session_id}][{host}] Connected successfully")
-            return client, session_id
         except paramiko.SSHException as ssh_err:
-            self.logger.error(f"[{session_id}][{host}] SSH error: {ssh_err}")
+            # A banner that never arrives is an overloaded or flaky peer;
+            # anything else (e.g. an unknown host key) will not change
+            transient = "banner" in str(ssh_err).lower()
+            self.logger.error(
+                "SSH error: %s", ssh_err, extra=log_context(session_id, host)
+            )
+        except (OSError, EOFError) as e:
+            transient = True
+            self.logger.error(
+                "Connection failed: %s", e, extra=log_context(session_id, host)
+            )
         except Exception as e:
-            self.logger.error(f"[{session_id}][{host}] Connection failed: {e}")
-        return None, session_id
+            transient = False
+            self.logger.error(
+                "Connection failed: %s", e, extra=log_context(session_id, host)
+            )
+        client.close()
+        if sock is not None:
+            sock.close()
+        return None, transient
+
+    # Inventory hosts carry their own user, port and key; plain host
+    # strings use the connector's defaults
+    def _username(self, host):
+        return getattr(host, "user", None) or self.username
+
+    def _port(self, host):
+        return getattr(host, "port", None) or self.port
+
+    def _jump(self, host):
+        # An explicit jump of "" (e.g. a bastion) means a direct connection
+        jump = getattr(host, "jump", None)
+        return self.jump_host if jump is None else jump
+
+    def _key_path(self, host):
+        key = getattr(host, "key", None)
+        return os.path.expanduser(key) if key else self.private_key_path
+
+    def _known_hosts_name(self, host):
+        # known_hosts (and paramiko) key non-standard ports as [host]:port
+        port = self._port(host)
+        if port == 22:
+            return str(host)
+        return f"[{host}]:{port}"
+
+    def _open_socket(self, addrinfo):
+        """Connect to the first reachable address from getaddrinfo()."""
+        error = OSError("no addresses to connect to")
+        for family, socktype, proto, _, address in addrinfo:
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(self.connect_timeout)
+            try:
+                sock.connect(address)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        raise error
 
     def execute_command(self, client, command: Command, session_id, host):
+        context = log_context(session_id, host)
         if client is None:
-            self.logger.error(f"[{session_id}][{host}] SSH client is None")
+            self.logger.error("SSH client is None", extra=context)
             return None
         try:
-            self.logger.debug(f"[{session_id}][{host}] Executing command")
-            output = command.execute(client)
+            self.logger.debug("Executing command", extra=context)
+            with METRICS.timer("execute", host):
+                output = command.execute(client)
+            record_output(output, host)
             return output
         except Exception as e:
-            self.logger.error(f"[{session_id}][{host}] Command failed: {e}")
+            self.logger.error("Command failed: %s", e, extra=context)
+            METRICS.inc("command_failures", host=host)
             return None
 
     def close_connection(self, client, session_id, host):
-        if client:
+        if not client:
+            return
+        with METRICS.timer("close", host):
+            self._close_client(client, session_id, host)
+
+    def _close_client(self, client, session_id, host):
+        if self.pool is not None:
+            self.pool.release(host, client)
+            self.logger.debug(
+                "Connection returned to pool",
+                extra=log_context(session_id, host),
+            )
+        else:
             client.close()
-            self.logger.info(f"[{session_id}][{host}] Connection closed")
+            self.logger.info(
+                "Connection closed", extra=log_context(session_id, host)
+            )
+
+    def abort_connection(self, client, session_id, host):
+        """Close ``client`` under a running command, e.g. at a deadline."""
+        if self.pool is not None:
+            # Through the pool, so the next command on the host reconnects
+            self.pool.discard(host, client)
+        else:
+            client.close()
+        self.logger.info(
+            "Connection aborted", extra=log_context(session_id, host)
+        )
+
+    def evict_idle(self):
+        """Close pooled and bastion connections idle for too long."""
+        if self.pool is not None:
+            self.pool.evict_idle()
+        self.bastions.evict_idle()
+
+    def shutdown(self):
+        """Close every pooled connection and persist new host keys."""
+        if self.pool is not None:
+            self.pool.close_all()
+        self.bastions.close_all()
+        self.flush_host_keys()
+        self.flush_breaker()
 
     def connect_and_run(self, command: Command):
         """Connect to hosts and run a command using SSHConnector."""
@@ -100,4 +383,4 @@ class SSHConnector:
             ssh_connector = SSHConnector(hosts_file, private_key_path)
             ssh_connector.run(command)
         except Exception as e:
-            self.logger.error(f"An error occurred: {e}")
+            self.logger.error("An error occurred: %s", e)
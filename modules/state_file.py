@@ -0,0 +1,61 @@
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on ``path`` (created if missing)."""
+    with open(path, "a+") as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def read_json(path):
+    """Return the JSON object in ``path``, or ``{}`` if it is missing."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def update_json(path, entries, keys):
+    """Write ``entries[key]`` for every key in ``keys`` into ``path``.
+
+    Keys missing from ``entries`` are removed from the file. The file is
+    re-read under a lock first, so processes that update different keys
+    (worker processes sharded by host) keep each other's changes. Returns
+    the merged object.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(f"{path}.lock"):
+        merged = read_json(path)
+        for key in keys:
+            if key in entries:
+                merged[key] = entries[key]
+            else:
+                merged.pop(key, None)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(merged, f)
+        os.replace(tmp_path, path)
+    return merged